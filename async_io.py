@@ -0,0 +1,98 @@
+import os
+import shutil
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def copy_file(source, dest):
+    """Copies a file so that dest only ever appears complete."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temp_dest = dest + ".partial"
+    shutil.copyfile(source, temp_dest)
+    os.replace(temp_dest, dest)
+
+
+def publish_file(local_path, dest):
+    copy_file(local_path, dest)
+    os.remove(local_path)
+
+
+class AsyncFileIO:
+    """Moves files between slow storage and a local staging directory in the background.
+
+    A bounded thread pool performs the blocking calls. Upcoming sources are copied to the staging
+    directory before the workers ask for them, and finished outputs are copied to their destination
+    while the workers go on with other documents.
+    """
+
+    def __init__(self, staging_dir, max_threads=4, prefetch_depth=8, max_pending_writes=32):
+        self.staging_dir = staging_dir
+        self.prefetch_depth = prefetch_depth
+        self.max_pending_writes = max_pending_writes
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="async_io")
+        self.pending_writes = deque()
+
+    def __enter__(self):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        return self
+
+    def __exit__(self, *exc_info):
+        # Every copy still queued finishes on a normal exit. On interruption, queued copies are cancelled
+        # and running ones are abandoned; their destinations never appear half written.
+        self.executor.shutdown(wait=exc_info[0] is None, cancel_futures=exc_info[0] is not None)
+
+    def submit(self, func, *args):
+        """Runs a blocking call in the thread pool and returns a future for its result."""
+        return self.executor.submit(func, *args)
+
+    def staged_path(self, index, source):
+        # One directory per source keeps the original file name, which some converters rely on.
+        return os.path.join(self.staging_dir, "in", str(index), os.path.basename(source))
+
+    def prefetch(self, sources):
+        """Yields (source, staged copy) pairs in order, copying the next prefetch_depth sources in the background.
+
+        If a source cannot be copied, it is yielded with None and should be read in place.
+        """
+        window = deque()
+        for index, source in enumerate(sources):
+            staged = self.staged_path(index, source)
+            window.append((source, staged, self.submit(copy_file, source, staged)))
+            if len(window) > self.prefetch_depth:
+                yield AsyncFileIO.finish_prefetch(*window.popleft())
+        while window:
+            yield AsyncFileIO.finish_prefetch(*window.popleft())
+
+    @staticmethod
+    def finish_prefetch(source, staged, future):
+        try:
+            future.result()
+        except OSError as e:
+            print(f"Could not prefetch {source}: {e.__str__()}. Reading it in place.")
+            return source, None
+        return source, staged
+
+    def write_behind(self, key, local_path, dest):
+        """Copies a finished output to its destination in the background.
+
+        Blocks while max_pending_writes copies are unfinished, so a stalled destination cannot fill up the staging directory.
+        """
+        unfinished = [future for _, future in self.pending_writes if not future.done()]
+        while len(unfinished) >= self.max_pending_writes:
+            _, not_done = wait(unfinished, return_when=FIRST_COMPLETED)
+            unfinished = list(not_done)
+        self.pending_writes.append((key, self.submit(publish_file, local_path, dest)))
+
+    def completed_writes(self):
+        """Returns (key, error) for every write that finished since the last call. error is None on success."""
+        completed = []
+        for key, future in list(self.pending_writes):
+            if future.done():
+                self.pending_writes.remove((key, future))
+                error = future.exception()
+                completed.append((key, error))
+        return completed
+
+    def drain(self):
+        wait([future for _, future in self.pending_writes])
+        return self.completed_writes()
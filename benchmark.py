@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+
+from main import BulkTextExtract
+from metrics import PERCENTILES
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et "
+         "dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+         "commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur").split()
+LINES_PER_PAGE = 45
+PARAGRAPHS_PER_CHAPTER = 12
+
+
+def make_paragraph(rng, sentences=5):
+    sentence_list = []
+    for _ in range(sentences):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 18))]
+        sentence_list.append(" ".join(words).capitalize() + ".")
+    return " ".join(sentence_list)
+
+
+def make_book(seed, chapters):
+    """Builds the text of a synthetic book as a list of (chapter title, paragraphs)."""
+    rng = random.Random(seed)
+    return [
+        (f"Chapter {i + 1}: {rng.choice(WORDS).capitalize()} {rng.choice(WORDS)}",
+         [make_paragraph(rng) for _ in range(PARAGRAPHS_PER_CHAPTER)])
+        for i in range(chapters)
+    ]
+
+
+def wrap(text, width=90):
+    lines, line = [], ""
+    for word in text.split():
+        if len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}".strip()
+    if line:
+        lines.append(line)
+    return lines
+
+
+def pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, book, pages):
+    """Writes a plain text PDF with a fixed number of pages, using the standard Helvetica font."""
+    lines = []
+    for title, paragraphs in book:
+        lines.append(("title", title))
+        for paragraph in paragraphs:
+            lines.extend(("text", line) for line in wrap(paragraph))
+            lines.append(("text", ""))
+
+    # Repeat the book as needed so that every page is filled
+    while len(lines) < pages * LINES_PER_PAGE:
+        lines.extend(lines)
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # The page tree is filled in once the page objects are numbered
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold >>",
+    ]
+    page_ids = []
+    for page in range(pages):
+        content = ["BT", "72 740 Td", "14 TL"]
+        for kind, line in lines[page * LINES_PER_PAGE:(page + 1) * LINES_PER_PAGE]:
+            font = "/F2 14" if kind == "title" else "/F1 11"
+            content.append(f"{font} Tf ({pdf_escape(line)}) '")
+        content.append("ET")
+        stream = "\n".join(content).encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> >>" % len(objects))
+        page_ids.append(len(objects))
+
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode()
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset))
+
+
+def write_epub(path, book, title):
+    """Writes a minimal EPUB 2 book with one XHTML document per chapter."""
+    chapter_files = [f"chapter_{i + 1}.xhtml" for i in range(len(book))]
+    manifest = "".join(f'<item id="c{i}" href="{name}" media-type="application/xhtml+xml"/>' for i, name in enumerate(chapter_files))
+    spine = "".join(f'<itemref idref="c{i}"/>' for i in range(len(chapter_files)))
+    nav_points = "".join(
+        f'<navPoint id="n{i}" playOrder="{i + 1}"><navLabel><text>{chapter_title}</text></navLabel><content src="{name}"/></navPoint>'
+        for i, (name, (chapter_title, _)) in enumerate(zip(chapter_files, book))
+    )
+
+    with zipfile.ZipFile(path, "w") as epub:
+        # The mimetype must come first and must not be compressed
+        epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", (
+            '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'
+        ), compress_type=zipfile.ZIP_DEFLATED)
+        epub.writestr("OEBPS/content.opf", (
+            '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="2.0">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:title>{title}</dc:title><dc:language>en</dc:language><dc:identifier id="id">{title}</dc:identifier></metadata>'
+            f'<manifest><item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>{manifest}</manifest>'
+            f'<spine toc="ncx">{spine}</spine></package>'
+        ), compress_type=zipfile.ZIP_DEFLATED)
+        epub.writestr("OEBPS/toc.ncx", (
+            '<?xml version="1.0"?><ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f'<head><meta name="dtb:uid" content="{title}"/></head><docTitle><text>{title}</text></docTitle>'
+            f'<navMap>{nav_points}</navMap></ncx>'
+        ), compress_type=zipfile.ZIP_DEFLATED)
+        for name, (chapter_title, paragraphs) in zip(chapter_files, book):
+            body = "".join(f"<p>{paragraph}</p>" for paragraph in paragraphs)
+            epub.writestr(f"OEBPS/{name}", (
+                '<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml">'
+                f"<head><title>{chapter_title}</title></head><body><h1>{chapter_title}</h1>{body}</body></html>"
+            ), compress_type=zipfile.ZIP_DEFLATED)
+
+
+def build_corpus(corpus_dir, documents, page_counts):
+    """Generates documents of each format and size, skipping files that already exist.
+
+    PDFs have exactly the requested number of pages; EPUBs and MOBIs have the same text with about
+    one chapter per four pages. MOBIs need calibre's ebook-convert and are skipped without it.
+    """
+    converter = shutil.which("ebook-convert")
+    if converter is None:
+        print("ebook-convert (calibre) was not found, so the corpus will not contain MOBI files.")
+
+    for pages in page_counts:
+        for i in range(documents):
+            name = f"book_{pages}p_{i + 1:03}"
+            book = make_book(seed=pages * 1000 + i, chapters=max(1, pages // 4))
+
+            pdf_path = os.path.join(corpus_dir, "pdf", f"{name}.pdf")
+            epub_path = os.path.join(corpus_dir, "epub", f"{name}.epub")
+            mobi_path = os.path.join(corpus_dir, "mobi", f"{name}.mobi")
+            for path in (pdf_path, epub_path, mobi_path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            if not os.path.exists(pdf_path):
+                write_pdf(pdf_path, book, pages)
+            if not os.path.exists(epub_path):
+                write_epub(epub_path, book, name)
+            if converter is not None and not os.path.exists(mobi_path):
+                subprocess.run([converter, epub_path, mobi_path], check=True, capture_output=True)
+
+
+def run_once(corpus_dir, workers, unstructured_settings):
+    """Runs a full BulkTextExtract session over the corpus and returns its metrics summary."""
+    # Start every run cold, otherwise only the first one would pay for MOBI conversion
+    shutil.rmtree(os.path.join(corpus_dir, BulkTextExtract.mobi_cache_dir), ignore_errors=True)
+
+    with tempfile.TemporaryDirectory(prefix="bulk_text_extract_bench_") as output_dir:
+        app = BulkTextExtract(corpus_dir, max_num_threads=workers, output_mode="collect", output_dir=output_dir,
+                              unstructured_settings=unstructured_settings)
+        # Keep the session state out of the corpus, so no run resumes or skips what another one left behind
+        app.progress_file = os.path.join(output_dir, "progress.json")
+        app.find_files()
+        start_time = time.time()
+        app.begin_extract()
+        run_seconds = time.time() - start_time
+
+    missing = len(app.files) - len(app.completed)
+    if missing > 0:
+        raise RuntimeError(f"{missing} of {len(app.files)} documents were not extracted, so the run is not comparable.")
+
+    return app, app.metrics.summary(run_seconds)
+
+
+def make_result(workers, chunking, app, summary):
+    run_seconds = summary["run_seconds"]
+    documents = len(app.completed)
+    elements = summary["counters"].get("elements", 0)
+    return {
+        "workers": workers,
+        "chunking": chunking,
+        "documents": documents,
+        "run_seconds": run_seconds,
+        "documents_per_second": documents / run_seconds,
+        "elements_per_second": elements / run_seconds,
+        "stages": {
+            name: {key: stage[key] for key in ("count", "seconds", *(f"p{p}_seconds" for p in PERCENTILES))}
+            for name, stage in summary["stages"].items()
+        },
+        "peak_rss": max(summary["workers"].values()),
+        "workers_peak_rss": summary["workers"],
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark BulkTextExtract on a synthetic corpus of PDF, EPUB and MOBI files.")
+    parser.add_argument("output", nargs="?", default="bench_extract.json", help="Where to write the JSON results.")
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "bulk_text_extract_corpus"),
+                        help="Where to generate the corpus. Existing files are reused. Default: %(default)s.")
+    parser.add_argument("--documents", type=int, default=4, help="Documents per format and size. Default: %(default)s.")
+    parser.add_argument("--pages", default="20,200", help="Comma-separated document sizes in pages. Default: %(default)s.")
+    parser.add_argument("--workers", default="1,2,4,6", help="Comma-separated worker counts to compare. Default: %(default)s.")
+    parser.add_argument("--chunking", default="by_title,none",
+                        help="Comma-separated chunking strategies to compare; none disables chunking. Default: %(default)s.")
+    parser.add_argument("--max-characters", type=int, default=None, help="max_characters passed to the chunker.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    build_corpus(args.corpus_dir, args.documents, [int(pages) for pages in args.pages.split(",")])
+
+    results = []
+    for chunking in args.chunking.split(","):
+        settings = {key: value for key, value in BulkTextExtract.unstructured_settings.items() if key != "chunking_strategy"}
+        if chunking != "none":
+            settings["chunking_strategy"] = chunking
+            if args.max_characters is not None:
+                settings["max_characters"] = args.max_characters
+
+        for workers in [int(workers) for workers in args.workers.split(",")]:
+            print(f"Benchmarking {workers} workers with chunking strategy {chunking}.")
+            app, summary = run_once(args.corpus_dir, workers, settings)
+            results.append(make_result(workers, chunking, app, summary))
+
+    for result in results:
+        partition = result["stages"].get("partition", {})
+        print(f"{result['workers']} workers, chunking {result['chunking']}: "
+              f"{result['documents_per_second']:.2f} documents/s, {result['elements_per_second']:.1f} elements/s, "
+              f"partition p50 {partition.get('p50_seconds', 0):.2f}s p99 {partition.get('p99_seconds', 0):.2f}s, "
+              f"peak memory {result['peak_rss'] / 1024 ** 2:.0f} MiB.")
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "corpus": {"documents": args.documents, "pages": args.pages},
+            "results": results,
+        }, f, indent=4)
+    print(f"Results written to {args.output}.")
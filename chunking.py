@@ -0,0 +1,114 @@
+import os
+
+DEFAULT_MAX_CHARACTERS = 500
+DEFAULT_WINDOW_PAGES = 20
+STRATEGIES = ("by_title", "basic")
+
+
+class StreamingChunker:
+    """Combines elements into chunks while a document is being partitioned.
+
+    Elements are fed in document order and every chunk is returned as soon as it is closed: by a
+    new title (by_title only), by a table, or by reaching max_characters. Only the open chunk is
+    held, so memory does not grow with the document. Text longer than max_characters is split.
+    """
+
+    separator = "\n\n"
+    skipped_types = ("PageBreak",)
+
+    def __init__(self, strategy="by_title", max_characters=DEFAULT_MAX_CHARACTERS, filename=None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown chunking strategy {strategy}")
+        self.strategy = strategy
+        self.max_characters = max_characters
+        self.filename = filename
+        self.texts = []
+        self.length = 0
+        self.page_number = None
+        self.section = None
+
+    def make_chunk(self, text, element_type, page_number):
+        metadata = {"filename": self.filename, "page_number": page_number}
+        if self.section is not None:
+            metadata["section"] = self.section
+        return {"type": element_type, "text": text, "metadata": metadata}
+
+    def split(self, text, element_type, page_number):
+        return [self.make_chunk(text[i:i + self.max_characters], element_type, page_number)
+                for i in range(0, len(text), self.max_characters)]
+
+    def feed(self, element):
+        """Adds an element. Returns the chunks it closed."""
+        element_type = getattr(element, "category", type(element).__name__)
+        text = (element.text or "").strip()
+        if element_type in self.skipped_types or len(text) == 0:
+            return []
+        page_number = element.metadata.page_number
+
+        chunks = []
+        if element_type == "Table":
+            # Tables are never combined with text
+            chunks.extend(self.flush())
+            chunks.extend(self.split(text, "Table", page_number))
+            return chunks
+
+        if element_type == "Title" and self.strategy == "by_title":
+            chunks.extend(self.flush())
+            self.section = text
+        elif self.length + len(self.separator) + len(text) > self.max_characters:
+            chunks.extend(self.flush())
+
+        if len(text) > self.max_characters:
+            *complete, rest = self.split(text, "CompositeElement", page_number)
+            chunks.extend(complete)
+            text = rest["text"]
+
+        if len(self.texts) == 0:
+            self.page_number = page_number
+        else:
+            self.length += len(self.separator)
+        self.texts.append(text)
+        self.length += len(text)
+        return chunks
+
+    def flush(self):
+        """Closes the open chunk, if any. Returns the closed chunks."""
+        if len(self.texts) == 0:
+            return []
+        chunk = self.make_chunk(self.separator.join(self.texts), "CompositeElement", self.page_number)
+        self.texts = []
+        self.length = 0
+        return [chunk]
+
+
+def iter_page_windows(path, window_dir, window_pages=DEFAULT_WINDOW_PAGES):
+    """Yields (file, number of preceding pages) for consecutive windows of the pages of a PDF.
+
+    Each window is written to window_dir and removed once the next one is requested. Other documents,
+    short PDFs and every PDF when pypdf is not installed are yielded whole.
+    """
+    if not path.lower().endswith(".pdf"):
+        yield path, 0
+        return
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        yield path, 0
+        return
+
+    reader = PdfReader(path)
+    page_count = len(reader.pages)
+    if page_count <= window_pages:
+        yield path, 0
+        return
+
+    for first_page in range(0, page_count, window_pages):
+        writer = PdfWriter()
+        for i in range(first_page, min(first_page + window_pages, page_count)):
+            writer.add_page(reader.pages[i])
+        window = os.path.join(window_dir, f"window_{first_page}.pdf")
+        writer.write(window)
+        try:
+            yield window, first_page
+        finally:
+            os.remove(window)
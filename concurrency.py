@@ -0,0 +1,95 @@
+import os
+import time
+
+
+def get_available_memory():
+    """The memory available for new allocations without swapping, in bytes. None if the system does not report it."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_process_rss(pid):
+    """The resident set size of a process in bytes, or 0 if it has exited."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def get_child_pids(parent=None):
+    parent = os.getpid() if parent is None else parent
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name is enclosed in parentheses and may itself contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == parent:
+            children.append(int(entry))
+    return children
+
+
+class ConcurrencyController:
+    """Adapts the number of documents extracted at once to the memory left on the system.
+
+    The limit starts at max_workers. Whenever less than min_available bytes are available it is
+    lowered, and halved below half of that. It is raised again once there is room for another
+    document as large as the largest worker. The pool keeps max_workers processes; the limit only
+    holds back dispatch. On systems without /proc, the limit stays at max_workers.
+    """
+
+    def __init__(self, min_workers, max_workers, min_available, sample_interval=1):
+        self.min_workers = max(1, min(min_workers, max_workers))
+        self.max_workers = max_workers
+        self.min_available = min_available
+        self.sample_interval = sample_interval
+        self.limit = max_workers
+        self.last_sample = -sample_interval
+
+    def update(self, available, worker_rss):
+        previous_limit = self.limit
+        largest_worker = max(worker_rss, default=0)
+        if available < self.min_available / 2:
+            self.limit = max(self.min_workers, self.limit // 2)
+        elif available < self.min_available:
+            self.limit = max(self.min_workers, self.limit - 1)
+        elif available - self.min_available > largest_worker:
+            self.limit = min(self.max_workers, self.limit + 1)
+
+        if self.limit != previous_limit:
+            print(f"{available // 2 ** 20}MiB of memory available. Extracting at most {self.limit} documents at once.")
+
+    def sample(self):
+        now = time.monotonic()
+        if now - self.last_sample < self.sample_interval:
+            return
+        self.last_sample = now
+        available = get_available_memory()
+        if available is not None:
+            self.update(available, [get_process_rss(pid) for pid in get_child_pids()])
+
+    def gate(self, tasks, finished_tasks):
+        """Yields the tasks, waiting while limit tasks are in flight.
+
+        finished_tasks is a shared counter the workers increment, since the pool only collects results
+        between two tasks taken from this generator.
+        """
+        dispatched = 0
+        for task in tasks:
+            self.sample()
+            while dispatched - finished_tasks.value >= self.limit:
+                time.sleep(self.sample_interval / 4)
+                self.sample()
+            dispatched += 1
+            yield task
@@ -0,0 +1,222 @@
+import html
+import os
+import re
+import shutil
+import struct
+import unicodedata
+import zipfile
+import zlib
+from xml.etree import ElementTree
+
+TITLE_KEY_WORDS = 10
+SHINGLE_WORDS = 5
+# Only shingles whose hash is divisible by this are kept. The selection is the same for every
+# document, so the kept shingles still estimate the overlap of the whole texts.
+SHINGLE_SAMPLE_RATE = 8
+MIN_SHINGLES = 20
+MIN_CONTAINMENT = 0.5
+PDF_SAMPLE_PAGES = 5
+DEFAULT_PREFERENCE = ("epub", "pdf", "mobi")
+MOBI_EXTENSIONS = (".mobi", ".prc", ".azw", ".azw3", ".azw4")
+
+
+def get_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    return "mobi" if extension in MOBI_EXTENSIONS else extension[1:]
+
+
+def normalize_title(title):
+    """Reduces a title to its first words in lower case without accents or punctuation."""
+    title = unicodedata.normalize("NFKD", title).encode("ascii", "ignore").decode("ascii")
+    words = re.findall(r"[a-z0-9]+", title.lower())
+    return " ".join(words[:TITLE_KEY_WORDS])
+
+
+def read_epub_title(path):
+    with zipfile.ZipFile(path) as book:
+        container = ElementTree.fromstring(book.read("META-INF/container.xml"))
+        rootfile = container.find(".//{*}rootfile")
+        package = ElementTree.fromstring(book.read(rootfile.get("full-path")))
+        title = package.find(".//{http://purl.org/dc/elements/1.1/}title")
+        return title.text if title is not None else None
+
+
+def read_pdf_title(path):
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdftypes import resolve1
+    from pdfminer.utils import decode_text
+
+    with open(path, "rb") as f:
+        document = PDFDocument(PDFParser(f))
+        for info in document.info:
+            title = resolve1(info.get("Title"))
+            if isinstance(title, bytes):
+                return decode_text(title)
+    return None
+
+
+def read_mobi_title(path):
+    """Reads the full name from the MOBI header of the first record."""
+    with open(path, "rb") as f:
+        header = f.read(78)
+        record_count = struct.unpack(">H", header[76:78])[0]
+        if record_count == 0:
+            return None
+        record_offset = struct.unpack(">L", f.read(4))[0]
+        f.seek(record_offset)
+        record = f.read(92)
+        if record[16:20] != b"MOBI":
+            return None
+        encoding = "utf-8" if struct.unpack(">L", record[28:32])[0] == 65001 else "cp1252"
+        name_offset, name_length = struct.unpack(">LL", record[84:92])
+        f.seek(record_offset + name_offset)
+        return f.read(name_length).decode(encoding, "replace")
+
+
+def get_title_keys(path):
+    """Cheap keys under which copies of the same book are expected to collide: the file name and the embedded title."""
+    keys = {normalize_title(os.path.splitext(os.path.basename(path))[0])}
+    readers = {"epub": read_epub_title, "pdf": read_pdf_title, "mobi": read_mobi_title}
+    reader = readers.get(get_format(path))
+    if reader is not None:
+        try:
+            title = reader(path)
+        except Exception as e:
+            print(f"Could not read the title of {path}: {e.__str__()}")
+            title = None
+        if title:
+            keys.add(normalize_title(title))
+    keys.discard("")
+    return keys
+
+
+def html_to_text(markup):
+    markup = re.sub(r"<(script|style)\b.*?</\1>", " ", markup, flags=re.S | re.I)
+    return html.unescape(re.sub(r"<[^>]+>", " ", markup))
+
+
+def sample_epub_text(path):
+    # Reading every chapter is cheap compared to partitioning and makes the set complete
+    with zipfile.ZipFile(path) as book:
+        names = [name for name in book.namelist() if name.lower().endswith((".xhtml", ".html", ".htm"))]
+        return " ".join(html_to_text(book.read(name).decode("utf-8", "replace")) for name in names)
+
+
+def sample_html_text(path):
+    with open(path, "rb") as f:
+        return html_to_text(f.read().decode("utf-8", "replace"))
+
+
+def sample_pdf_text(path):
+    """Extracts the text of a few pages spread over the document, skipping the front and back matter."""
+    from pdfminer.high_level import extract_text
+    from pdfminer.pdfpage import PDFPage
+
+    with open(path, "rb") as f:
+        page_count = sum(1 for _ in PDFPage.get_pages(f))
+    pages = sorted({(k + 1) * page_count // (PDF_SAMPLE_PAGES + 1) for k in range(PDF_SAMPLE_PAGES)})
+    return extract_text(path, page_numbers=pages)
+
+
+def get_shingles(text):
+    """Hashes of the sampled word shingles of a text."""
+    words = re.findall(r"\w+", text.lower())
+    shingles = set()
+    for i in range(len(words) - SHINGLE_WORDS + 1):
+        h = zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+        if h % SHINGLE_SAMPLE_RATE == 0:
+            shingles.add(h)
+    return shingles
+
+
+def get_text_fingerprint(path, convert_mobi=None):
+    """Returns the sampled shingles of a document, or None if its text cannot be read."""
+    source = path
+    if get_format(path) == "mobi":
+        source = convert_mobi(path) if convert_mobi is not None else False
+        if source is False:
+            return None
+
+    samplers = {".epub": sample_epub_text, ".html": sample_html_text, ".pdf": sample_pdf_text}
+    sampler = samplers.get(os.path.splitext(source)[1].lower())
+    if sampler is None:
+        return None
+    try:
+        shingles = get_shingles(sampler(source))
+    except Exception as e:
+        print(f"Could not sample the text of {path}: {e.__str__()}")
+        return None
+    # Scans without a text layer cannot be compared
+    return shingles if len(shingles) >= MIN_SHINGLES else None
+
+
+def containment(a, b):
+    """How much of the smaller sample appears in the larger one, so a few sampled pages can match a whole book."""
+    return len(a & b) / min(len(a), len(b))
+
+
+def group_candidates(files):
+    """Groups files that share a title key, directly or through other files."""
+    parents = {file: file for file in files}
+
+    def find(file):
+        while parents[file] != file:
+            parents[file] = parents[parents[file]]
+            file = parents[file]
+        return file
+
+    owners = {}
+    for file in files:
+        for key in get_title_keys(file):
+            if key in owners:
+                parents[find(file)] = find(owners[key])
+            else:
+                owners[key] = file
+
+    groups = {}
+    for file in files:
+        groups.setdefault(find(file), []).append(file)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(files, preference=DEFAULT_PREFERENCE, convert_mobi=None, groups=None):
+    """Finds documents that are copies of another document in a preferred format.
+
+    Candidates share a title key, and are confirmed by comparing sampled text shingles, so only
+    the files of candidate groups are read. Returns a dict mapping each duplicate to the document
+    that is extracted in its place. convert_mobi turns a MOBI book into an epub, html or pdf file.
+    groups are the candidate groups, if they have already been found with group_candidates.
+    """
+    def rank(file):
+        file_format = get_format(file)
+        return (preference.index(file_format) if file_format in preference else len(preference), file)
+
+    duplicates = {}
+    for group in (group_candidates(files) if groups is None else groups):
+        # Every member is compared with the most preferred document of each confirmed set
+        representatives = []
+        for file in sorted(group, key=rank):
+            fingerprint = get_text_fingerprint(file, convert_mobi)
+            if fingerprint is None:
+                continue
+            for representative, representative_fingerprint in representatives:
+                if containment(fingerprint, representative_fingerprint) >= MIN_CONTAINMENT:
+                    duplicates[file] = representative
+                    break
+            else:
+                representatives.append((file, fingerprint))
+    return duplicates
+
+
+def link_output(target, link):
+    """Makes link refer to the output at target. Copies it where symbolic links are not permitted."""
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    temp_link = link + ".partial"
+    if os.path.lexists(temp_link):
+        os.remove(temp_link)
+    try:
+        os.symlink(os.path.relpath(target, os.path.dirname(link)), temp_link)
+    except (OSError, NotImplementedError):
+        shutil.copyfile(target, temp_link)
+    os.replace(temp_link, link)
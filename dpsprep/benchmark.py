@@ -0,0 +1,421 @@
+from pathlib import Path
+from time import time
+from typing import Any, Callable, Literal, Union
+import json
+import multiprocessing
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+
+import click
+import djvu.decode
+import pdfrw
+from loguru import logger
+from PIL import Image, ImageDraw
+
+from .dpsprep import process_page_bg
+from .images import djvu_page_to_image
+from .logging import configure_loguru, human_readable_size
+from .metrics import Metrics
+from .pdf import combine_pdfs_on_fs_with_text, combine_pdfs_on_fs_without_text
+from .text import djvu_pages_to_text_fpdf
+from .workdir import WorkingDirectory
+
+
+DocumentKind = Literal['bitonal', 'grayscale', 'color']
+DOCUMENT_KINDS: tuple[DocumentKind, ...] = ('bitonal', 'grayscale', 'color')
+
+PageEncodingOption = Literal['auto', 'native']
+# The default of dpsprep comes last, so that the combination stages measure its pages
+ENCODINGS: tuple[PageEncodingOption, ...] = ('auto', 'native')
+# Results from before the encoding was recorded only come from automatic encoding, except for these stages
+ENCODING_INDEPENDENT_STAGES = ('djvu_page_to_image', 'djvu_pages_to_text_fpdf')
+
+# US Letter at 300 dpi, which is typical for scanned books
+PAGE_SIZE = (2550, 3300)
+PAGE_DPI = 300
+MARGIN = 150
+LINE_HEIGHT = 48
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor']
+
+REQUIRED_TOOLS = ('cjb2', 'c44', 'djvm', 'djvused')
+
+
+def missing_djvulibre_tools():
+    return [tool for tool in REQUIRED_TOOLS if shutil.which(tool) is None]
+
+
+def draw_page(kind: DocumentKind, seed: int) -> tuple[Image.Image, list[tuple[int, int, int, int, str]]]:
+    """Draw a synthetic book page.
+
+    Words are drawn as clusters of glyph-like bars, which compress similarly to real text.
+    Grayscale and color pages also get an illustration. Returns the image and the word boxes
+    in image coordinates.
+    """
+    rng = random.Random(seed)
+    width, height = PAGE_SIZE
+
+    if kind == 'color':
+        image = Image.new('RGB', PAGE_SIZE, (250, 244, 228))
+    else:
+        image = Image.new('L', PAGE_SIZE, 255)
+
+    draw = ImageDraw.Draw(image)
+    words = []
+    y = MARGIN
+
+    if kind != 'bitonal':
+        illustration_bottom = MARGIN + height // 4
+        ink = (rng.randrange(256), rng.randrange(256), rng.randrange(256)) if kind == 'color' else rng.randrange(200)
+
+        for x in range(MARGIN, width - MARGIN, 4):
+            shade = 40 + 180 * (x - MARGIN) // (width - 2 * MARGIN)
+            draw.line([(x, MARGIN), (x, illustration_bottom)], fill=(shade, shade // 2, 255 - shade) if kind == 'color' else shade, width=4)
+
+        draw.ellipse([width // 3, MARGIN + 40, 2 * width // 3, illustration_bottom - 40], fill=ink)
+        y = illustration_bottom + LINE_HEIGHT
+
+    black = (20, 20, 20) if kind == 'color' else 0
+
+    while y + LINE_HEIGHT < height - MARGIN:
+        x = MARGIN
+
+        while True:
+            word = rng.choice(WORDS)
+            word_width = 22 * len(word)
+
+            if x + word_width > width - MARGIN:
+                break
+
+            for i in range(len(word)):
+                glyph_height = rng.choice((24, 24, 24, 32))
+                draw.rectangle((x + 22 * i + 3, y + 32 - glyph_height, x + 22 * i + 18, y + 32), fill=black)
+
+            words.append((x, y, x + word_width, y + 32, word))
+            x += word_width + 22
+
+        y += LINE_HEIGHT
+
+    return (image.convert('1') if kind == 'bitonal' else image), words
+
+
+def words_to_text_sexpr(words: list[tuple[int, int, int, int, str]]):
+    width, height = PAGE_SIZE
+    # DjVu text coordinates start at the bottom left corner
+    word_sexprs = ' '.join(f'(word {x1} {height - y2} {x2} {height - y1} "{text}")' for x1, y1, x2, y2, text in words)
+    return f'(page 0 0 {width} {height} (line 0 0 {width} {height} {word_sexprs}))\n'
+
+
+def generate_page(kind: DocumentKind, tmp: Path, i: int):
+    image, words = draw_page(kind, seed=i)
+    page_path = tmp / f'page_{i + 1:05}.djvu'
+
+    if kind == 'bitonal':
+        image_path = tmp / f'page_{i + 1:05}.pbm'
+        image.save(image_path)
+        subprocess.run(['cjb2', '-dpi', str(PAGE_DPI), image_path, page_path], check=True)
+    else:
+        image_path = tmp / f'page_{i + 1:05}.{"ppm" if kind == "color" else "pgm"}'
+        image.save(image_path)
+        subprocess.run(['c44', '-dpi', str(PAGE_DPI), image_path, page_path], check=True)
+
+    text_path = tmp / f'page_{i + 1:05}.txt'
+    text_path.write_text(words_to_text_sexpr(words))
+    subprocess.run(['djvused', page_path, '-e', f'select 1; set-txt {text_path}', '-s'], check=True)
+    image_path.unlink()
+    text_path.unlink()
+    return page_path
+
+
+def generate_document(path: Path, kind: DocumentKind, pages: int, pool_size: int):
+    """Generate a bundled DjVu document with a text layer and a flat outline with one bookmark per ten pages."""
+    with tempfile.TemporaryDirectory(prefix='dpsprep_bench_') as tmp:
+        with multiprocessing.Pool(processes=pool_size) as pool:
+            page_paths = pool.starmap(generate_page, [(kind, Path(tmp), i) for i in range(pages)])
+
+        subprocess.run(['djvm', '-c', path, *page_paths], check=True)
+
+    outline_path = path.with_suffix('.outline')
+    bookmarks = ' '.join(f'("Chapter {i // 10 + 1}" "#{i + 1}")' for i in range(0, pages, 10))
+    outline_path.write_text(f'(bookmarks {bookmarks})\n')
+    subprocess.run(['djvused', path, '-e', f'set-outline {outline_path}', '-s'], check=True)
+    outline_path.unlink()
+
+
+def ensure_document(cache_dir: Path, kind: DocumentKind, pages: int, pool_size: int):
+    path = cache_dir / f'synthetic_{kind}_{pages}.djvu'
+
+    if path.exists():
+        logger.info(f'Reusing generated document {path}.')
+    else:
+        logger.info(f'Generating {pages}-page {kind} document {path}.')
+        start_time = time()
+        generate_document(path, kind, pages, pool_size)
+        logger.info(f'Generated {path} with size {human_readable_size(os.path.getsize(path))} in {time() - start_time:.2f}s.')
+
+    return path
+
+
+def open_document(src: Path):
+    document = djvu.decode.Context().new_document(djvu.decode.FileURI(src))
+    document.decoding_job.wait()
+    return document
+
+
+def render_pages(src: Path):
+    metrics = Metrics()
+    document = open_document(src)
+
+    for i, page in enumerate(document.pages):
+        with metrics.stage('djvu_page_to_image'):
+            djvu_page_to_image(page, i)
+
+    return metrics.as_dict()
+
+
+def render_text_layer(src: Path, dest: Path):
+    metrics = Metrics()
+    document = open_document(src)
+
+    with metrics.stage('djvu_pages_to_text_fpdf') as record:
+        djvu_pages_to_text_fpdf(document.pages).output(str(dest))
+        record.bytes_out = os.path.getsize(dest)
+
+    return metrics.as_dict()
+
+
+def combine_without_text(workdir: WorkingDirectory, pages: int):
+    metrics = Metrics()
+
+    with metrics.stage('combine') as record:
+        combine_pdfs_on_fs_without_text(workdir, pdfrw.IndirectPdfDict(), pages, workdir.combined_pdf_without_text_path)
+        record.bytes_out = os.path.getsize(workdir.combined_pdf_without_text_path)
+
+    return metrics.as_dict()
+
+
+def combine_with_text(workdir: WorkingDirectory):
+    metrics = Metrics()
+
+    with metrics.stage('combine') as record:
+        combine_pdfs_on_fs_with_text(workdir, pdfrw.IndirectPdfDict(), workdir.combined_pdf_path)
+        record.bytes_out = os.path.getsize(workdir.combined_pdf_path)
+
+    return metrics.as_dict()
+
+
+def run_isolated(func: Callable, *args) -> dict[str, Any]:
+    """Run a stage in a fresh process, so that its peak memory is not hidden by earlier stages."""
+    with multiprocessing.Pool(processes=1) as pool:
+        return pool.apply(func, args)
+
+
+def make_result(
+    kind: DocumentKind,
+    stage: str,
+    encoding: Union[PageEncodingOption, None],
+    pool_size: int,
+    pages: int,
+    seconds: float,
+    snapshot: dict[str, Any]
+):
+    output_bytes = sum(stage_['bytes_out'] for stage_ in snapshot['stages'].values())
+
+    return dict(
+        kind=kind,
+        stage=stage,
+        encoding=encoding,
+        pool_size=pool_size,
+        pages=pages,
+        seconds=seconds,
+        pages_per_second=pages / seconds if seconds > 0 else None,
+        peak_rss=max(snapshot['workers'].values()),
+        output_bytes=output_bytes,
+    )
+
+
+def process_pages(workdir: WorkingDirectory, pages: int, pool_size: int, quality: int, encoding: PageEncodingOption, optlevel: Union[int, None]):
+    # Start from scratch, since process_page_bg skips pages that already exist
+    for i in range(pages):
+        workdir.get_page_pdf_path(i).unlink(missing_ok=True)
+        workdir.get_duplicate_marker_path(i).unlink(missing_ok=True)
+
+    shutil.rmtree(workdir.page_hashes_path, ignore_errors=True)
+    workdir.create_if_necessary()
+    metrics = Metrics()
+
+    with multiprocessing.Pool(processes=pool_size) as pool:
+        for snapshot in pool.starmap(process_page_bg, [(workdir, quality, i, encoding, optlevel) for i in range(pages)]):
+            metrics.merge(snapshot)
+
+    return metrics.as_dict()
+
+
+def benchmark_document(
+    src: Path,
+    kind: DocumentKind,
+    pool_sizes: list[int],
+    optlevel: Union[int, None],
+    quality: int,
+    encodings: tuple[PageEncodingOption, ...] = ENCODINGS
+):
+    results = []
+    pages = len(open_document(src).pages)
+
+    with tempfile.TemporaryDirectory(prefix='dpsprep_bench_') as tmp:
+        workdir = WorkingDirectory(src, Path(tmp) / 'output.pdf')
+        workdir.workdir = Path(tmp) / 'workdir'
+        workdir.create_if_necessary()
+
+        start_time = time()
+        snapshot = run_isolated(render_pages, src)
+        results.append(make_result(kind, 'djvu_page_to_image', None, 1, pages, time() - start_time, snapshot))
+
+        start_time = time()
+        snapshot = run_isolated(render_text_layer, src, workdir.text_layer_pdf_path)
+        results.append(make_result(kind, 'djvu_pages_to_text_fpdf', None, 1, pages, time() - start_time, snapshot))
+
+        for encoding in encodings:
+            if optlevel is not None:
+                for pool_size in pool_sizes:
+                    start_time = time()
+                    snapshot = process_pages(workdir, pages, pool_size, quality, encoding, optlevel)
+                    results.append(make_result(kind, f'process_page_bg_O{optlevel}', encoding, pool_size, pages, time() - start_time, snapshot))
+
+            for pool_size in pool_sizes:
+                start_time = time()
+                snapshot = process_pages(workdir, pages, pool_size, quality, encoding, None)
+                results.append(make_result(kind, 'process_page_bg', encoding, pool_size, pages, time() - start_time, snapshot))
+
+        # The combination stages below use the unoptimized pages from the last encoding and pool size
+        start_time = time()
+        snapshot = run_isolated(combine_without_text, workdir, pages)
+        results.append(make_result(kind, 'combine_pdfs_on_fs_without_text', encodings[-1], 1, pages, time() - start_time, snapshot))
+
+        start_time = time()
+        snapshot = run_isolated(combine_with_text, workdir)
+        results.append(make_result(kind, 'combine_pdfs_on_fs_with_text', encodings[-1], 1, pages, time() - start_time, snapshot))
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_result_key(result: dict[str, Any]):
+    default_encoding = None if result['stage'] in ENCODING_INDEPENDENT_STAGES else 'auto'
+    return result['kind'], result['stage'], result.get('encoding', default_encoding), result['pool_size']
+
+
+def describe_result(result: dict[str, Any]):
+    encoding = '' if result['encoding'] is None else f", {result['encoding']} encoding"
+    return f"{result['kind']} {result['stage']} (pool size {result['pool_size']}{encoding})"
+
+
+def compare_results(results: list[dict[str, Any]], baseline: list[dict[str, Any]]):
+    baseline_by_key = {get_result_key(r): r for r in baseline}
+
+    for result in results:
+        previous = baseline_by_key.get(get_result_key(result))
+
+        if previous is None or not previous['seconds']:
+            continue
+
+        logger.info(
+            f"{describe_result(result)}: "
+            f"time {100 * result['seconds'] / previous['seconds']:.1f}%, "
+            f"output size {100 * result['output_bytes'] / max(previous['output_bytes'], 1):.1f}%, "
+            f"peak memory {100 * result['peak_rss'] / max(previous['peak_rss'], 1):.1f}% of the baseline."
+        )
+
+
+def parse_document_kind(name: str) -> DocumentKind:
+    for kind in DOCUMENT_KINDS:
+        if kind == name:
+            return kind
+
+    raise SystemExit(f'Unknown document kind {repr(name)}. Expected one of {", ".join(DOCUMENT_KINDS)}.')
+
+
+def parse_encoding(name: str) -> PageEncodingOption:
+    for encoding in ENCODINGS:
+        if encoding == name:
+            return encoding
+
+    raise SystemExit(f'Unknown encoding {repr(name)}. Expected one of {", ".join(ENCODINGS)}.')
+
+
+def parse_int_list(ctx, param, value: str):
+    try:
+        return [int(item) for item in value.split(',')]
+    except ValueError:
+        raise click.BadParameter('Expected a comma-separated list of integers.')
+
+
+@click.option('-v', '--verbose', is_flag=True, help='Display debug messages.')
+@click.option('-O', '--optlevel', type=click.IntRange(min=1, max=3), default=None, help='Also benchmark page processing with OCRmyPDF optimization at this level.')
+@click.option('-q', '--quality', type=click.IntRange(min=0, max=100), default=75, help='Image quality passed to process_page_bg.')
+@click.option('-b', '--baseline', type=click.Path(exists=True, dir_okay=False), help='Compare the results to a previous output file.')
+@click.option('-c', '--cache-dir', type=click.Path(file_okay=False), default=None, help='Where to keep generated documents between runs. Defaults to the system temporary directory.')
+@click.option('-e', '--encodings', default=','.join(ENCODINGS), help='Comma-separated list of page encodings to benchmark. The combination stages use the pages of the last one.')
+@click.option('-k', '--kinds', default=','.join(DOCUMENT_KINDS), help='Comma-separated list of document kinds to benchmark.')
+@click.option('-s', '--pool-sizes', default='1,2,4', callback=parse_int_list, help='Comma-separated list of pool sizes.')
+@click.option('-n', '--pages', type=click.IntRange(min=1), default=300, help='Number of pages of each generated document.')
+@click.argument('output', type=click.Path(dir_okay=False), default='benchmark.json')
+@click.command()
+def benchmark(output: str, pages: int, pool_sizes: list[int], kinds: str, encodings: str, cache_dir: Union[str, None], baseline: Union[str, None], quality: int, optlevel: Union[int, None], verbose: bool):
+    """Benchmark the conversion stages on synthetic documents and write the results to OUTPUT as JSON."""
+    configure_loguru(verbose)
+
+    missing = missing_djvulibre_tools()
+
+    if len(missing) > 0:
+        raise SystemExit(f'Generating documents requires the DjVuLibre tools {", ".join(missing)}.')
+
+    kind_list = [parse_document_kind(kind.strip()) for kind in kinds.split(',')]
+    encoding_list = tuple(parse_encoding(encoding.strip()) for encoding in encodings.split(','))
+
+    cache_path = Path(cache_dir) if cache_dir else Path(tempfile.gettempdir()) / 'dpsprep_bench'
+    cache_path.mkdir(parents=True, exist_ok=True)
+    results = []
+
+    for kind in kind_list:
+        src = ensure_document(cache_path, kind, pages, max(pool_sizes))
+        logger.info(f'Benchmarking {src}.')
+        results.extend(benchmark_document(src, kind, pool_sizes, optlevel, quality, encoding_list))
+
+    for result in results:
+        logger.info(
+            f"{describe_result(result)}: {result['seconds']:.2f}s, "
+            f"{result['pages_per_second']:.2f} pages/s, peak memory {human_readable_size(result['peak_rss'])}, "
+            f"output {human_readable_size(result['output_bytes'])}."
+        )
+
+    if baseline is not None:
+        with open(baseline) as file:
+            compare_results(results, json.load(file)['results'])
+
+    report = dict(
+        commit=get_commit(),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        cpu_count=os.cpu_count(),
+        pages=pages,
+        results=results,
+    )
+
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    logger.info(f'Results written to {output}.')
+
+
+if __name__ == '__main__':
+    benchmark()
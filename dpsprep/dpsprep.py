@@ -1,51 +1,208 @@
 from time import time
-from typing import Union
+from typing import Any, Literal, Union
+import contextlib
 import json
 import multiprocessing.pool
 import os.path
-import shutil
+import pathlib
+import queue
 
 import click
 import djvu.decode
 import pdfrw
 from loguru import logger
-
-from .images import djvu_page_to_image
+from PIL import Image
+
+from .images import (
+    ImageMode,
+    PageEncoding,
+    apply_page_encoding,
+    choose_page_encoding,
+    get_image_digest,
+    get_max_page_buffer_size,
+    get_page_buffer_size,
+    get_render_size,
+    image_from_buffer,
+    is_blank_page,
+    render_djvu_page,
+    render_page_job,
+)
 from .logging import configure_loguru, human_readable_size
-from .ocrmypdf import optimize_pdf, perform_ocr
-from .outline import OutlineTransformVisitor
-from .pdf import combine_pdfs_on_fs_with_text, combine_pdfs_on_fs_without_text, is_valid_pdf
+from .memory import ConcurrencyController
+from .metrics import Metrics
+from .ocrmypdf import is_ocrmypdf_available, optimize_page_pdf, perform_page_ocr
+from .outline import OutlineTransformVisitor, build_page_index
+from .pdf import (
+    combine_pdfs_on_fs_with_ocr,
+    combine_pdfs_on_fs_with_text,
+    combine_pdfs_on_fs_without_text,
+    is_valid_pdf,
+    write_blank_page_pdf,
+    write_indexed_image_pdf,
+)
+from .profiling import StackSampler, run_profiled, write_profile_report
+from .shared_pages import PageRing, get_slot_buffer, init_slot_worker
 from .text import djvu_pages_to_text_fpdf
 from .workdir import WorkingDirectory
 
 
-def process_page_bg(workdir: WorkingDirectory, quality: int, i: int):
+def is_page_processed(workdir: WorkingDirectory, i: int):
     page_number = i + 1
 
+    if workdir.get_duplicate_marker_path(i).exists():
+        logger.debug(f'Page {page_number} already found to be a duplicate.')
+        return True
+
     if workdir.get_page_pdf_path(i).exists():
         if is_valid_pdf(workdir.get_page_pdf_path(i)):
             logger.debug(f'Image data from page {page_number} already processed.')
-            return
+            return True
         else:
             logger.debug(f'Invalid page generated for {page_number}, regenerating.')
     else:
         logger.debug(f'Processing image data from page {page_number}.')
 
+    return False
+
+
+def encode_page(
+    workdir: WorkingDirectory,
+    quality: int,
+    i: int,
+    image: Image.Image,
+    page_size: tuple[int, int],
+    encoding: Literal['auto', 'native'],
+    optlevel: Union[int, None],
+    skip_blank: bool,
+    metrics: Metrics
+):
+    with metrics.stage('deduplicate'):
+        if skip_blank and is_blank_page(image):
+            logger.debug(f'Page {i + 1} is blank.')
+            workdir.get_blank_marker_path(i).touch()
+            write_blank_page_pdf(workdir.get_page_pdf_path(i), page_size)
+            return os.path.getsize(workdir.get_page_pdf_path(i))
+
+        # Exact rather than perceptual hashes, since merging pages that merely look alike would lose content
+        owner = workdir.claim_page_digest(i, get_image_digest(image))
+
+        if owner != i:
+            logger.debug(f'Page {i + 1} is a duplicate of page {owner + 1}.')
+            workdir.mark_duplicate(i, owner)
+            return 0
+
+    page_encoding: Union[PageEncoding, None] = None
+
+    # Optimized pages only appear at the page path once they are complete, so that interrupted runs never reuse unoptimized pages
+    encoded_path = workdir.get_page_pdf_path(i) if optlevel is None else workdir.get_unoptimized_page_pdf_path(i)
+
+    with metrics.stage('encode') as record:
+        if encoding == 'auto':
+            page_encoding = choose_page_encoding(image)
+            image = apply_page_encoding(image, page_encoding)
+
+        if image.mode == 'P':
+            write_indexed_image_pdf(image, encoded_path, page_size)
+        else:
+            image.save(
+                encoded_path,
+                format='PDF',
+                quality=quality,
+                # Keep the PDF page at the native size of the DjVu page even if the image has been downscaled
+                resolution=72 * image.width / page_size[0]
+            )
+
+        record.bytes_out = os.path.getsize(encoded_path)
+
+    if optlevel is not None:
+        with metrics.stage('optimize', bytes_in=record.bytes_out) as record:
+            optimize_page_pdf(workdir, i, optlevel, quality)
+            record.bytes_out = os.path.getsize(workdir.get_page_pdf_path(i))
+
+    if page_encoding is not None:
+        logger.debug(f'Encoding page {i + 1} as {page_encoding}.')
+
+    return record.bytes_out
+
+
+def process_page_bg(
+    workdir: WorkingDirectory,
+    quality: int,
+    i: int,
+    encoding: Literal['auto', 'native'] = 'native',
+    optlevel: Union[int, None] = None,
+    dpi: Union[int, None] = None,
+    max_size: Union[int, None] = None,
+    skip_blank: bool = False
+):
+    if is_page_processed(workdir, i):
+        return
+
     start_time = time()
+    metrics = Metrics()
     document = djvu.decode.Context().new_document(
         djvu.decode.FileURI(workdir.src)
     )
     document.decoding_job.wait()
 
-    image_pdf_raw = djvu_page_to_image(document.pages[i], i)
-    image_pdf_raw.save(
-        workdir.get_page_pdf_path(i),
-        format='PDF',
-        quality=quality
+    with metrics.stage('render'):
+        image_pdf_raw, page_size = render_djvu_page(document.pages[i], i, dpi, max_size)
+
+    size = encode_page(workdir, quality, i, image_pdf_raw, page_size, encoding, optlevel, skip_blank, metrics)
+
+    logger.debug(f'Image data with size {human_readable_size(size)} from page {i + 1} processed in {time() - start_time:.2f}s and written to working directory.')
+    return metrics.as_dict()
+
+
+def render_page_to_slot(
+    workdir: WorkingDirectory,
+    i: int,
+    slot: str,
+    dpi: Union[int, None] = None,
+    max_size: Union[int, None] = None
+):
+    """Render a page into a buffer of the page ring and return what `encode_page_from_slot` needs to read it back."""
+    if is_page_processed(workdir, i):
+        return
+
+    metrics = Metrics()
+    document = djvu.decode.Context().new_document(
+        djvu.decode.FileURI(workdir.src)
     )
+    document.decoding_job.wait()
+
+    with metrics.stage('render'):
+        page_job = document.pages[i].decode(wait=True)
+        size = get_render_size(page_job.size, page_job.dpi, dpi, max_size)
+
+        with get_slot_buffer(slot, get_page_buffer_size(size)) as buffer:
+            mode = render_page_job(page_job, i, size, buffer)
+
+    return dict(mode=mode, size=size, page_size=page_job.size, metrics=metrics.as_dict())
+
+
+def encode_page_from_slot(
+    workdir: WorkingDirectory,
+    quality: int,
+    i: int,
+    slot: str,
+    mode: ImageMode,
+    size: tuple[int, int],
+    page_size: tuple[int, int],
+    encoding: Literal['auto', 'native'] = 'native',
+    optlevel: Union[int, None] = None,
+    skip_blank: bool = False
+):
+    start_time = time()
+    metrics = Metrics()
+
+    with get_slot_buffer(slot, get_page_buffer_size(size)) as buffer:
+        image = image_from_buffer(mode, size, buffer)
+
+    pdf_size = encode_page(workdir, quality, i, image, page_size, encoding, optlevel, skip_blank, metrics)
 
-    pdf_size = os.path.getsize(workdir.get_page_pdf_path(i))
-    logger.debug(f'Image data with size {human_readable_size(pdf_size)} from page {page_number} processed in {time() - start_time:.2f}s and written to working directory.')
+    logger.debug(f'Image data with size {human_readable_size(pdf_size)} from page {i + 1} encoded in {time() - start_time:.2f}s and written to working directory.')
+    return metrics.as_dict()
 
 
 def process_text(workdir: WorkingDirectory):
@@ -56,16 +213,175 @@ def process_text(workdir: WorkingDirectory):
         logger.debug('Processing text data.')
 
     start_time = time()
+    metrics = Metrics()
     document = djvu.decode.Context().new_document(
         djvu.decode.FileURI(workdir.src)
     )
     document.decoding_job.wait()
 
-    fpdf = djvu_pages_to_text_fpdf(document.pages)
-    fpdf.output(workdir.text_layer_pdf_path)
+    with metrics.stage('text_layer') as record:
+        fpdf = djvu_pages_to_text_fpdf(document.pages)
+        fpdf.output(workdir.text_layer_pdf_path)
+        record.bytes_out = os.path.getsize(workdir.text_layer_pdf_path)
 
-    pdf_size = os.path.getsize(workdir.text_layer_pdf_path)
-    logger.info(f'Text data with size {human_readable_size(pdf_size) } processed in {time() - start_time:.2f}s and written to working directory')
+    logger.info(f'Text data with size {human_readable_size(record.bytes_out) } processed in {time() - start_time:.2f}s and written to working directory')
+    return metrics.as_dict()
+
+
+def process_page_ocr(workdir: WorkingDirectory, i: int, options: dict[str, Any]):
+    page_number = i + 1
+
+    # Duplicates reuse the OCR output of their original and blank pages have no text
+    if workdir.get_duplicate_marker_path(i).exists() or workdir.get_blank_marker_path(i).exists():
+        return
+
+    if workdir.get_ocr_page_pdf_path(i).exists():
+        if is_valid_pdf(workdir.get_ocr_page_pdf_path(i)):
+            logger.debug(f'OCR of page {page_number} already performed.')
+            return
+        else:
+            logger.debug(f'Invalid OCR output generated for {page_number}, regenerating.')
+    else:
+        logger.debug(f'Performing OCR on page {page_number}.')
+
+    metrics = Metrics()
+
+    with metrics.stage('ocr', bytes_in=os.path.getsize(workdir.get_page_pdf_path(i))) as record:
+        perform_page_ocr(workdir, i, options)
+        record.bytes_out = os.path.getsize(workdir.get_ocr_page_pdf_path(i))
+
+    return metrics.as_dict()
+
+
+def process_pages_pipelined(
+    workdir: WorkingDirectory,
+    page_count: int,
+    quality: int,
+    page_options: dict[str, Any],
+    with_text: bool,
+    pool_size: int,
+    metrics: Metrics,
+    ring: Union[PageRing, None] = None,
+    encode_pool_size: int = 0,
+    ocr_options: Union[dict[str, Any], None] = None,
+    ocr_pool_size: int = 0,
+    controller: Union[ConcurrencyController, None] = None,
+    profile_dir: Union[pathlib.Path, None] = None
+):
+    """Pass every page through a pool for each stage as soon as the previous stage is done with it.
+
+    If a page ring is given, pages are rendered into it by one pool and encoded by another.
+    If OCR options are given, a third pool performs OCR on the encoded pages.
+
+    At most `pool_size + 2 * (encode_pool_size + ocr_pool_size)` pages are in progress at any time,
+    so the earlier stages pause whenever the later ones fall behind.
+    If a controller is given, it also limits the number of pages being rendered according to the available memory.
+    If a profile directory is given, every task is sampled and the workers write their samples there.
+    """
+    # The pool callbacks run in a thread of the main process
+    events: queue.Queue = queue.Queue()
+    max_pages_in_flight = pool_size + 2 * (encode_pool_size + ocr_pool_size)
+    pages_in_flight = 0
+    pages_rendering = 0
+    next_page = 0
+    pages_remaining = page_count
+    text_pending = with_text
+    page_slots: dict[int, str] = {}
+
+    with contextlib.ExitStack() as stack:
+        # The workers attaching to the page ring detach from it when they exit
+        slot_initializer = init_slot_worker if ring is not None else None
+        render_pool = stack.enter_context(multiprocessing.Pool(processes=pool_size, initializer=slot_initializer))
+        encode_pool = stack.enter_context(multiprocessing.Pool(processes=encode_pool_size, initializer=slot_initializer)) if ring is not None else None
+        ocr_pool = stack.enter_context(multiprocessing.Pool(processes=ocr_pool_size)) if ocr_options is not None else None
+
+        def submit(pool: multiprocessing.pool.Pool, event: str, i: int, func, args: list[Any], kwds: Union[dict[str, Any], None] = None):
+            if profile_dir is not None:
+                func, args = run_profiled, [profile_dir, func, *args]
+
+            pool.apply_async(
+                func=func,
+                args=args,
+                kwds=kwds or {},
+                callback=lambda result: events.put((event, i, result)),
+                error_callback=lambda err: events.put(('failed', i, err))
+            )
+
+        if with_text:
+            submit(render_pool, 'text', -1, process_text, [workdir])
+
+        while pages_remaining > 0 or text_pending:
+            while (
+                next_page < page_count and
+                pages_in_flight < max_pages_in_flight and
+                (ring is None or ring.has_free_slot()) and
+                (controller is None or controller.can_dispatch(pages_rendering))
+            ):
+                if ring is None:
+                    submit(render_pool, 'encoded', next_page, process_page_bg, [workdir, quality, next_page], page_options)
+                else:
+                    page_slots[next_page] = ring.acquire()
+                    submit(
+                        render_pool, 'rendered', next_page, render_page_to_slot,
+                        [workdir, next_page, page_slots[next_page]],
+                        dict(dpi=page_options['dpi'], max_size=page_options['max_size'])
+                    )
+
+                next_page += 1
+                pages_in_flight += 1
+                pages_rendering += 1
+
+            try:
+                event, i, result = events.get(timeout=None if controller is None else controller.sample_interval)
+            except queue.Empty:
+                # Check again whether memory has been freed in the meantime
+                continue
+
+            if event == 'failed':
+                raise result
+
+            # The render pool reports pages as rendered if there is an encode pool and as encoded otherwise
+            if event == ('rendered' if ring is not None else 'encoded'):
+                pages_rendering -= 1
+
+            if event == 'text':
+                metrics.merge(result)
+                text_pending = False
+                continue
+
+            if event == 'rendered':
+                if result is not None:
+                    metrics.merge(result['metrics'])
+                    submit(
+                        encode_pool, 'encoded', i, encode_page_from_slot,  # type: ignore
+                        [workdir, quality, i, page_slots[i], result['mode'], result['size'], result['page_size']],
+                        dict(encoding=page_options['encoding'], optlevel=page_options['optlevel'], skip_blank=page_options['skip_blank'])
+                    )
+                    continue
+
+                # The page has already been processed in a previous run
+                event = 'encoded'
+
+            if event == 'encoded':
+                if i in page_slots:
+                    ring.release(page_slots.pop(i))  # type: ignore
+
+                metrics.merge(result)
+
+                if ocr_pool is not None:
+                    submit(ocr_pool, 'recognized', i, process_page_ocr, [workdir, i, ocr_options])
+                    continue
+            else:
+                metrics.merge(result)
+
+            pages_in_flight -= 1
+            pages_remaining -= 1
+
+        # Leaving the pools terminates their workers, which then skip their exit hooks
+        for pool in (render_pool, encode_pool, ocr_pool):
+            if pool is not None:
+                pool.close()
+                pool.join()
 
 
 @click.option('-d', '--delete-working', is_flag=True, help='Delete any existing files in the working directory prior to writing to it.')
@@ -77,7 +393,17 @@ def process_text(workdir: WorkingDirectory):
 @click.option('-O2', 'optlevel', flag_value=2, help='Use the PDF image optimization from OCRmyPDF.')
 @click.option('-O3', 'optlevel', flag_value=3, help='Use the aggressive lossy PDF image optimization from OCRmyPDF.')
 @click.option('-p', '--pool-size', type=click.IntRange(min=0), default=4, help='Size of MultiProcessing pool for handling page-by-page operations.')
+@click.option('--min-pool-size', type=click.IntRange(min=1), default=1, help='Render at least this many pages at once, even when memory runs low.')
+@click.option('--min-available-memory', type=click.IntRange(min=0), default=512, help='Render fewer pages at once, down to --min-pool-size, while less than this many MiB of memory are available. More are rendered again, up to --pool-size, once there is room. Only supported on Linux.')
 @click.option('-q', '--quality', type=click.IntRange(min=0, max=100), default=75, help="Quality of images in output. Used only for JPEG compression, i.e. RGB and Grayscale images. Passed directly to Pillow and to OCRmyPDF's optimizer.")
+@click.option('-b', '--skip-blank', is_flag=True, help='Emit blank pages without an image. A page is considered blank if at most one in 100000 of its pixels is dark.')
+@click.option('--dpi', type=click.IntRange(min=1), default=None, help='Downscale pages whose resolution is higher than this. The page dimensions, text layer and outline are not affected.')
+@click.option('--max-size', type=click.IntRange(min=1), default=None, help='Downscale pages whose width or height in pixels is larger than this. The page dimensions, text layer and outline are not affected.')
+@click.option('-e', '--encoding', type=click.Choice(['auto', 'native']), default='native', help='How to encode page images. With "native" (the default), pages are encoded as bilevel or RGB, depending on how DjVuLibre renders them. With "auto", every page is analyzed: pages consisting only of black and white or of at most 16 colors are encoded losslessly as bilevel or palette images, pages without colored pixels as grayscale JPEG, and all others as RGB JPEG.')
+@click.option('--metrics', 'metrics_path', type=click.Path(dir_okay=False, resolve_path=True), help='Write per-stage timings, byte counts and peak memory of every worker to this file. The report is a Prometheus textfile if the name ends with .prom and JSON otherwise.')
+@click.option('--encode-pool-size', type=click.IntRange(min=1), default=None, help='Encode pages in a separate MultiProcessing pool of this size. Rendered pixels are passed to it via shared memory rather than being pickled, and Pillow copies them once when the encoder builds the image. By default, every worker both renders and encodes its pages.')
+@click.option('--ocr-pool-size', type=click.IntRange(min=1), default=None, help='Size of the MultiProcessing pool performing OCR on rendered pages. Defaults to the value of --pool-size.')
+@click.option('--profile', type=click.Path(file_okay=False, resolve_path=True), help='Sample the stacks of the main process and of every worker while they process pages, and write them to this directory as flamegraph-compatible collapsed stacks (profile.collapsed) along with a table of the functions found in the most samples (profile.txt).')
 @click.option('--ocr', type=str, is_flag=False, flag_value='{}', help='Perform OCR via OCRmyPDF rather than trying to convert the text layer. If this parameter has a value, it should be a JSON dictionary of options to be passed to OCRmyPDF.')
 @click.argument('dest', type=click.Path(exists=False, resolve_path=True), required=False)
 @click.argument('src', type=click.Path(exists=True, resolve_path=True), required=True)
@@ -94,6 +420,16 @@ def dpsprep(
     no_text: bool,
     optlevel: Union[int, None],
     ocr: Union[str, None],
+    metrics_path: Union[str, None],
+    encoding: Literal['auto', 'native'],
+    ocr_pool_size: Union[int, None],
+    dpi: Union[int, None],
+    max_size: Union[int, None],
+    encode_pool_size: Union[int, None],
+    skip_blank: bool,
+    min_pool_size: int,
+    min_available_memory: int,
+    profile: Union[str, None],
 ):
     configure_loguru(verbose)
     workdir = WorkingDirectory(src, dest)
@@ -111,10 +447,32 @@ def dpsprep(
 
         no_text = True
 
+    if optlevel is not None and not is_ocrmypdf_available():
+        logger.warning('Cannot detect OCRmyPDF. No optimizations will be performed on the page images.')
+        optlevel = None
+
+    if ocr_options is not None and not is_ocrmypdf_available():
+        logger.warning('Cannot detect OCRmyPDF. No OCR will be performed on the output file.')
+        ocr_options = None
+
     if not overwrite and workdir.dest.exists():
         raise SystemExit(f'File {workdir.dest} already exists.')
 
     start_time = time()
+    metrics = Metrics()
+
+    if profile is None:
+        profile_dir = None
+    else:
+        profile_dir = pathlib.Path(profile) / 'workers'
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+        for path in profile_dir.glob('*.json'):
+            path.unlink()
+
+        # Workers are forked before they start their own sampler, so this one only samples the main process
+        main_sampler = StackSampler()
+        main_sampler.active = True
 
     if workdir.workdir.exists():
         if delete_working:
@@ -136,76 +494,93 @@ def dpsprep(
     djvu_size = os.path.getsize(workdir.src)
     logger.info(f'Processing {workdir.src} with {len(document.pages)} pages and size {human_readable_size(djvu_size)} using {pool_size} workers.')
 
-    pool = multiprocessing.Pool(processes=pool_size)
-    tasks: list[multiprocessing.pool.AsyncResult] = []
-
-    if not no_text:
-        tasks.append(pool.apply_async(func=process_text, args=[workdir]))
-
-    for i in range(len(document.pages)):
-        # Cannot pass the page object itself because it does not support serialization for IPC
-        tasks.append(pool.apply_async(func=process_page_bg, args=[workdir, quality, i]))
-
-    pool.close()
-    pool_is_working = True
-
-    while pool_is_working:
-        pool_is_working = False
-
-        for task in tasks:
-            try:
-                task.get(timeout=25)
-            except multiprocessing.TimeoutError:
-                pool_is_working = True
+    if optlevel is not None:
+        logger.info(f'Every page will be optimized at level {optlevel} as soon as it is rendered.')
+
+    page_options = dict(encoding=encoding, optlevel=optlevel, dpi=dpi, max_size=max_size, skip_blank=skip_blank)
+
+    if dpi is not None or max_size is not None:
+        logger.info('Pages will be downscaled by libdjvu while rendering.')
+
+    if workdir.update_render_settings(dict(dpi=dpi, max_size=max_size)):
+        logger.info('Pages in the working directory were rendered with different settings and will be rendered again.')
+
+    ring = None
+
+    if encode_pool_size is not None:
+        slot_size = get_max_page_buffer_size(document, dpi, max_size)
+        ring = PageRing(slot_count=pool_size + 2 * encode_pool_size, slot_size=slot_size)
+        logger.info(f'Encoding pages using {encode_pool_size} workers and {len(ring.slots)} shared buffers with size {human_readable_size(slot_size)}.')
+
+    if ocr_options is not None:
+        logger.info(f'Performing OCR on every page as soon as it is rendered using {ocr_pool_size or pool_size} workers.')
+
+    # Pages are dispatched one at a time, so that fewer are rendered at once when memory runs low
+    controller = ConcurrencyController(min_pool_size, pool_size, min_available_memory * 2 ** 20)
+
+    try:
+        process_pages_pipelined(
+            workdir,
+            len(document.pages),
+            quality,
+            page_options,
+            with_text=not no_text,
+            pool_size=pool_size,
+            metrics=metrics,
+            ring=ring,
+            encode_pool_size=encode_pool_size or 0,
+            ocr_options=ocr_options,
+            ocr_pool_size=(ocr_pool_size or pool_size) if ocr_options is not None else 0,
+            controller=controller,
+            profile_dir=profile_dir
+        )
+    finally:
+        if ring is not None:
+            ring.destroy()
 
-    pool.join()
     logger.info('Processed all pages.')
 
     outline = pdfrw.IndirectPdfDict()
 
     if len(document.outline.sexpr) > 0:
         logger.info('Processing metadata.')
-        outline = OutlineTransformVisitor().visit(document.outline.sexpr)
+        outline = OutlineTransformVisitor(page_index=build_page_index(document)).visit(document.outline.sexpr)
         logger.info('Metadata processed.')
     else:
         logger.info('No metadata to process.')
 
     logger.info('Combining everything.')
 
-    if no_text:
-        combine_pdfs_on_fs_without_text(workdir, outline, len(document.pages))
-
-        if ocr_options is None:
-            logger.info('Skipping the text layer.')
-            shutil.copy(workdir.combined_pdf_without_text_path, workdir.combined_pdf_path)
-        else:
-            logger.info('Performing OCR.')
-            perform_ocr(workdir, ocr_options)
-    else:
-        combine_pdfs_on_fs_with_text(workdir, outline)
-
-    combined_size = os.path.getsize(workdir.combined_pdf_path)
-    logger.info(f'Produced a combined output file with size {human_readable_size(combined_size)} in {time() - start_time:.2f}s. This is {round(100 * combined_size / djvu_size, 2)}% of the DjVu source file.')
-
-    opt_success = False
-
-    if optlevel is not None:
-        logger.info(f'Performing level {optlevel} optimization.')
-        opt_success = optimize_pdf(workdir, optlevel, quality, pool_size)
-
-    if opt_success:
-        opt_size = os.path.getsize(workdir.optimized_pdf_path)
-
-        logger.info(f'The optimized file has size {human_readable_size(opt_size)}, which is {round(100 * opt_size / combined_size, 2)}% of the raw combined file and {round(100 * opt_size / djvu_size, 2)}% of the DjVu source file.')
-
-        if opt_size < combined_size:
-            logger.info('Using the optimized file.')
-            shutil.copy(workdir.optimized_pdf_path, workdir.dest)
-        else:
-            logger.info('Using the raw combined file.')
-            shutil.copy(workdir.combined_pdf_path, workdir.dest)
-    else:
-        shutil.copy(workdir.combined_pdf_path, workdir.dest)
+    # The output is assembled next to the destination and then renamed, so the destination never contains a partial file
+    try:
+        with metrics.stage('combine') as record:
+            if ocr_options is not None:
+                combine_pdfs_on_fs_with_ocr(workdir, outline, len(document.pages), workdir.partial_dest_path)
+            elif no_text:
+                logger.info('Skipping the text layer.')
+                combine_pdfs_on_fs_without_text(workdir, outline, len(document.pages), workdir.partial_dest_path)
+            else:
+                combine_pdfs_on_fs_with_text(workdir, outline, workdir.partial_dest_path)
+
+            record.bytes_out = os.path.getsize(workdir.partial_dest_path)
+
+        workdir.publish()
+    finally:
+        # Only left behind if combining or publishing failed
+        workdir.discard_partial()
+
+    combined_size = record.bytes_out
+    logger.info(f'Produced the output file {workdir.dest} with size {human_readable_size(combined_size)} in {time() - start_time:.2f}s. This is {round(100 * combined_size / djvu_size, 2)}% of the DjVu source file.')
+
+    if metrics_path is not None:
+        metrics.export(metrics_path, run_seconds=time() - start_time)
+        logger.info(f'Metrics written to {metrics_path}.')
+
+    if profile_dir is not None:
+        main_sampler.active = False
+        main_sampler.dump(profile_dir / f'{os.getpid()}.json')
+        write_profile_report(profile_dir, profile_dir.parent / 'profile.collapsed', profile_dir.parent / 'profile.txt')
+        logger.info(f'Profile written to {profile_dir.parent}.')
 
     if preserve_working:
         logger.info(f'Working directory {workdir.workdir} will be preserved.')
@@ -1,13 +1,15 @@
-from typing import Literal
+from typing import Literal, Union
+import hashlib
 
 from loguru import logger
-from PIL import Image, ImageOps
+from PIL import Image, ImageChops, ImageOps
 import PIL.features
 import djvu.decode
 import djvu.sexpr
 
 
 ImageMode = Literal['rgb', 'bitonal']
+PageEncoding = Literal['bilevel', 'grayscale', 'palette', 'jpeg']
 
 
 djvu_pixel_formats = {
@@ -27,13 +29,48 @@ pil_modes = {
 }
 
 
-def djvu_page_to_image(page: djvu.decode.Page, i: int) -> Image.Image:
-    page_job = page.decode(wait=True)
-    width, height = page_job.size
-    buffer = bytearray(3 * width * height) # RGB at most
+def get_render_size(
+    native_size: tuple[int, int],
+    native_dpi: int,
+    dpi: Union[int, None],
+    max_size: Union[int, None]
+) -> tuple[int, int]:
+    """Determine the size to which a page should be shrunk to fit the target resolution and size. Pages are never enlarged."""
+    scale = 1.0
+
+    if dpi is not None and native_dpi > 0:
+        scale = min(scale, dpi / native_dpi)
+
+    if max_size is not None:
+        scale = min(scale, max_size / max(native_size))
+
+    native_width, native_height = native_size
+    return max(1, round(native_width * scale)), max(1, round(native_height * scale))
+
+
+def get_page_buffer_size(size: tuple[int, int]):
+    width, height = size
+    return 3 * width * height # RGB at most
+
 
+def get_max_page_buffer_size(document: djvu.decode.Document, dpi: Union[int, None], max_size: Union[int, None]):
+    """Determine a buffer size sufficient for rendering any page of the document. Only the page headers are decoded."""
+    buffer_size = 0
+
+    for page in document.pages:
+        page.get_info(wait=True)
+        buffer_size = max(buffer_size, get_page_buffer_size(get_render_size(page.size, page.dpi, dpi, max_size)))
+
+    return buffer_size
+
+
+def render_page_job(page_job: djvu.decode.PageJob, i: int, size: tuple[int, int], buffer) -> ImageMode:
+    """Render a decoded page with the given size into a writable buffer of at least `get_page_buffer_size(size)` bytes."""
+    width, height = size
+
+    # libdjvu scales the page to page_rect and then renders the part of it within render_rect
     rect = (0, 0, width, height)
-    mode = 'bitonal' if page_job.type == djvu.decode.PAGE_TYPE_BITONAL else 'rgb'
+    mode: ImageMode = 'bitonal' if page_job.type == djvu.decode.PAGE_TYPE_BITONAL else 'rgb'
 
     if mode == 'bitonal':
         if not PIL.features.check_codec('libtiff'):
@@ -53,15 +90,23 @@ def djvu_page_to_image(page: djvu.decode.Page, i: int) -> Image.Image:
         )
     except djvu.decode.NotAvailable:
         logger.warning(f'libdjvu claims that data for page {i + 1} is not available. Producing a blank page.')
-        return Image.new(
-            pil_modes['bitonal'],
-            page_job.size,
-            1
-        )
 
+        # Unset bits become white after the inversion in image_from_buffer
+        packed_size = (width + 7) // 8 * height
+        buffer[:packed_size] = bytes(packed_size)
+        return 'bitonal'
+
+    return mode
+
+
+def image_from_buffer(mode: ImageMode, size: tuple[int, int], buffer) -> Image.Image:
+    """Build an image from pixels rendered by `render_page_job`.
+
+    Pillow copies the pixels for both modes we use, so the buffer may be reused once this returns.
+    """
     image = Image.frombuffer(
         pil_modes[mode],
-        page_job.size,
+        size,
         buffer,
         'raw'
     )
@@ -69,3 +114,146 @@ def djvu_page_to_image(page: djvu.decode.Page, i: int) -> Image.Image:
     # I have experimentally determined that we need to invert the black-and-white images. -- Ianis, 2023-05-13
     # See also https://github.com/kcroker/dpsprep/issues/16
     return ImageOps.invert(image) if mode == 'bitonal' else image
+
+
+def render_djvu_page(
+    page: djvu.decode.Page,
+    i: int,
+    dpi: Union[int, None] = None,
+    max_size: Union[int, None] = None
+) -> tuple[Image.Image, tuple[int, int]]:
+    """Render a page, possibly downscaled by libdjvu itself, and return the image along with the native page size.
+
+    The native size should be used as the size of the PDF page, so that the geometry of the text layer is unaffected by scaling.
+    """
+    page_job = page.decode(wait=True)
+    size = get_render_size(page_job.size, page_job.dpi, dpi, max_size)
+    buffer = bytearray(get_page_buffer_size(size))
+    mode = render_page_job(page_job, i, size, buffer)
+    return image_from_buffer(mode, size, buffer), page_job.size
+
+
+def djvu_page_to_image(page: djvu.decode.Page, i: int) -> Image.Image:
+    image, _ = render_djvu_page(page, i)
+    return image
+
+
+# Content analysis first runs on a copy whose longest side is at most this many pixels.
+# Nearest-neighbor sampling keeps the pixel values intact, so any level or color in the copy also
+# occurs in the page. The copy can thus rule encodings out cheaply, but only the page itself can
+# confirm them.
+ANALYSIS_SIZE = 512
+
+# A pixel counts as colored if two of its channels differ by at least this much.
+CHROMA_THRESHOLD = 24
+
+PALETTE_MAX_COLORS = 16
+
+
+def downsample_for_analysis(image: Image.Image) -> Image.Image:
+    scale = ANALYSIS_SIZE / max(image.size)
+
+    if scale >= 1:
+        return image
+
+    return image.resize(
+        (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+        Image.Resampling.NEAREST
+    )
+
+
+def has_colored_pixels(image: Image.Image):
+    r, g, b = image.split()
+    chroma = ImageChops.lighter(
+        ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b)),
+        ImageChops.difference(r, b)
+    )
+    return sum(chroma.histogram()[CHROMA_THRESHOLD:]) > 0
+
+
+def has_few_colors(image: Image.Image, sample: Image.Image, max_colors: int):
+    return sample.getcolors(max_colors) is not None and image.getcolors(max_colors) is not None
+
+
+def choose_page_encoding(image: Image.Image) -> PageEncoding:
+    """Choose how to encode a rendered page based on its pixels.
+
+    libdjvu only tells us whether a page is bitonal. Many pages that it renders as RGB are
+    actually grayscale or have very few colors. Those are encoded losslessly as bilevel or
+    palette images if the whole page consists of two levels or few colors, and as grayscale
+    JPEG if no pixel of the page is colored. Everything else is encoded as RGB JPEG, as with
+    the native encoding, so that no figure or anti-aliasing is lost.
+    """
+    if image.mode == '1':
+        return 'bilevel'
+
+    sample = downsample_for_analysis(image)
+
+    if image.mode == 'RGB':
+        if has_colored_pixels(sample) or has_colored_pixels(image):
+            return 'palette' if has_few_colors(image, sample, PALETTE_MAX_COLORS) else 'jpeg'
+
+        image = image.convert('L')
+        sample = sample.convert('L')
+
+    levels = image.getcolors(2) if sample.getcolors(2) is not None else None
+
+    # Only black and white are lossless as bilevel; other pairs of levels are kept in a palette
+    if levels is not None and {level for _, level in levels} <= {0, 255}:
+        return 'bilevel'
+
+    if has_few_colors(image, sample, PALETTE_MAX_COLORS):
+        return 'palette'
+
+    return 'grayscale'
+
+
+def apply_page_encoding(image: Image.Image, encoding: PageEncoding) -> Image.Image:
+    """Convert the image into the mode in which it should be written.
+
+    Pillow compresses mode '1' using CCITT group 4 (if it has libtiff) and modes 'L' and 'RGB' using JPEG.
+    Mode 'P' images should be written using `write_indexed_image_pdf`.
+    Bilevel and palette encodings are lossless for the pages for which `choose_page_encoding` picks them.
+    """
+    if encoding == 'bilevel':
+        if image.mode == '1':
+            return image
+
+        return image.convert('L').point(lambda value: 255 if value >= 128 else 0, mode='1')
+
+    if encoding == 'grayscale':
+        return image.convert('L')
+
+    if encoding == 'palette':
+        # Taken from the whole page, so that every color of the page is in the palette
+        colors = image.getcolors(PALETTE_MAX_COLORS)
+        palette_image = Image.new('P', (1, 1))
+        palette: list[int] = []
+
+        for _, color in colors or []:
+            palette.extend(color if isinstance(color, tuple) else (color, color, color))
+
+        palette_image.putpalette(palette)
+        source = image if image.mode in ('L', 'RGB') else image.convert('RGB')
+        return source.quantize(palette=palette_image, dither=Image.Dither.NONE)
+
+    return image.convert('RGB')
+
+
+# A page is blank if no more than this fraction of its pixels is darker than BLANK_DARK.
+# This allows for some dust on scans, but a lone page number is still considered content.
+BLANK_DARK = 128
+BLANK_PIXEL_FRACTION = 1e-5
+
+
+def is_blank_page(image: Image.Image):
+    # The full-resolution histogram is cheap, and downsampling could hide small marks
+    histogram = image.convert('L').histogram() if image.mode not in ('1', 'L') else image.histogram()
+    return sum(histogram[:BLANK_DARK]) <= BLANK_PIXEL_FRACTION * image.width * image.height
+
+
+def get_image_digest(image: Image.Image):
+    """Hash the exact pixels of an image. Pages with the same digest can share a single encoded image."""
+    h = hashlib.sha1(f'{image.mode} {image.width}x{image.height}'.encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
@@ -0,0 +1,105 @@
+from time import monotonic
+from typing import Union
+import os
+
+from loguru import logger
+
+
+def get_available_memory() -> Union[int, None]:
+    """The memory available for new allocations without swapping, in bytes. None if the system does not report it."""
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def get_process_rss(pid: int) -> int:
+    """The resident set size of a process in bytes, or 0 if it has exited."""
+    try:
+        with open(f'/proc/{pid}/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def get_child_pids(parent: Union[int, None] = None) -> list[int]:
+    parent = os.getpid() if parent is None else parent
+    children = []
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                # The command name is enclosed in parentheses and may itself contain spaces
+                fields = file.read().rsplit(')', maxsplit=1)[1].split()
+        except (OSError, IndexError):
+            continue
+
+        if int(fields[1]) == parent:
+            children.append(int(entry))
+
+    return children
+
+
+class ConcurrencyController:
+    """Adapt the number of tasks running at once to the memory left on the system.
+
+    The limit starts at max_workers. Whenever less than min_available bytes are available, it is lowered,
+    and halved if less than half of that is available. It is raised again once there is room for another
+    task as large as the largest worker. The pools keep max_workers processes; the limit only holds back dispatch.
+    On systems without /proc, the limit stays at max_workers.
+    """
+
+    min_workers: int
+    max_workers: int
+    min_available: int
+    sample_interval: float
+    limit: int
+    last_sample: float
+
+    def __init__(self, min_workers: int, max_workers: int, min_available: int, sample_interval: float = 1):
+        self.min_workers = max(1, min(min_workers, max_workers))
+        self.max_workers = max_workers
+        self.min_available = min_available
+        self.sample_interval = sample_interval
+        self.limit = max_workers
+        self.last_sample = -sample_interval
+
+    def update(self, available: int, worker_rss: list[int]):
+        previous_limit = self.limit
+        largest_worker = max(worker_rss, default=0)
+
+        if available < self.min_available / 2:
+            self.limit = max(self.min_workers, self.limit // 2)
+        elif available < self.min_available:
+            self.limit = max(self.min_workers, self.limit - 1)
+        elif available - self.min_available > largest_worker:
+            self.limit = min(self.max_workers, self.limit + 1)
+
+        if self.limit < previous_limit:
+            logger.info(f'Only {available // 2 ** 20}MiB of memory available. Running at most {self.limit} tasks at once.')
+        elif self.limit > previous_limit:
+            logger.debug(f'{available // 2 ** 20}MiB of memory available. Running at most {self.limit} tasks at once.')
+
+    def sample(self):
+        now = monotonic()
+
+        if now - self.last_sample < self.sample_interval:
+            return
+
+        self.last_sample = now
+        available = get_available_memory()
+
+        if available is not None:
+            self.update(available, [get_process_rss(pid) for pid in get_child_pids()])
+
+    def can_dispatch(self, tasks_in_flight: int) -> bool:
+        self.sample()
+        return tasks_in_flight < self.limit
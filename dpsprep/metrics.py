@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Iterator, Union
+import json
+import math
+import os
+import resource
+import sys
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def get_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(samples: list[float], p: int):
+    ordered = sorted(samples)
+    index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+class StageRecord:
+    bytes_in: int
+    bytes_out: int
+
+    def __init__(self, bytes_in: int = 0):
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+
+
+class Metrics:
+    """Per-stage durations and byte counts.
+
+    Every worker task builds its own instance and returns `as_dict()`, which is picklable.
+    The main process merges these snapshots and exports a single report per run.
+    """
+
+    stages: dict[str, dict[str, Any]]
+    workers: dict[str, int]
+
+    def __init__(self):
+        self.stages = {}
+        self.workers = {}
+
+    def record(self, name: str, seconds: float, bytes_in: int = 0, bytes_out: int = 0):
+        stage = self.stages.setdefault(name, dict(samples=[], bytes_in=0, bytes_out=0))
+        stage['samples'].append(seconds)
+        stage['bytes_in'] += bytes_in
+        stage['bytes_out'] += bytes_out
+
+    @contextmanager
+    def stage(self, name: str, bytes_in: int = 0) -> Iterator[StageRecord]:
+        record = StageRecord(bytes_in)
+        start_time = perf_counter()
+
+        try:
+            yield record
+        finally:
+            self.record(name, perf_counter() - start_time, record.bytes_in, record.bytes_out)
+
+    def as_dict(self):
+        return dict(
+            stages=self.stages,
+            workers={**self.workers, str(os.getpid()): get_peak_rss()}
+        )
+
+    def merge(self, snapshot: Union[dict[str, Any], None]):
+        if snapshot is None:
+            return
+
+        for name, other in snapshot['stages'].items():
+            stage = self.stages.setdefault(name, dict(samples=[], bytes_in=0, bytes_out=0))
+            stage['samples'].extend(other['samples'])
+            stage['bytes_in'] += other['bytes_in']
+            stage['bytes_out'] += other['bytes_out']
+
+        for pid, peak_rss in snapshot['workers'].items():
+            self.workers[pid] = max(peak_rss, self.workers.get(pid, 0))
+
+    def summary(self, run_seconds: float):
+        stages = {}
+
+        for name, stage in self.stages.items():
+            samples = stage['samples']
+            stages[name] = dict(
+                count=len(samples),
+                seconds=sum(samples),
+                max_seconds=max(samples),
+                bytes_in=stage['bytes_in'],
+                bytes_out=stage['bytes_out'],
+                **{f'p{p}_seconds': percentile(samples, p) for p in PERCENTILES}
+            )
+
+        return dict(
+            run_seconds=run_seconds,
+            stages=stages,
+            workers={**self.workers, str(os.getpid()): get_peak_rss()}
+        )
+
+    def to_prometheus(self, run_seconds: float, prefix: str = 'dpsprep'):
+        summary = self.summary(run_seconds)
+        lines = [
+            f'# HELP {prefix}_run_seconds Wall-clock duration of the run.',
+            f'# TYPE {prefix}_run_seconds gauge',
+            f'{prefix}_run_seconds {summary["run_seconds"]:.6f}',
+        ]
+
+        stage_metrics = [
+            ('stage_seconds_total', 'seconds', 'Time spent in each stage, summed over workers.'),
+            ('stage_calls_total', 'count', 'Number of times each stage ran.'),
+            ('stage_bytes_in_total', 'bytes_in', 'Bytes read by each stage.'),
+            ('stage_bytes_out_total', 'bytes_out', 'Bytes written by each stage.'),
+        ]
+
+        for metric, key, help_text in stage_metrics:
+            lines.append(f'# HELP {prefix}_{metric} {help_text}')
+            lines.append(f'# TYPE {prefix}_{metric} counter')
+            lines.extend(f'{prefix}_{metric}{{stage="{name}"}} {stage[key]}' for name, stage in summary['stages'].items())
+
+        lines.append(f'# HELP {prefix}_worker_peak_rss_bytes Peak resident set size of each process.')
+        lines.append(f'# TYPE {prefix}_worker_peak_rss_bytes gauge')
+        lines.extend(f'{prefix}_worker_peak_rss_bytes{{pid="{pid}"}} {rss}' for pid, rss in summary['workers'].items())
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: Union[os.PathLike, str], run_seconds: float):
+        """Write a JSON report, or a Prometheus textfile if the path ends with .prom."""
+        path = Path(path)
+
+        if path.suffix == '.prom':
+            content = self.to_prometheus(run_seconds)
+        else:
+            content = json.dumps(self.summary(run_seconds), indent=4)
+
+        # The Prometheus textfile collector may read the file at any time, so never expose a partial one
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        tmp_path.write_text(content)
+        os.replace(tmp_path, path)
@@ -1,4 +1,5 @@
 from typing import Any
+import os
 import shutil
 
 from loguru import logger
@@ -41,54 +42,108 @@ class OptimizeOptions:
         self.progress_bar = False
 
 
-def optimize_pdf(workdir: WorkingDirectory, optlevel: int, quality: int, pool_size: int):
+def is_ocrmypdf_available():
+    try:
+        import ocrmypdf.optimize  # noqa: F401
+    except ImportError:
+        return False
+    else:
+        return True
+
+
+def optimize_page_pdf(workdir: WorkingDirectory, i: int, optlevel: int, quality: int):
+    """Optimize the unoptimized PDF of a single page and move the smaller of the two files to the page path.
+
+    This runs inside the page workers, so every page is only decoded and encoded once more while it is still hot,
+    rather than in a second pass over the whole combined file.
+    """
+    src = workdir.get_unoptimized_page_pdf_path(i)
+    dest = workdir.get_page_pdf_path(i)
+
     try:
         # ObjectStreamMode is actually from pikepdf, but I did not want to include that as a dependency
         from ocrmypdf.optimize import ObjectStreamMode, PdfContext, optimize
     except ImportError:
-        logger.warning('Cannot detect OCRmyPDF. No optimizations will be performed on the output file.')
-        shutil.copy(workdir.combined_pdf_path, workdir.optimized_pdf_path)
+        os.replace(src, dest)
         return False
 
+    tmp_path = workdir.get_page_ocrmypdf_tmp_path(i)
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    optimized_path = tmp_path / 'optimized.pdf'
+
     options = OptimizeOptions(
-        input_file=workdir.combined_pdf_path,
-        jobs=pool_size,  # These correspond to CPU cores rather than threads, but it seems better to use the available pool size parameter
+        input_file=src,
+        jobs=1,  # The pages themselves are already distributed among the pool workers
         optimize_=optlevel,
         jpeg_quality=quality,
         png_quality=quality
     )
 
-    context = PdfContext(options, workdir.ocrmypdf_tmp_path, workdir.combined_pdf_path, None, None) # type: ignore
-
-    optimize(
-        workdir.combined_pdf_path,
-        workdir.optimized_pdf_path,
-        context,
-        dict(
-            compress_streams=True,
-            preserve_pdfa=True,
-            object_stream_mode=ObjectStreamMode.generate,
-        ),
-    )
+    context = PdfContext(options, tmp_path, src, None, None) # type: ignore
+
+    try:
+        optimize(
+            src,
+            optimized_path,
+            context,
+            dict(
+                compress_streams=True,
+                preserve_pdfa=True,
+                # pdfrw cannot read object streams, and the pages are combined using pdfrw
+                object_stream_mode=ObjectStreamMode.disable,
+            ),
+        )
+    except Exception as err:
+        logger.warning(f'OCRmyPDF failed to optimize page {i + 1}: {err}')
+        os.replace(src, dest)
+        return False
+    else:
+        if os.path.getsize(optimized_path) < os.path.getsize(src):
+            os.replace(optimized_path, dest)
+            src.unlink()
+        else:
+            os.replace(src, dest)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
 
     return True
 
 
-def perform_ocr(workdir: WorkingDirectory, options: dict[str, Any]):
+def perform_page_ocr(workdir: WorkingDirectory, i: int, options: dict[str, Any]):
+    src = workdir.get_page_pdf_path(i)
+    dest = workdir.get_ocr_page_pdf_path(i)
+    raw_path = workdir.ocrmypdf_tmp_path / f'page_{i + 1}_ocr.pdf'
+
     try:
+        # pikepdf is a dependency of OCRmyPDF
         from ocrmypdf import api
+        import pikepdf
     except ImportError:
-        logger.warning('Cannot detect OCRmyPDF. No OCR will be performed on the output file.')
-        shutil.copy(workdir.combined_pdf_without_text_path, workdir.combined_pdf_path)
+        shutil.copy(src, dest)
         return False
 
     try:
         api.ocr(
-            input_file=workdir.combined_pdf_without_text_path,
-            output_file=workdir.combined_pdf_path,
-            **options
+            **{
+                'output_type': 'pdf',  # PDF/A conversion is pointless for a single page that is about to be merged
+                'progress_bar': False,
+                'jobs': 1,
+                **options,
+                # The pool workers are daemonic processes, which cannot start child processes
+                'use_threads': True,
+                'input_file': src,
+                'output_file': raw_path,
+            }
         )
+
+        # pdfrw cannot read object streams, and the pages are combined using pdfrw
+        with pikepdf.open(raw_path) as pdf:
+            pdf.save(dest, object_stream_mode=pikepdf.ObjectStreamMode.disable)
     except Exception as err:
-        logger.warning(f'OCRmyPDF failed: {err}')
-        shutil.copy(workdir.combined_pdf_without_text_path, workdir.combined_pdf_path)
+        logger.warning(f'OCRmyPDF failed on page {i + 1}: {err}')
+        shutil.copy(src, dest)
         return False
+    finally:
+        raw_path.unlink(missing_ok=True)
+
+    return True
@@ -1,20 +1,57 @@
+from typing import Union
+
 from loguru import logger
 from pdfrw import PdfName, PdfDict, IndirectPdfDict
+import djvu.decode
 import djvu.sexpr
 
 from .sexpr import SExpressionVisitor
 
 
+def build_page_index(document: djvu.decode.Document) -> dict[str, int]:
+    """Map the identifiers, names and titles of the component files of a document to page indices.
+
+    Outline entries may refer to pages by any of these rather than by page number.
+    """
+    page_index: dict[str, int] = {}
+
+    for file in document.files:
+        file.get_info(wait=True)
+
+        if file.type != djvu.decode.FILE_TYPE_PAGE:
+            continue
+
+        # Identifiers take precedence over names and titles
+        for key in (file.title, file.name, file.id):
+            if key:
+                page_index[key] = file.n_page
+
+    return page_index
+
+
 # Based on
 # https://github.com/pmaupin/pdfrw/issues/52#issuecomment-271190546
 class OutlineTransformVisitor(SExpressionVisitor):
-    def visit_plain_list(self, node: djvu.sexpr.StringExpression, parent: IndirectPdfDict):
-        title, page, *rest = node
+    page_index: dict[str, int]
+
+    def __init__(self, page_index: Union[dict[str, int], None] = None):
+        self.page_index = page_index or {}
+
+    def get_page_number(self, target: str) -> Union[int, None]:
+        key = target[1:] if target.startswith('#') else target
+
         # I have experimentally determined that we need to translate page indices. -- Ianis, 2023-05-03
         try:
-            page_number = int(page.value[1:]) - 1
+            return int(key) - 1
         except ValueError:
-            # As far as I understand, python-djvulibre doesn't support Djvu's page titles. -- Ianis, 2023-12-09
+            return self.page_index.get(key)
+
+    def visit_plain_list(self, node: djvu.sexpr.ListExpression, parent: IndirectPdfDict):
+        title, page, *rest = node
+        page_number = self.get_page_number(page.value)
+
+        if page_number is None:
+            # python-djvulibre doesn't support DjVu's page titles, so we can only resolve them via the page index
             logger.warning(f'Could not determine page number from the page title {page.value}.')
             return
 
@@ -37,9 +74,6 @@ class OutlineTransformVisitor(SExpressionVisitor):
         parent.Count += 1
         parent.Last = bookmark
 
-        for child in rest:
-            self.visit(child, parent=bookmark)
-
         return bookmark
 
     def visit_list_bookmarks(self, node: djvu.sexpr.ListExpression):
@@ -47,7 +81,16 @@ class OutlineTransformVisitor(SExpressionVisitor):
 
         outline = IndirectPdfDict()
 
-        for child in rest:
-            self.visit(child, parent=outline)
+        # Outlines can be nested arbitrarily deep, so we use an explicit stack rather than recursion.
+        # Children are pushed in reverse so that siblings are still attached in order.
+        stack = [(child, outline) for child in reversed(rest)]
+
+        while len(stack) > 0:
+            child, parent = stack.pop()
+            bookmark = self.visit(child, parent=parent)
+
+            if bookmark is not None:
+                _, _, *grandchildren = child
+                stack.extend((grandchild, bookmark) for grandchild in reversed(grandchildren))
 
         return outline
@@ -1,5 +1,8 @@
 import pathlib
+import zlib
 
+from PIL import Image
+from pdfrw import PdfDict, PdfName, PdfString
 import pdfrw
 
 from .workdir import WorkingDirectory
@@ -14,26 +17,131 @@ def is_valid_pdf(path: pathlib.Path):
         return True
 
 
-def combine_pdfs_on_fs_with_text(workdir: WorkingDirectory, outline: pdfrw.IndirectPdfDict):
+# Pillow writes palette images as uncompressed hexadecimal data, so we build those pages ourselves
+def write_indexed_image_pdf(image: Image.Image, path: pathlib.Path, page_size: tuple[float, float]):
+    width, height = page_size
+    palette = bytes(image.getpalette() or [])
+
+    xobject = PdfDict(
+        Type=PdfName.XObject,
+        Subtype=PdfName.Image,
+        Width=image.width,
+        Height=image.height,
+        ColorSpace=[PdfName.Indexed, PdfName.DeviceRGB, len(palette) // 3 - 1, PdfString.from_bytes(palette, bytes_encoding='hex')],
+        BitsPerComponent=8,
+        Filter=PdfName.FlateDecode
+    )
+    # pdfrw keeps streams as strings and writes them using latin-1, which maps bytes one-to-one
+    xobject.stream = zlib.compress(image.tobytes()).decode('latin-1')
+
+    contents = PdfDict()
+    contents.stream = f'q {width} 0 0 {height} 0 0 cm /Im0 Do Q'
+
+    page = PdfDict(
+        Type=PdfName.Page,
+        MediaBox=[0, 0, width, height],
+        Resources=PdfDict(XObject=PdfDict(Im0=xobject)),
+        Contents=contents
+    )
+
+    writer = pdfrw.PdfWriter()
+    writer.addpage(page)
+    writer.write(path)
+
+
+def write_blank_page_pdf(path: pathlib.Path, page_size: tuple[float, float]):
+    width, height = page_size
+    contents = PdfDict()
+    contents.stream = ''
+
+    page = PdfDict(
+        Type=PdfName.Page,
+        MediaBox=[0, 0, width, height],
+        Resources=PdfDict(),
+        Contents=contents
+    )
+
+    writer = pdfrw.PdfWriter()
+    writer.addpage(page)
+    writer.write(path)
+
+
+def share_page(page: PdfDict):
+    """Create another page with the same contents and resources, so that the image data is only written once."""
+    return PdfDict(
+        Type=PdfName.Page,
+        MediaBox=page.inheritable.MediaBox,
+        Resources=page.inheritable.Resources,
+        Contents=page.Contents
+    )
+
+
+class PageReaderCache:
+    """Read the PDF of every page at most once, so that duplicates of a page can refer to the same objects."""
+
+    readers: dict[pathlib.Path, pdfrw.PdfReader]
+
+    def __init__(self):
+        self.readers = {}
+
+    def get_page(self, path: pathlib.Path) -> PdfDict:
+        if path not in self.readers:
+            self.readers[path] = pdfrw.PdfReader(path)
+
+        return self.readers[path].pages[0]
+
+    def get_image_page(self, workdir: WorkingDirectory, i: int) -> PdfDict:
+        owner = workdir.get_duplicate_owner(i)
+
+        if owner is None:
+            return self.get_page(workdir.get_page_pdf_path(i))
+
+        return share_page(self.get_page(workdir.get_page_pdf_path(owner)))
+
+    def get_ocr_page(self, workdir: WorkingDirectory, i: int) -> PdfDict:
+        owner = workdir.get_duplicate_owner(i)
+
+        if owner is not None:
+            return share_page(self.get_ocr_page(workdir, owner))
+
+        # Blank pages are not passed through OCR
+        if workdir.get_blank_marker_path(i).exists():
+            return self.get_page(workdir.get_page_pdf_path(i))
+
+        return self.get_page(workdir.get_ocr_page_pdf_path(i))
+
+
+def combine_pdfs_on_fs_with_text(workdir: WorkingDirectory, outline: pdfrw.IndirectPdfDict, dest: pathlib.Path):
     text_pdf = pdfrw.PdfReader(workdir.text_layer_pdf_path)
     writer = pdfrw.PdfWriter()
+    cache = PageReaderCache()
 
     for i, page in enumerate(text_pdf.pages):
         merger = pdfrw.PageMerge(page)
-        image_pdf = pdfrw.PdfReader(workdir.get_page_pdf_path(i))
-        merger.add(image_pdf.pages[0]).render()
+        merger.add(cache.get_image_page(workdir, i)).render()
         writer.addpage(page)
 
     writer.trailer.Root.Outlines = outline
-    writer.write(workdir.combined_pdf_path)
+    writer.write(dest)
+
+
+def combine_pdfs_on_fs_without_text(workdir: WorkingDirectory, outline: pdfrw.IndirectPdfDict, max_page: int, dest: pathlib.Path):
+    writer = pdfrw.PdfWriter()
+    cache = PageReaderCache()
+
+    for i in range(max_page):
+        writer.addpage(cache.get_image_page(workdir, i))
+
+    writer.trailer.Root.Outlines = outline
+    writer.write(dest)
 
 
-def combine_pdfs_on_fs_without_text(workdir: WorkingDirectory, outline: pdfrw.IndirectPdfDict, max_page: int):
+def combine_pdfs_on_fs_with_ocr(workdir: WorkingDirectory, outline: pdfrw.IndirectPdfDict, max_page: int, dest: pathlib.Path):
     writer = pdfrw.PdfWriter()
+    cache = PageReaderCache()
 
     for i in range(max_page):
-        image_pdf = pdfrw.PdfReader(workdir.get_page_pdf_path(i))
-        writer.addpage(image_pdf.pages[0])
+        writer.addpage(cache.get_ocr_page(workdir, i))
 
     writer.trailer.Root.Outlines = outline
-    writer.write(workdir.combined_pdf_without_text_path)
+    writer.write(dest)
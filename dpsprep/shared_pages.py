@@ -0,0 +1,58 @@
+from multiprocessing import shared_memory
+import multiprocessing.util
+
+
+class PageRing:
+    """A fixed set of shared memory buffers, each large enough for any rendered page of a document.
+
+    Render workers write the pixels of a page into a free buffer and encoder workers build the image from there,
+    so the pixel data passes neither through pickling nor through the file system.
+    Pillow still copies the pixels once when building the image, which frees the buffer for the next page.
+    The buffers are owned by the main process, which hands them out and takes them back.
+    """
+
+    slots: list[shared_memory.SharedMemory]
+    free_slots: list[str]
+
+    def __init__(self, slot_count: int, slot_size: int):
+        self.slots = [shared_memory.SharedMemory(create=True, size=slot_size) for _ in range(slot_count)]
+        self.free_slots = [slot.name for slot in self.slots]
+
+    def has_free_slot(self):
+        return len(self.free_slots) > 0
+
+    def acquire(self):
+        return self.free_slots.pop()
+
+    def release(self, name: str):
+        self.free_slots.append(name)
+
+    def destroy(self):
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+
+
+# Workers attach to every buffer once and keep it mapped for the rest of their lifetime
+attached_slots: dict[str, shared_memory.SharedMemory] = {}
+
+
+def get_slot_buffer(name: str, size: int) -> memoryview:
+    if name not in attached_slots:
+        attached_slots[name] = shared_memory.SharedMemory(name=name)
+
+    buffer = attached_slots[name].buf
+    assert buffer is not None, 'Only closed shared memory has no buffer'
+    return buffer[:size]
+
+
+def detach_slots():
+    for slot in attached_slots.values():
+        slot.close()
+
+    attached_slots.clear()
+
+
+def init_slot_worker():
+    """Pool initializer that detaches a worker from the buffers it attached to once it exits."""
+    multiprocessing.util.Finalize(None, detach_slots, exitpriority=0)
@@ -0,0 +1,67 @@
+import pytest
+
+from .benchmark import WORDS, benchmark_document, draw_page, generate_document, get_result_key, missing_djvulibre_tools, open_document
+from .text import TextExtractVisitor
+
+
+def test_draw_page_is_deterministic():
+    image_a, words_a = draw_page('grayscale', seed=1)
+    image_b, words_b = draw_page('grayscale', seed=1)
+
+    assert image_a.mode == 'L'
+    assert words_a == words_b
+    assert image_a.tobytes() == image_b.tobytes()
+
+
+def test_draw_page_bitonal():
+    image, words = draw_page('bitonal', seed=1)
+
+    assert image.mode == '1'
+    assert len(words) > 0
+
+
+@pytest.mark.skipif(len(missing_djvulibre_tools()) > 0, reason='Requires the DjVuLibre command-line tools')
+def test_generate_document(tmp_path):
+    path = tmp_path / 'synthetic.djvu'
+    generate_document(path, 'color', pages=2, pool_size=1)
+
+    document = open_document(path)
+    assert len(document.pages) == 2
+    assert len(document.outline.sexpr) > 0
+
+    text = TextExtractVisitor().visit(document.pages[0].text.sexpr)
+    assert any(word in text for word in WORDS)
+
+
+@pytest.mark.skipif(len(missing_djvulibre_tools()) > 0, reason='Requires the DjVuLibre command-line tools')
+def test_benchmark_document(tmp_path):
+    path = tmp_path / 'synthetic.djvu'
+    generate_document(path, 'grayscale', pages=2, pool_size=1)
+
+    results = benchmark_document(path, 'grayscale', pool_sizes=[1, 2], optlevel=None, quality=75)
+
+    assert [(result['stage'], result['encoding'], result['pool_size']) for result in results] == [
+        ('djvu_page_to_image', None, 1),
+        ('djvu_pages_to_text_fpdf', None, 1),
+        ('process_page_bg', 'auto', 1),
+        ('process_page_bg', 'auto', 2),
+        ('process_page_bg', 'native', 1),
+        ('process_page_bg', 'native', 2),
+        ('combine_pdfs_on_fs_without_text', 'native', 1),
+        ('combine_pdfs_on_fs_with_text', 'native', 1),
+    ]
+
+    for result in results:
+        assert result['pages'] == 2
+        assert result['peak_rss'] > 0
+
+        if result['stage'] != 'djvu_page_to_image':
+            assert result['output_bytes'] > 0
+
+
+def test_compare_results_with_legacy_baseline():
+    legacy = dict(kind='color', stage='process_page_bg', pool_size=1, seconds=2.0, output_bytes=100, peak_rss=100)
+    result = dict(legacy, encoding='auto')
+
+    assert get_result_key(result) == get_result_key(legacy)
+    assert get_result_key(dict(result, encoding='native')) != get_result_key(legacy)
@@ -1,10 +1,10 @@
 from typing import Protocol
 
 from pytest_image_diff.plugin import DiffCompareResult
-from PIL import Image
+from PIL import Image, ImageDraw
 import djvu.decode
 
-from .images import djvu_page_to_image
+from .images import apply_page_encoding, choose_page_encoding, djvu_page_to_image, get_image_digest, is_blank_page, render_djvu_page
 
 
 class ImageDiffProtocol(Protocol):
@@ -22,3 +22,105 @@ def test_djvu_page_to_image_bitonal(image_diff: ImageDiffProtocol):
     result = djvu_page_to_image(document.pages[0], i=0)
 
     assert image_diff(fixture, result, threshold=1e-2)
+
+
+def test_render_djvu_page_max_size():
+    document = djvu.decode.Context().new_document(
+        djvu.decode.FileURI('fixtures/lipsum_words.djvu')
+    )
+    document.decoding_job.wait()
+
+    native, native_size = render_djvu_page(document.pages[0], i=0)
+    result, page_size = render_djvu_page(document.pages[0], i=0, max_size=200)
+
+    assert page_size == native_size == native.size
+    assert max(result.size) == 200
+    assert abs(result.width / result.height - native.width / native.height) < 0.02
+
+
+def test_render_djvu_page_never_upscales():
+    document = djvu.decode.Context().new_document(
+        djvu.decode.FileURI('fixtures/lipsum_words.djvu')
+    )
+    document.decoding_job.wait()
+
+    native, _ = render_djvu_page(document.pages[0], i=0)
+    result, _ = render_djvu_page(document.pages[0], i=0, dpi=100000, max_size=100000)
+
+    assert result.size == native.size
+
+
+def test_choose_page_encoding_bilevel():
+    image = Image.new('RGB', (1200, 1600), 'white')
+    draw = ImageDraw.Draw(image)
+
+    for y in range(100, 1500, 40):
+        draw.rectangle((100, y, 1100, y + 12), fill='black')
+
+    assert choose_page_encoding(image) == 'bilevel'
+    assert apply_page_encoding(image, 'bilevel').mode == '1'
+
+
+def test_choose_page_encoding_keeps_small_figures():
+    image = Image.new('L', (1200, 1600), 255)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((100, 100, 1100, 1400), fill=0)
+    # A gradient covering well under 2% of the page
+    image.paste(Image.linear_gradient('L').resize((100, 100)), (1000, 1450))
+
+    assert choose_page_encoding(image) == 'grayscale'
+
+
+def test_choose_page_encoding_palette_covers_every_color():
+    image = Image.new('RGB', (2000, 2000), 'white')
+    image.putpixel((1001, 1001), (0, 128, 0))  # Missed by the analysis sample
+
+    result = apply_page_encoding(image, choose_page_encoding(image))
+    assert result.mode == 'P'
+    assert result.convert('RGB').tobytes() == image.tobytes()
+
+
+def test_choose_page_encoding_grayscale():
+    image = Image.linear_gradient('L').resize((600, 800)).convert('RGB')
+
+    assert choose_page_encoding(image) == 'grayscale'
+    assert apply_page_encoding(image, 'grayscale').mode == 'L'
+
+
+def test_choose_page_encoding_palette():
+    image = Image.new('RGB', (600, 800), 'white')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((50, 50, 550, 300), fill=(200, 30, 30))
+    draw.rectangle((50, 400, 550, 700), fill=(30, 30, 200))
+
+    assert choose_page_encoding(image) == 'palette'
+
+    result = apply_page_encoding(image, 'palette')
+    assert result.mode == 'P'
+    assert result.convert('RGB').getpixel((300, 200)) == (200, 30, 30)
+
+
+def test_choose_page_encoding_jpeg():
+    red = Image.linear_gradient('L').resize((600, 800))
+    image = Image.merge('RGB', [red, red.rotate(90), red.transpose(Image.Transpose.FLIP_TOP_BOTTOM)])
+
+    assert choose_page_encoding(image) == 'jpeg'
+
+
+def test_is_blank_page():
+    image = Image.new('L', (1000, 1000), 250)
+    image.putpixel((10, 10), 0)  # Dust
+    assert is_blank_page(image)
+
+    ImageDraw.Draw(image).rectangle((500, 950, 507, 961), fill=0)  # A lone page number
+    assert not is_blank_page(image)
+
+
+def test_get_image_digest():
+    image = Image.new('RGB', (100, 100), 'white')
+    copy = image.copy()
+    assert get_image_digest(image) == get_image_digest(copy)
+
+    copy.putpixel((50, 50), (0, 0, 0))
+    assert get_image_digest(image) != get_image_digest(copy)
+    assert get_image_digest(image) != get_image_digest(image.convert('L'))
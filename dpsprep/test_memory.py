@@ -0,0 +1,49 @@
+import os
+
+from .memory import ConcurrencyController, get_available_memory, get_child_pids, get_process_rss
+
+
+MiB = 2 ** 20
+
+
+def test_controller_lowers_limit_under_pressure():
+    controller = ConcurrencyController(min_workers=1, max_workers=8, min_available=512 * MiB)
+
+    controller.update(400 * MiB, [300 * MiB])
+    assert controller.limit == 7
+
+    controller.update(100 * MiB, [300 * MiB])
+    assert controller.limit == 3
+
+    controller.update(100 * MiB, [300 * MiB])
+    controller.update(100 * MiB, [300 * MiB])
+    assert controller.limit == 1
+
+
+def test_controller_raises_limit_when_there_is_room():
+    controller = ConcurrencyController(min_workers=2, max_workers=4, min_available=512 * MiB)
+    controller.limit = 2
+
+    # Not enough room for another worker as large as the largest one
+    controller.update(700 * MiB, [300 * MiB])
+    assert controller.limit == 2
+
+    controller.update(1024 * MiB, [300 * MiB])
+    controller.update(1024 * MiB, [300 * MiB])
+    controller.update(1024 * MiB, [300 * MiB])
+    assert controller.limit == 4
+
+
+def test_controller_dispatch():
+    controller = ConcurrencyController(min_workers=1, max_workers=2, min_available=0, sample_interval=3600)
+
+    assert controller.can_dispatch(1)
+    assert not controller.can_dispatch(2)
+
+
+def test_process_memory():
+    if get_available_memory() is None:
+        return
+
+    assert get_process_rss(os.getpid()) > 0
+    assert os.getpid() in get_child_pids(os.getppid())
@@ -0,0 +1,50 @@
+import json
+
+from .metrics import Metrics
+
+
+def test_merge_worker_snapshots():
+    first = Metrics()
+    first.record('render', 1.0)
+    first.record('encode', 0.5, bytes_out=100)
+
+    second = Metrics()
+    second.record('render', 3.0)
+    second.record('encode', 0.5, bytes_out=50)
+
+    metrics = Metrics()
+    metrics.merge(first.as_dict())
+    metrics.merge(second.as_dict())
+    metrics.merge(None)  # Pages that had already been processed
+    summary = metrics.summary(run_seconds=4)
+
+    assert summary['stages']['render']['count'] == 2
+    assert summary['stages']['render']['seconds'] == 4.0
+    assert summary['stages']['render']['p50_seconds'] == 1.0
+    assert summary['stages']['render']['p99_seconds'] == 3.0
+    assert summary['stages']['encode']['bytes_out'] == 150
+    assert len(summary['workers']) == 1  # All snapshots come from the test process
+
+
+def test_export_prometheus(tmp_path):
+    metrics = Metrics()
+
+    with metrics.stage('combine', bytes_in=10) as record:
+        record.bytes_out = 20
+
+    metrics.export(tmp_path / 'run.prom', run_seconds=1)
+    content = (tmp_path / 'run.prom').read_text()
+
+    assert 'dpsprep_stage_calls_total{stage="combine"} 1' in content
+    assert 'dpsprep_stage_bytes_in_total{stage="combine"} 10' in content
+    assert 'dpsprep_stage_bytes_out_total{stage="combine"} 20' in content
+
+
+def test_export_json(tmp_path):
+    metrics = Metrics()
+    metrics.record('ocr', 2.5)
+    metrics.export(tmp_path / 'run.json', run_seconds=3)
+
+    report = json.loads((tmp_path / 'run.json').read_text())
+    assert report['run_seconds'] == 3
+    assert report['stages']['ocr']['max_seconds'] == 2.5
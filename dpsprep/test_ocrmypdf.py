@@ -0,0 +1,157 @@
+import sys
+import types
+
+from PIL import Image
+import pdfrw
+import pytest
+
+from .dpsprep import encode_page, process_page_ocr
+from .metrics import Metrics
+from .ocrmypdf import optimize_page_pdf, perform_page_ocr
+from .pdf import combine_pdfs_on_fs_with_ocr, write_blank_page_pdf
+from .workdir import WorkingDirectory
+
+
+def make_workdir(tmp_path, page_count: int):
+    src = tmp_path / 'book.djvu'
+    src.write_bytes(b'AT&TFORM')
+    workdir = WorkingDirectory(src, tmp_path / 'book.pdf')
+    workdir.workdir = tmp_path / 'workdir'
+    workdir.create_if_necessary()
+
+    for i in range(page_count):
+        Image.new('L', (100, 100), 255).save(workdir.get_page_pdf_path(i), format='PDF', resolution=72)
+
+    return workdir
+
+
+def stub_ocrmypdf(monkeypatch, ocr):
+    monkeypatch.setitem(sys.modules, 'ocrmypdf', types.SimpleNamespace(api=types.SimpleNamespace(ocr=ocr)))
+
+
+def test_perform_page_ocr_without_ocrmypdf(tmp_path, monkeypatch):
+    workdir = make_workdir(tmp_path, page_count=1)
+    # A None entry makes the import fail with ImportError
+    monkeypatch.setitem(sys.modules, 'ocrmypdf', None)
+
+    assert not perform_page_ocr(workdir, 0, {})
+    assert workdir.get_ocr_page_pdf_path(0).read_bytes() == workdir.get_page_pdf_path(0).read_bytes()
+
+
+def test_perform_page_ocr_failure(tmp_path, monkeypatch):
+    pytest.importorskip('pikepdf')
+    workdir = make_workdir(tmp_path, page_count=1)
+
+    def ocr(**kwargs):
+        raise RuntimeError('Tesseract is missing')
+
+    stub_ocrmypdf(monkeypatch, ocr)
+
+    assert not perform_page_ocr(workdir, 0, {})
+    assert workdir.get_ocr_page_pdf_path(0).read_bytes() == workdir.get_page_pdf_path(0).read_bytes()
+
+
+def test_combine_pdfs_on_fs_with_ocr(tmp_path, monkeypatch):
+    pytest.importorskip('pikepdf')
+    workdir = make_workdir(tmp_path, page_count=4)
+    calls = []
+
+    # The output pages are twice as large as their input, so that they can be told apart
+    def ocr(input_file, output_file, **kwargs):
+        calls.append(input_file)
+        write_blank_page_pdf(output_file, (200, 200))
+
+    stub_ocrmypdf(monkeypatch, ocr)
+
+    workdir.mark_duplicate(2, 0)
+    workdir.get_blank_marker_path(3).touch()
+
+    for i in range(4):
+        process_page_ocr(workdir, i, {'language': 'eng'})
+
+    # Duplicates and blank pages are not passed through OCR, and finished pages are not passed again
+    assert calls == [workdir.get_page_pdf_path(0), workdir.get_page_pdf_path(1)]
+    process_page_ocr(workdir, 0, {})
+    assert len(calls) == 2
+
+    dest = tmp_path / 'combined.pdf'
+    combine_pdfs_on_fs_with_ocr(workdir, pdfrw.IndirectPdfDict(), 4, dest)
+    pages = pdfrw.PdfReader(dest).pages
+
+    assert [float(page.inheritable.MediaBox[2]) for page in pages] == [200, 200, 200, 100]
+
+
+def stub_optimizer(monkeypatch, optimize):
+    module = types.SimpleNamespace(
+        ObjectStreamMode=types.SimpleNamespace(disable='disable'),
+        PdfContext=lambda *args: None,
+        optimize=optimize
+    )
+    monkeypatch.setitem(sys.modules, 'ocrmypdf', types.SimpleNamespace(optimize=module))
+    monkeypatch.setitem(sys.modules, 'ocrmypdf.optimize', module)
+
+
+def make_unoptimized_page(tmp_path):
+    workdir = make_workdir(tmp_path, page_count=0)
+    Image.new('L', (100, 100), 255).save(workdir.get_unoptimized_page_pdf_path(0), format='PDF', resolution=72)
+    return workdir, workdir.get_unoptimized_page_pdf_path(0).read_bytes()
+
+
+def test_optimize_page_pdf_keeps_smaller_file(tmp_path, monkeypatch):
+    workdir, unoptimized = make_unoptimized_page(tmp_path)
+
+    def optimize(src, dest, context, options):
+        assert options['object_stream_mode'] == 'disable'
+        dest.write_bytes(b'%PDF-1.4 optimized')
+
+    stub_optimizer(monkeypatch, optimize)
+
+    assert optimize_page_pdf(workdir, 0, 1, 75)
+    assert workdir.get_page_pdf_path(0).read_bytes() == b'%PDF-1.4 optimized'
+    assert not workdir.get_unoptimized_page_pdf_path(0).exists()
+    assert not workdir.get_page_ocrmypdf_tmp_path(0).exists()
+
+    # A larger result is discarded
+    workdir.get_unoptimized_page_pdf_path(0).write_bytes(unoptimized)
+    stub_optimizer(monkeypatch, lambda src, dest, context, options: dest.write_bytes(unoptimized + b'padding'))
+
+    assert optimize_page_pdf(workdir, 0, 1, 75)
+    assert workdir.get_page_pdf_path(0).read_bytes() == unoptimized
+
+
+def test_optimize_page_pdf_failure(tmp_path, monkeypatch):
+    workdir, unoptimized = make_unoptimized_page(tmp_path)
+
+    def optimize(src, dest, context, options):
+        dest.write_bytes(b'%PDF-1.4 trunc')
+        raise RuntimeError('jbig2 crashed')
+
+    stub_optimizer(monkeypatch, optimize)
+
+    assert not optimize_page_pdf(workdir, 0, 1, 75)
+    assert workdir.get_page_pdf_path(0).read_bytes() == unoptimized
+    assert not workdir.get_unoptimized_page_pdf_path(0).exists()
+    assert not workdir.get_page_ocrmypdf_tmp_path(0).exists()
+
+
+def test_optimize_page_pdf_without_ocrmypdf(tmp_path, monkeypatch):
+    workdir, unoptimized = make_unoptimized_page(tmp_path)
+    monkeypatch.setitem(sys.modules, 'ocrmypdf', None)
+
+    assert not optimize_page_pdf(workdir, 0, 1, 75)
+    assert workdir.get_page_pdf_path(0).read_bytes() == unoptimized
+    assert not workdir.get_unoptimized_page_pdf_path(0).exists()
+
+
+def test_encode_page_with_optimization(tmp_path, monkeypatch):
+    workdir = make_workdir(tmp_path, page_count=0)
+    stub_optimizer(monkeypatch, lambda src, dest, context, options: dest.write_bytes(b'%PDF-1.4 optimized'))
+    metrics = Metrics()
+
+    size = encode_page(workdir, 75, 0, Image.new('L', (100, 100), 255), (100, 100), 'native', 1, False, metrics)
+
+    # Only the optimized page ever appears at the page path
+    assert size == len(b'%PDF-1.4 optimized')
+    assert workdir.get_page_pdf_path(0).read_bytes() == b'%PDF-1.4 optimized'
+    assert not workdir.get_unoptimized_page_pdf_path(0).exists()
+    assert metrics.as_dict()['stages']['optimize']['bytes_in'] > size
@@ -65,3 +65,59 @@ def test_outline_with_page_titles():
     bookmarks = visitor.visit(src)
     empty_pdf_dict = IndirectPdfDict()
     assert bookmarks == empty_pdf_dict
+
+
+# Page titles can be resolved if we build an index from the component files of the document
+def test_outline_with_page_index():
+    src = sexpr.ListExpression([
+        sexpr.SymbolExpression(sexpr.Symbol('bookmarks')),
+        sexpr.ListExpression([
+            sexpr.StringExpression(b'Preface'),
+            sexpr.StringExpression(b'#f007.djvu'),
+        ]),
+        sexpr.ListExpression([
+            sexpr.StringExpression(b'Contents'),
+            sexpr.StringExpression(b'#f011.djvu'),
+        ]),
+        sexpr.ListExpression([
+            sexpr.StringExpression(b'0 Prologue'),
+            sexpr.StringExpression(b'#p001.djvu')
+        ])
+    ])
+
+    visitor = OutlineTransformVisitor(page_index={'f007.djvu': 6, 'f011.djvu': 10})
+    bookmarks = visitor.visit(src)
+    assert bookmarks.Count == 2
+    assert bookmarks.First.A.D[0] == 6
+    assert bookmarks.Last.Title == 'Contents'
+    assert bookmarks.Last.A.D[0] == 10
+
+
+def test_deeply_nested_outline():
+    depth = 5000
+    node = sexpr.ListExpression([
+        sexpr.StringExpression(f'Section {depth}'.encode()),
+        sexpr.StringExpression(f'#{depth}'.encode()),
+    ])
+
+    for level in range(depth - 1, 0, -1):
+        node = sexpr.ListExpression([
+            sexpr.StringExpression(f'Section {level}'.encode()),
+            sexpr.StringExpression(f'#{level}'.encode()),
+            node
+        ])
+
+    src = sexpr.ListExpression([
+        sexpr.SymbolExpression(sexpr.Symbol('bookmarks')),
+        node
+    ])
+
+    visitor = OutlineTransformVisitor()
+    bookmark = visitor.visit(src).First
+
+    for level in range(1, depth):
+        assert bookmark.A.D[0] == level - 1
+        bookmark = bookmark.First
+
+    assert bookmark.Title == f'Section {depth}'
+    assert bookmark.First is None
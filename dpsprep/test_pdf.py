@@ -0,0 +1,36 @@
+from PIL import Image, ImageDraw
+import pdfrw
+
+from .dpsprep import encode_page
+from .metrics import Metrics
+from .pdf import combine_pdfs_on_fs_without_text
+from .workdir import WorkingDirectory
+
+
+def draw_page(text: str):
+    image = Image.new('L', (200, 300), 255)
+    ImageDraw.Draw(image).text((20, 20), text, fill=0)
+    return image
+
+
+def test_duplicate_pages_share_their_image(tmp_path):
+    src = tmp_path / 'book.djvu'
+    src.write_bytes(b'AT&TFORM')
+    workdir = WorkingDirectory(src, tmp_path / 'book.pdf')
+    workdir.workdir = tmp_path / 'workdir'
+    workdir.create_if_necessary()
+
+    pages = [draw_page('Chapter 1'), draw_page('Chapter 2'), draw_page('Chapter 1'), draw_page('Chapter 2')]
+
+    for i, image in enumerate(pages):
+        encode_page(workdir, 75, i, image, (200, 300), 'native', None, False, Metrics())
+
+    assert [workdir.get_duplicate_owner(i) for i in range(4)] == [None, None, 0, 1]
+    assert not workdir.get_page_pdf_path(2).exists()
+
+    dest = tmp_path / 'combined.pdf'
+    combine_pdfs_on_fs_without_text(workdir, pdfrw.IndirectPdfDict(), 4, dest)
+
+    # Four pages, but the image data of each distinct page is only written once
+    assert len(pdfrw.PdfReader(dest).pages) == 4
+    assert dest.read_bytes().count(b'/Subtype /Image') == 2
@@ -0,0 +1,35 @@
+from collections import Counter
+from time import perf_counter
+import pathlib
+
+from .profiling import format_top_functions, merge_profiles, run_profiled, write_profile_report
+
+
+def spin(seconds: float):
+    end = perf_counter() + seconds
+    total = 0
+
+    while perf_counter() < end:
+        total += 1
+
+    return total
+
+
+def test_run_profiled(tmp_path: pathlib.Path):
+    assert run_profiled(tmp_path, spin, 0.2) > 0
+
+    stacks = merge_profiles(tmp_path)
+    assert sum(stacks.values()) > 0
+    assert all(stack.startswith('spin ') for stack in stacks)
+
+    write_profile_report(tmp_path, tmp_path / 'profile.collapsed', tmp_path / 'profile.txt')
+    assert (tmp_path / 'profile.collapsed').read_text().startswith('spin ')
+
+
+def test_format_top_functions():
+    stacks = Counter({'main;parse;read': 3, 'main;parse': 1, 'main;render': 1})
+    lines = format_top_functions(stacks, top_n=2).splitlines()
+
+    assert len(lines) == 3
+    assert lines[1].split() == ['0', '0.0', '5', '100.0', 'main']
+    assert lines[2].split() == ['1', '20.0', '4', '80.0', 'parse']
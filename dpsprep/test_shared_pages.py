@@ -0,0 +1,28 @@
+from PIL import Image
+
+from .images import get_page_buffer_size, image_from_buffer
+from .shared_pages import PageRing, detach_slots, get_slot_buffer
+
+
+def test_page_ring_round_trip():
+    image = Image.linear_gradient('L').convert('RGB')
+    buffer_size = get_page_buffer_size(image.size)
+    ring = PageRing(slot_count=2, slot_size=buffer_size)
+
+    try:
+        slot = ring.acquire()
+        assert ring.has_free_slot()
+
+        with get_slot_buffer(slot, buffer_size) as buffer:
+            buffer[:] = image.tobytes()
+
+        with get_slot_buffer(slot, buffer_size) as buffer:
+            result = image_from_buffer('rgb', image.size, buffer)
+
+        assert result.tobytes() == image.tobytes()
+
+        ring.release(slot)
+        assert len(ring.free_slots) == 2
+    finally:
+        detach_slots()
+        ring.destroy()
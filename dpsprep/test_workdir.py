@@ -0,0 +1,65 @@
+from .workdir import WorkingDirectory
+
+
+def test_publish(tmp_path):
+    src = tmp_path / 'book.djvu'
+    src.write_bytes(b'AT&TFORM')
+    workdir = WorkingDirectory(src, tmp_path / 'book.pdf')
+
+    workdir.partial_dest_path.write_bytes(b'%PDF-1.4')
+    workdir.publish()
+    workdir.discard_partial()
+
+    assert workdir.dest.read_bytes() == b'%PDF-1.4'
+    assert not workdir.partial_dest_path.exists()
+
+
+def test_discard_partial(tmp_path):
+    src = tmp_path / 'book.djvu'
+    src.write_bytes(b'AT&TFORM')
+    workdir = WorkingDirectory(src, tmp_path / 'book.pdf')
+
+    workdir.partial_dest_path.write_bytes(b'%PDF-1.4')
+    workdir.discard_partial()
+
+    assert not workdir.partial_dest_path.exists()
+    assert not workdir.dest.exists()
+
+
+def test_update_render_settings(tmp_path):
+    src = tmp_path / 'book.djvu'
+    src.write_bytes(b'AT&TFORM')
+    workdir = WorkingDirectory(src, tmp_path / 'book.pdf')
+    workdir.workdir = tmp_path / 'workdir'
+    workdir.create_if_necessary()
+
+    workdir.get_page_pdf_path(0).write_bytes(b'%PDF-1.4')
+    workdir.text_layer_pdf_path.write_bytes(b'%PDF-1.4')
+
+    # Pages from before the settings were recorded were rendered at full size
+    assert not workdir.update_render_settings(dict(dpi=None, max_size=None))
+    assert workdir.get_page_pdf_path(0).exists()
+
+    assert workdir.update_render_settings(dict(dpi=150, max_size=None))
+    assert not workdir.get_page_pdf_path(0).exists()
+    assert workdir.text_layer_pdf_path.exists()
+    assert workdir.page_hashes_path.exists()
+
+    assert not workdir.update_render_settings(dict(dpi=150, max_size=None))
+
+
+def test_claim_page_digest(tmp_path):
+    src = tmp_path / 'book.djvu'
+    src.write_bytes(b'AT&TFORM')
+    workdir = WorkingDirectory(src, tmp_path / 'book.pdf')
+    workdir.workdir = tmp_path / 'workdir'
+    workdir.create_if_necessary()
+
+    assert workdir.claim_page_digest(0, 'abc') == 0
+    assert workdir.claim_page_digest(2, 'abc') == 0
+    assert workdir.claim_page_digest(1, 'def') == 1
+    assert list(workdir.page_hashes_path.glob('*.tmp')) == []
+
+    workdir.mark_duplicate(2, 0)
+    assert workdir.get_duplicate_owner(2) == 0
+    assert workdir.get_duplicate_owner(1) is None
@@ -1,6 +1,8 @@
 from pathlib import Path
-from typing import Union
+from typing import Any, Union
+import errno
 import hashlib
+import json
 import os
 import shutil
 import tempfile
@@ -8,7 +10,8 @@ import tempfile
 from loguru import logger
 
 
-HASHING_BUFFER_SIZE = 64 * 1024
+# Large sequential reads perform much better than small ones on network file systems
+HASHING_BUFFER_SIZE = 1024 * 1024
 
 
 # Based on
@@ -17,6 +20,9 @@ def get_file_hash(path: Union[os.PathLike, str]):
     h = hashlib.sha1()
 
     with open(path, 'rb') as file:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
         data = file.read(HASHING_BUFFER_SIZE)
 
         while len(data) > 0:
@@ -59,14 +65,108 @@ class WorkingDirectory:
 
         if not self.ocrmypdf_tmp_path.exists():
             logger.debug(f'Creating {repr(str(self.ocrmypdf_tmp_path))}.')
+            self.ocrmypdf_tmp_path.mkdir()
+
+        if not self.page_hashes_path.exists():
+            logger.debug(f'Creating {repr(str(self.page_hashes_path))}.')
+            self.page_hashes_path.mkdir()
+
+    def discard_pages(self):
+        """Remove everything derived from the rendered pages, but keep the text layer."""
+        for pattern in ['page_bg_*', 'page_ocr_*']:
+            for path in self.workdir.glob(pattern):
+                path.unlink()
+
+        for path in [self.page_hashes_path, self.ocrmypdf_tmp_path]:
+            shutil.rmtree(path)
+            path.mkdir()
+
+        self.combined_pdf_without_text_path.unlink(missing_ok=True)
+        self.combined_pdf_path.unlink(missing_ok=True)
+
+    def update_render_settings(self, settings: dict[str, Any]) -> bool:
+        """Record the settings pages are rendered with. If pages were rendered with different settings, discard them and return True.
+
+        Working directories from before the settings were recorded only contain pages rendered at full size.
+        """
+        try:
+            previous = json.loads(self.render_settings_path.read_text())
+        except FileNotFoundError:
+            previous = {key: None for key in settings}
+
+        changed = previous != settings
+
+        if changed:
+            self.discard_pages()
+
+        tmp_path = self.render_settings_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(settings))
+        os.replace(tmp_path, self.render_settings_path)
+        return changed
 
     def get_page_pdf_path(self, i: int):
         return self.workdir / f'page_bg_{i + 1}.pdf'
 
+    def get_unoptimized_page_pdf_path(self, i: int):
+        return self.workdir / f'page_bg_{i + 1}_unoptimized.pdf'
+
+    def get_ocr_page_pdf_path(self, i: int):
+        return self.workdir / f'page_ocr_{i + 1}.pdf'
+
+    def get_duplicate_marker_path(self, i: int):
+        return self.workdir / f'page_bg_{i + 1}.duplicate'
+
+    def get_blank_marker_path(self, i: int):
+        return self.workdir / f'page_bg_{i + 1}.blank'
+
+    def claim_page_digest(self, i: int, digest: str):
+        """Record that page i has the given image digest, unless another page already has.
+
+        Return the index of the page that owns the digest. The claim is created with its content in place
+        via a hard link, so concurrent workers never observe a partially written claim.
+        """
+        path = self.page_hashes_path / digest
+        tmp_path = self.page_hashes_path / f'{digest}.{i}.tmp'
+        tmp_path.write_text(str(i))
+
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return int(path.read_text())
+        else:
+            return i
+        finally:
+            tmp_path.unlink()
+
+    def mark_duplicate(self, i: int, owner: int):
+        tmp_path = self.get_duplicate_marker_path(i).with_suffix('.tmp')
+        tmp_path.write_text(str(owner))
+        os.replace(tmp_path, self.get_duplicate_marker_path(i))
+
+    def get_duplicate_owner(self, i: int) -> Union[int, None]:
+        try:
+            return int(self.get_duplicate_marker_path(i).read_text())
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return None
+
+            raise
+
+    def get_page_ocrmypdf_tmp_path(self, i: int):
+        return self.ocrmypdf_tmp_path / f'page_{i + 1}'
+
     @property
     def text_layer_pdf_path(self):
         return self.workdir / 'text_layer.pdf'
 
+    @property
+    def render_settings_path(self):
+        return self.workdir / 'render_settings.json'
+
+    @property
+    def page_hashes_path(self):
+        return self.workdir / 'page_hashes'
+
     @property
     def ocrmypdf_tmp_path(self):
         return self.workdir / 'ocrmypdf'
@@ -80,8 +180,26 @@ class WorkingDirectory:
         return self.workdir / 'combined.pdf'
 
     @property
-    def optimized_pdf_path(self):
-        return self.workdir / 'optimized.pdf'
+    def partial_dest_path(self):
+        # Next to the destination, so that publishing it is a rename within the same file system rather than a copy
+        return self.dest.with_name(f'.{self.dest.name}.partial')
+
+    def publish(self):
+        with open(self.partial_dest_path, 'rb') as file:
+            os.fsync(file.fileno())
+
+        os.replace(self.partial_dest_path, self.dest)
+
+        # The rename itself is only durable once the directory containing it has been synced
+        dir_fd = os.open(self.dest.parent, os.O_RDONLY)
+
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def discard_partial(self):
+        self.partial_dest_path.unlink(missing_ok=True)
 
     def destroy(self):
         shutil.rmtree(self.workdir)
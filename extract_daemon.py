@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import signal
+import time
+
+from main import BulkTextExtract
+
+
+class ExtractionDaemon:
+    """Keeps a pool of warm partition workers alive and feeds it jobs dropped into a queue directory.
+
+    A job is a JSON file placed in ``<queue>/incoming``. It names either a directory to scan,
+    ``{"directory": "/library/physics"}``, or an explicit list of files, ``{"files": ["/a.pdf"]}``.
+    Jobs are claimed by renaming them into ``processing`` and end up in ``done`` or ``failed``.
+    """
+
+    poll_interval = 2
+    extractor = staticmethod(BulkTextExtract.textExtractor)
+
+    def __init__(self, queue_dir, max_num_threads=6, max_tasks_per_worker=None):
+        self.queue_dir = queue_dir
+        self.max_num_threads = max_num_threads
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.worker_settings = {
+            "cache_root": os.path.join(queue_dir, BulkTextExtract.mobi_cache_dir),
+            "source_root": None,
+            "output_root": None,
+        }
+        self.thread_pool = None
+
+        for name in ("incoming", "processing", "done", "failed"):
+            os.makedirs(self.job_dir(name), exist_ok=True)
+
+    def job_dir(self, name):
+        return os.path.join(self.queue_dir, name)
+
+    def requeue_interrupted_jobs(self):
+        """Returns jobs left in processing by a daemon that was stopped to the incoming queue."""
+        processing = self.job_dir("processing")
+        for filename in os.listdir(processing):
+            print(f"Requeueing interrupted job {filename}.")
+            os.replace(os.path.join(processing, filename), os.path.join(self.job_dir("incoming"), filename))
+
+    def claim_next_job(self):
+        """Moves the oldest incoming job into processing. Returns None if the queue is empty."""
+        incoming = self.job_dir("incoming")
+        for filename in sorted(os.listdir(incoming)):
+            if not filename.endswith(".json"):
+                continue
+            claimed = os.path.join(self.job_dir("processing"), filename)
+            try:
+                os.rename(os.path.join(incoming, filename), claimed)
+            except FileNotFoundError:
+                continue  # Claimed by another daemon sharing the queue
+            return claimed
+        return None
+
+    @staticmethod
+    def job_files(job):
+        if "files" in job:
+            return list(job["files"])
+        return sorted(BulkTextExtract.scan_directory(job["directory"]))
+
+    def run_job(self, job_path):
+        start_time = time.time()
+        with open(job_path, "r") as f:
+            job = json.load(f)
+
+        files = self.job_files(job)
+        print(f"Running job {os.path.basename(job_path)} with {len(files)} files.")
+        succeeded = set()
+        if len(files) > 0:
+            for result, _ in self.thread_pool.imap_unordered(
+                self.extractor,
+                files,
+                worker_init=BulkTextExtract.warm_up,
+                worker_lifespan=self.max_tasks_per_worker,
+            ):
+                if result is not None:
+                    succeeded.add(result)
+
+        job["documents"] = len(files)
+        job["succeeded"] = [file for file in files if file in succeeded]
+        job["failed"] = [file for file in files if file not in succeeded]
+        job["elapsed"] = time.time() - start_time
+        return job
+
+    def finish_job(self, job_path, job, outcome):
+        with open(os.path.join(self.job_dir(outcome), os.path.basename(job_path)), "w") as f:
+            json.dump(job, f, indent=4)
+        os.remove(job_path)
+
+    def open_pool(self):
+        from mpire import WorkerPool
+
+        return WorkerPool(n_jobs=self.max_num_threads, shared_objects=self.worker_settings, keep_alive=True)
+
+    def process_next_job(self):
+        """Runs the oldest incoming job, if any, and files it under done or failed. Returns False if the queue is empty."""
+        job_path = self.claim_next_job()
+        if job_path is None:
+            return False
+
+        try:
+            job = self.run_job(job_path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # A malformed job only fails itself
+            print(f"Job {os.path.basename(job_path)} failed: {e}")
+            self.finish_job(job_path, {"error": str(e)}, "failed")
+        else:
+            if len(job["failed"]) > 0:
+                print(f"Job {os.path.basename(job_path)} finished in {job['elapsed']:.2f}s with "
+                      f"{len(job['failed'])} of {job['documents']} documents failed.")
+                self.finish_job(job_path, job, "failed")
+            else:
+                print(f"Job {os.path.basename(job_path)} finished in {job['elapsed']:.2f}s.")
+                self.finish_job(job_path, job, "done")
+        return True
+
+    def serve_forever(self):
+        self.requeue_interrupted_jobs()
+        # Workers are forked from this process, so importing here warms every worker the pool ever starts.
+        BulkTextExtract.warm_up()
+        print(f"Watching {self.job_dir('incoming')} with {self.max_num_threads} workers.")
+
+        with self.open_pool() as self.thread_pool:
+            while True:
+                if not self.process_next_job():
+                    time.sleep(ExtractionDaemon.poll_interval)
+
+
+def raise_interrupt(signal_number, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve BulkTextExtract jobs from a queue directory using warm workers.")
+    parser.add_argument("queue_dir", help="Directory holding the incoming, processing, done and failed job folders.")
+    parser.add_argument("-n", "--workers", type=int, default=6, help="Number of partition workers to keep alive.")
+    parser.add_argument("--max-tasks-per-worker", type=int, default=None,
+                        help="Recycle a worker after this many documents to bound its memory. Unlimited by default.")
+    args = parser.parse_args()
+
+    daemon = ExtractionDaemon(args.queue_dir, args.workers, args.max_tasks_per_worker)
+    # Stopping the service behaves like Ctrl+C: workers are terminated and the running job stays in
+    # processing, from where it is requeued the next time the daemon starts.
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        print("\nExiting daemon...")
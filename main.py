@@ -1,18 +1,28 @@
+import argparse
+import contextlib
+import glob
 import logging
+import multiprocessing
 import os
 import json
 import time
 import shutil
+import signal
+import tempfile
+import hashlib
+import importlib
 from os.path import splitext
 
-import mobi
-from unstructured.partition.auto import partition
-from mpire import WorkerPool
-from unstructured.staging.base import elements_to_json
-from unstructured.cleaners.core import clean_non_ascii_chars, clean_extra_whitespace, group_broken_paragraphs, \
-    replace_unicode_quotes
-from unstructured.documents.elements import NarrativeText
-from unstructured.documents.elements import Title
+from async_io import AsyncFileIO
+from concurrency import ConcurrencyController
+from chunking import DEFAULT_MAX_CHARACTERS, DEFAULT_WINDOW_PAGES, StreamingChunker, iter_page_windows
+from dedup import DEFAULT_PREFERENCE, find_duplicates, get_format, group_candidates, link_output
+from metrics import Metrics
+from profiling import StackSampler, run_profiled, write_profile_report
+from segment_store import SegmentStoreProcess, element_records
+
+# unstructured, mobi and mpire take seconds to import. They are imported where they are used,
+# so --help, --status and the resume check start instantly.
 
 DEBUG = False
 def validate_directory(directory):
@@ -33,7 +43,7 @@ def dbg(msg, obj, alarm: int = 0):
         conv = str(obj)
     except TypeError:
         conv = "<Could not convert>"
-        
+
     print(f"DEBUG: {msg} --- attached object {conv}")
 
     if alarm == 1:
@@ -48,15 +58,28 @@ class BulkTextExtract:
         "chunking_strategy" : "by_title"
     }
     file_types_of_interest = ("pdf", "mobi", "epub")
+    mobi_extensions = (".MOBI", ".PRC", ".AZW", ".AZW3", ".AZW4")
+    mobi_cache_dir = ".mobi_cache"
+    hashing_buffer_size = 64 * 1024
+    progress_save_interval = 10 # seconds
 
-    def find_files(self):
+    @staticmethod
+    def scan_directory(directory, file_types=None):
         """Scans a directory and its subdirectories for files of specified types."""
+        file_types = tuple(file_types or BulkTextExtract.file_types_of_interest)
         files = set()
-        for root, _, filenames in os.walk(directory):
+        for root, dirnames, filenames in os.walk(directory):
+            # Converted books live in the cache and are reached through their MOBI source.
+            if BulkTextExtract.mobi_cache_dir in dirnames:
+                dirnames.remove(BulkTextExtract.mobi_cache_dir)
             for filename in filenames:
-                if filename.lower().endswith(BulkTextExtract.file_types_of_interest):
+                if filename.lower().endswith(file_types):
                     subj = os.path.join(root, filename)
                     files.add(subj)
+        return files
+
+    def find_files(self):
+        files = BulkTextExtract.scan_directory(self.directory, self.file_types)
         self.files = list(files.union(self.files))
         return files
 
@@ -68,157 +91,708 @@ class BulkTextExtract:
 
 
     @staticmethod
-    def save_progress(file, files, progress_index):
-        """Saves progress information to a JSON file."""
-        data = {"files": files, "progress_index": progress_index}
-        with open(file, "w") as f:
+    def save_progress(file, files, completed, duplicates=None):
+        """Saves progress information to a JSON file.
+
+        The file is replaced atomically, so an interruption leaves either the old or the new state behind.
+        """
+        data = {"files": files, "completed": sorted(completed), "duplicates": duplicates or {}}
+        temp_file = file + ".tmp"
+        with open(temp_file, "w") as f:
             json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, file)
+
+    def flush_progress(self):
+        BulkTextExtract.save_progress(self.progress_file, self.files, self.completed, self.duplicates)
+        self.last_progress_save = time.time()
 
     def attempt_load_progress(self):
         try:
             with open(self.progress_file, "r") as f:
                 data = json.load(f)
                 self.files = data.get("files")
-                self.progress_index = data.get("progress_index")
+                self.duplicates = data.get("duplicates", {})
+                if "completed" in data:
+                    self.completed = set(data["completed"])
+                else:
+                    # Progress files written before completion tracking only stored an index
+                    self.completed = set(self.files[:data.get("progress_index", 0)])
         except FileNotFoundError:
             self.files = None
-            self.progress_index = 0
+            self.completed = set()
+            self.duplicates = {}
+
+    @staticmethod
+    def get_file_fingerprint(path):
+        """Hashes the contents of a file, so moved or renamed copies share a fingerprint."""
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            data = f.read(BulkTextExtract.hashing_buffer_size)
+            while len(data) > 0:
+                h.update(data)
+                data = f.read(BulkTextExtract.hashing_buffer_size)
+        return h.hexdigest()
 
     @staticmethod
-    def convert_mobi(mobi_file_path):
-        tempdir, filepath = (None, None)
+    def find_unpacked_book(unpack_dir):
+        """Locates the book produced by kindleunpack, in the same order mobi.extract looks for it.
+
+        kindleunpack names the epub and pdf after the file it was given, so they are looked up by
+        pattern. Otherwise a renamed copy of a cached book would not find it.
+        """
+        patterns = [
+            os.path.join(glob.escape(unpack_dir), "mobi8", "*.epub"),
+            os.path.join(glob.escape(unpack_dir), "mobi7", "book.html"),
+            os.path.join(glob.escape(unpack_dir), "*.001.pdf"),
+        ]
+        for pattern in patterns:
+            candidates = sorted(glob.glob(pattern))
+            if len(candidates) > 0:
+                return candidates[0]
+        return None
+
+    @staticmethod
+    def convert_mobi(mobi_file_path, cache_root):
+        """Unpacks a MOBI book into a cache directory keyed by the fingerprint of the source.
+
+        Cached books are never unpacked again. Unpacking goes straight into the cache root, so
+        publishing the result is a single directory rename rather than a move out of a temp dir.
+        """
+        try:
+            fingerprint = BulkTextExtract.get_file_fingerprint(mobi_file_path)
+        except OSError as e:
+            print(f"Problem reading file {mobi_file_path}: {e.__str__()}")
+            return False
+
+        unpack_dir = os.path.join(cache_root, fingerprint)
+        cached = BulkTextExtract.find_unpacked_book(unpack_dir)
+        if cached is not None:
+            return cached
+
+        partial_dir = f"{unpack_dir}.{os.getpid()}.partial"
         try:
-            tempdir, filepath = mobi.extract(mobi_file_path)
+            from mobi.kindleunpack import unpackBook
+
+            os.makedirs(partial_dir, exist_ok=True)
+            unpackBook(mobi_file_path, partial_dir, epubver="A")
+            if BulkTextExtract.find_unpacked_book(partial_dir) is None:
+                raise ValueError("kindleunpack produced no epub, html or pdf")
         except Exception as e:
             print(f"Problem converting file {mobi_file_path}: {e.__str__()}")
-            if tempdir is not None and os.path.exists(tempdir):
-                shutil.rmtree(tempdir)
+            shutil.rmtree(partial_dir, ignore_errors=True)
             return False
-        else:
-            (head, tail) = os.path.split(mobi_file_path)
-            (root, oext) = os.path.splitext(tail)
 
-            (nhead, ntail) = os.path.split(filepath)
-            (nroot, next) = os.path.splitext(ntail)
+        try:
+            os.rename(partial_dir, unpack_dir)
+        except OSError:
+            # An identical book was published by another worker in the meantime.
+            shutil.rmtree(partial_dir, ignore_errors=True)
 
-            new_file = head+"/"+root + next
-            shutil.move(filepath, new_file)
-            shutil.rmtree(tempdir)
-            return new_file
+        return BulkTextExtract.find_unpacked_book(unpack_dir) or False
 
-    def begin_extract(self):
+    @staticmethod
+    def convert_mobi_task(cache_root, file):
+        return file, BulkTextExtract.convert_mobi(file, cache_root)
+
+    def convert_mobi_files(self, files):
+        """Converts MOBI books in a worker pool. Returns the converted book, or False, for every file.
+
+        The conversions land in the cache, so the extraction later reuses them.
+        """
+        from mpire import WorkerPool
+
+        if len(files) == 0:
+            return {}
+        cache_root = os.path.join(self.directory, BulkTextExtract.mobi_cache_dir)
+        with WorkerPool(n_jobs=min(self.max_num_threads, len(files)), shared_objects=cache_root) as pool:
+            return dict(pool.imap_unordered(BulkTextExtract.convert_mobi_task, files, iterable_len=len(files), chunk_size=1))
+
+    def detect_duplicates(self):
+        """Finds copies of the same book in other formats, so only the preferred copy is extracted."""
+        with self.metrics.stage("dedup"):
+            groups = group_candidates(self.files)
+            # Only MOBI books that may be copies of another file are converted for the comparison
+            converted = self.convert_mobi_files([file for group in groups for file in group if get_format(file) == "mobi"])
+            self.duplicates = find_duplicates(self.files, self.prefer, lambda file: converted.get(file, False), groups)
+        self.metrics.count("duplicates", len(self.duplicates))
+        print(f"Found {len(self.duplicates)} duplicates. They will be linked to the output of the preferred format.")
+
+    def link_duplicates(self, preferred):
+        """Links the outputs of the duplicates of a completed document to its output and marks them as completed."""
+        settings = self.worker_settings()
+        for duplicate, original in self.duplicates.items():
+            if original != preferred or duplicate in self.completed:
+                continue
+            if self.store is not None:
+                # Completed once the writer has committed the alias
+                self.store.alias(duplicate, BulkTextExtract.store_document_name(settings, duplicate),
+                                 BulkTextExtract.store_document_name(settings, original))
+                continue
+            try:
+                link_output(BulkTextExtract.segment_path(settings, original), BulkTextExtract.segment_path(settings, duplicate))
+            except OSError as e:
+                print(f"Could not link segments of {duplicate}: {e.__str__()}")
+                continue
+            self.completed.add(duplicate)
+
+    def worker_settings(self):
+        """Settings shared with every worker of the pool."""
+        return {
+            "cache_root": os.path.join(self.directory, BulkTextExtract.mobi_cache_dir),
+            "source_root": self.directory,
+            "output_root": self.output_dir if self.output_mode == "collect" else None,
+            "staging_root": os.path.join(self.staging_dir, "out") if self.staging_dir is not None and self.output_mode != "store" else None,
+            "store_queue": self.store.requests if self.store is not None else None,
+            "unstructured": self.unstructured_settings,
+            "profile_dir": self.profile_worker_dir(),
+            "stream_chunks": {
+                "strategy": self.unstructured_settings.get("chunking_strategy") or "by_title",
+                "max_characters": self.max_characters,
+                "window_pages": self.window_pages,
+            } if self.stream_chunks else None,
+        }
+
+    def profile_worker_dir(self):
+        return os.path.join(self.profile_dir, "workers") if self.profile_dir is not None else None
+
+    def write_profile(self, sampler):
+        """Merges the samples of this process and of every worker into collapsed stacks and a table of the top functions."""
+        sampler.active = False
+        sampler.dump(os.path.join(self.profile_worker_dir(), f"{os.getpid()}.json"))
+        write_profile_report(self.profile_worker_dir(), os.path.join(self.profile_dir, "profile.collapsed"),
+                             os.path.join(self.profile_dir, "profile.txt"))
+        print(f"Profile written to {self.profile_dir}.")
+
+    def collect_writes(self, io, drain=False):
+        """Marks the files whose segments have reached their destination as completed. Returns the number of failed writes.
+
+        io is an AsyncFileIO or a SegmentStoreProcess. If drain is set, waits for every pending write first.
+        """
+        failed = 0
+        if io is None:
+            return failed
+        # Completing a document can queue aliases of its duplicates, so a drain repeats until nothing is pending
+        while True:
+            completed = io.drain() if drain else io.completed_writes()
+            if len(completed) == 0:
+                return failed
+            for file, error in completed:
+                if error is None:
+                    self.thread_response_count_complete(file)
+                else:
+                    print(f"Could not write segments of {file}: {error.__str__()}")
+                    failed += 1
 
-        print("Looking for files that need conversion...")
-        for file in self.files:
-            ext = splitext(file)[-1].upper()
-            if ext in [".MOBI", ".PRC", ".AZW", ".AZW3", ".AZW4"]:
-                print(f"Converting {file} to an epub format...")
-                result = BulkTextExtract.convert_mobi(file)
+    def begin_extract(self):
+        """Extracts every file not completed yet. Returns False if the session was interrupted."""
+        from mpire import WorkerPool
 
-                if result is not False:
-                    print(f"Success: {result}")
-                    self.files[self.files.index(file)] = result
+        to_do = [file for file in self.files if file not in self.completed and file not in self.duplicates]
+        failed = 0
+        self.flush_progress()
 
         print("Spawning pool and beginning... This will take quite some time.")
-        with WorkerPool(n_jobs=self.max_num_threads) as self.thread_pool:
-            self.running_pool = True
-            to_do = self.files[self.progress_index:]
-            self.thread_pool.map_unordered(BulkTextExtract.textExtractor, to_do, progress_bar=True)
+        previous_handlers = {
+            signal_number: signal.signal(signal_number, self.signal_handler)
+            for signal_number in (signal.SIGINT, signal.SIGTERM)
+        }
+        io = None
+        try:
+            with contextlib.ExitStack() as stack:
+                if self.output_mode == "store":
+                    # A single process appends the segments of every worker to the store
+                    self.store = stack.enter_context(SegmentStoreProcess(self.output_dir, max_queued=2 * self.max_num_threads))
+                    stack.callback(setattr, self, "store", None)
+                settings = self.worker_settings()
+                settings["finished_tasks"] = multiprocessing.Value("i", 0)
+
+                # Duplicates whose preferred copy was completed before an interruption are linked right away
+                for preferred in set(self.duplicates.values()) & self.completed:
+                    self.link_duplicates(preferred)
+
+                tasks = to_do
+                if self.staging_dir is not None:
+                    # Workers read prefetched copies and write to local disk; the slow storage is only touched by the I/O threads.
+                    io = stack.enter_context(AsyncFileIO(self.staging_dir, max_threads=self.io_threads,
+                                                         prefetch_depth=2 * self.max_num_threads))
+                    tasks = io.prefetch(to_do)
+
+                # Documents are handed out one at a time, so fewer are extracted at once when memory runs low
+                controller = ConcurrencyController(self.min_workers, self.max_num_threads, self.min_available_memory * 2 ** 20)
+                tasks = controller.gate(tasks, settings["finished_tasks"])
+
+                self.thread_pool = stack.enter_context(WorkerPool(n_jobs=self.max_num_threads, shared_objects=settings))
+                self.running_pool = True
+                extractor = BulkTextExtract.textExtractor if self.profile_dir is None else BulkTextExtract.profiledTextExtractor
+                for result, snapshot in self.thread_pool.imap_unordered(extractor, tasks,
+                                                                        iterable_len=len(to_do), chunk_size=1,
+                                                                        worker_init=BulkTextExtract.init_worker,
+                                                                        progress_bar=True):
+                    self.metrics.merge(snapshot)
+                    if result is None:
+                        failed += 1
+                    elif self.store is not None:
+                        # Only completed once the writer has committed the segments
+                        self.store.expect()
+                    elif io is None:
+                        self.thread_response_count_complete(result)
+                    else:
+                        # Only completed once the segments have reached their destination
+                        io.write_behind(result, BulkTextExtract.staged_output_path(settings, result),
+                                        BulkTextExtract.segment_path(settings, result))
+                    failed += self.collect_writes(io) + self.collect_writes(self.store)
+
+                failed += self.collect_writes(io, drain=True)
+                failed += self.collect_writes(self.store, drain=True)
+        except KeyboardInterrupt:
+            # Leaving the pool context has terminated the workers. Their documents are not marked
+            # as completed, so they are extracted again when the session is resumed.
+            self.running_pool = False
+            self.flush_progress()
+            print(f"Stopped with {len(self.completed)} of {len(self.files)} files done. Run again to resume.")
+            return False
+        finally:
+            for signal_number, handler in previous_handlers.items():
+                signal.signal(signal_number, handler)
+
+        if failed > 0:
+            self.running_pool = False
+            self.flush_progress()
+            print(f"{failed} files failed. Run again to retry them.")
+        else:
+            self.complete_progress()
+        return True
 
-        self.complete_progress()
 
+    @staticmethod
+    def warm_up(*_):
+        """Imports the partitioners that unstructured would otherwise load lazily on the first document."""
+        for module in ("unstructured.partition.pdf", "unstructured.partition.epub", "unstructured.partition.html"):
+            importlib.import_module(module)
+
+    @staticmethod
+    def segment_suffix(settings):
+        return "_chunks.jsonl" if settings.get("stream_chunks") is not None else "_raw.json"
+
+    @staticmethod
+    def segment_path(settings, file):
+        """Where the segments of a document are written for the configured output mode.
+
+        By default they go next to the source. When an output root is set, the directory
+        layout below the scanned directory is mirrored inside it instead.
+        """
+        dir = os.path.dirname(file)
+        if settings.get("output_root") is not None:
+            relative_dir = os.path.relpath(dir, settings["source_root"])
+            dir = os.path.normpath(os.path.join(settings["output_root"], relative_dir))
+
+        document_name = os.path.splitext(os.path.basename(file))[0].replace(".", "_")
+        return os.path.join(dir, document_name, document_name + BulkTextExtract.segment_suffix(settings))
+
+    @staticmethod
+    def store_document_name(settings, file):
+        """The name of a document in the segment store: its path below the scanned directory."""
+        return os.path.relpath(file, settings["source_root"])
+
+    @staticmethod
+    def staged_output_path(settings, file):
+        """Where a worker writes the segments of a document before they are copied to segment_path."""
+        name = hashlib.sha1(file.encode("utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(settings["staging_root"], name + BulkTextExtract.segment_suffix(settings))
 
     @staticmethod
-    def textExtractor(file):
+    def profiledTextExtractor(settings, file, staged=None):
+        """textExtractor, sampling the stack of the worker and writing its samples to the profile directory."""
+        return run_profiled(settings["profile_dir"], BulkTextExtract.textExtractor, settings, file, staged)
+
+    @staticmethod
+    def textExtractor(settings, file, staged=None):
+        """Extracts one document in a worker.
+
+        staged is a local copy of the file, if it has been prefetched. Returns the file if its segments
+        were saved (None otherwise) along with the metrics of the document.
+        """
+        metrics = Metrics()
+        try:
+            with metrics.stage("document"):
+                result = BulkTextExtract.extract_document(settings, file, metrics, staged)
+        except Exception as e:
+            # A document the parsers choke on must not take down the pool, and with it the whole session
+            print(f"Problem extracting {file}: {e.__class__.__name__}: {e.__str__()}")
+            dbg(f"Exception logging {file}", e)
+            result = None
+        finally:
+            if staged is not None:
+                shutil.rmtree(os.path.dirname(staged), ignore_errors=True)
+            if settings.get("finished_tasks") is not None:
+                with settings["finished_tasks"].get_lock():
+                    settings["finished_tasks"].value += 1
+        return result, metrics.as_dict()
+
+    @staticmethod
+    def clean_elements(elements):
+        from unstructured.cleaners.core import clean_non_ascii_chars, clean_extra_whitespace, group_broken_paragraphs, \
+            replace_unicode_quotes
+        from unstructured.documents.elements import NarrativeText
+        from unstructured.documents.elements import Title
+
+        for element in elements:
+            if isinstance(element, (NarrativeText, Title)):
+                element.apply(clean_non_ascii_chars, clean_extra_whitespace, group_broken_paragraphs, replace_unicode_quotes)
+
+    @staticmethod
+    def extract_document_streaming(settings, file, source, metrics):
+        """Partitions a document window by window and writes its chunks as JSON lines as soon as they are closed.
+
+        Other processes can follow the .partial file while the document is being extracted. With the
+        segment store, the serialized chunks are sent once the document is done.
+        """
+        from unstructured.partition.auto import partition
+
+        stream_settings = settings["stream_chunks"]
+        # Chunking happens here rather than after the whole document has been partitioned
+        partition_settings = {key: value for key, value in settings.get("unstructured", BulkTextExtract.unstructured_settings).items()
+                              if key != "chunking_strategy"}
+        chunker = StreamingChunker(stream_settings["strategy"], stream_settings["max_characters"],
+                                   filename=os.path.basename(file))
+
+        if settings.get("store_queue") is not None:
+            segment_filepath = None
+            records = []
+        elif settings.get("staging_root") is not None:
+            segment_filepath = BulkTextExtract.staged_output_path(settings, file)
+        else:
+            segment_filepath = BulkTextExtract.segment_path(settings, file)
+
+        window_dir = tempfile.mkdtemp(prefix="windows_")
+        chunk_count = 0
+        try:
+            with contextlib.ExitStack() as stack:
+                if segment_filepath is not None:
+                    os.makedirs(os.path.dirname(segment_filepath), exist_ok=True)
+                    temp_filepath = segment_filepath + ".partial"
+                    out = stack.enter_context(open(temp_filepath, "w"))
+
+                def emit(chunks):
+                    with metrics.stage("serialize") as record:
+                        for chunk in chunks:
+                            if segment_filepath is None:
+                                records.extend(element_records([chunk]))
+                                record.bytes_out += len(records[-1][2])
+                            else:
+                                line = json.dumps(chunk) + "\n"
+                                out.write(line)
+                                record.bytes_out += len(line)
+                        if segment_filepath is not None:
+                            out.flush()
+                    return len(chunks)
+
+                try:
+                    for window, preceding_pages in iter_page_windows(source, window_dir, stream_settings["window_pages"]):
+                        with metrics.stage("partition", bytes_in=os.path.getsize(window)):
+                            elements = partition(filename=window, **partition_settings)
+                        with metrics.stage("clean"):
+                            BulkTextExtract.clean_elements(elements)
+                        metrics.count("elements", len(elements))
+                        for element in elements:
+                            if element.metadata.page_number is not None:
+                                element.metadata.page_number += preceding_pages
+                            chunk_count += emit(chunker.feed(element))
+                except OSError as e:
+                    print(f"There was a problem partitioning {file}. Logging information.")
+                    dbg(f"OSError logging {file}", e)
+                    chunk_count += emit(chunker.flush())
+                    chunk_count += emit([{"type": "Error", "text": f"Failed to partition {file}", "metadata": {}}])
+                chunk_count += emit(chunker.flush())
+                metrics.count("chunks", chunk_count)
+
+            if segment_filepath is None:
+                # Blocks while the writer is behind
+                settings["store_queue"].put((file, BulkTextExtract.store_document_name(settings, file), records))
+                print(f"Sent {chunk_count} chunks to the store.")
+            else:
+                os.replace(temp_filepath, segment_filepath)
+                print(f"Saved {chunk_count} chunks.")
+        except (ValueError, IOError) as e:
+            dbg("Failed to save chunks. Logging details. Skipping to next file.", e, 1)
+            return None
+        finally:
+            shutil.rmtree(window_dir, ignore_errors=True)
+
+        return file
+
+    @staticmethod
+    def extract_document(settings, file, metrics, staged=None):
+        from unstructured.partition.auto import partition
+        from unstructured.staging.base import elements_to_json
 
         global DEBUG
         print(f"\nExtracting text from {file}")
+        source = staged or file
+        if splitext(file)[-1].upper() in BulkTextExtract.mobi_extensions:
+            # Converting inside the worker overlaps unpacking with the partitioning of other files.
+            with metrics.stage("convert", bytes_in=os.path.getsize(source)) as record:
+                source = BulkTextExtract.convert_mobi(source, settings["cache_root"])
+            if source is False:
+                return None
+            record.bytes_out = os.path.getsize(source)
+
+        if settings.get("stream_chunks") is not None:
+            return BulkTextExtract.extract_document_streaming(settings, file, source, metrics)
+
         if DEBUG == True:
             time.sleep(1)
             elements = ["test","test"]
         else:
             try:
-                elements = partition(filename=file, **BulkTextExtract.unstructured_settings)
-                for element in elements:
-                    if isinstance(element, (NarrativeText, Title)):
-                        element.apply(clean_non_ascii_chars, clean_extra_whitespace, group_broken_paragraphs, replace_unicode_quotes)
+                with metrics.stage("partition", bytes_in=os.path.getsize(source)):
+                    elements = partition(filename=source, **settings.get("unstructured", BulkTextExtract.unstructured_settings))
+                with metrics.stage("clean"):
+                    BulkTextExtract.clean_elements(elements)
+                metrics.count("elements", len(elements))
 
             except OSError as e:
                 elements = ["Error", f"Failed to partition {file}"]
                 print(f"There was a problem partitioning {file}. Logging information.")
                 dbg(f"OSError logging {file}", e)
-        try:
-
-            dir = os.path.dirname(file)
-            document_name = os.path.splitext(os.path.basename(file))[0].replace(".", "_")
-            segment_dir = os.path.join(dir, document_name)
-            os.makedirs(segment_dir, exist_ok=True)  
-            segment_filename = f"{document_name}_raw.json"
-            segment_filepath = os.path.join(segment_dir, segment_filename)
+        if settings.get("store_queue") is not None:
+            with metrics.stage("serialize") as record:
+                records = element_records(elements)
+                record.bytes_out = sum(len(data) for _, _, data in records)
+                # Blocks while the writer is behind
+                settings["store_queue"].put((file, BulkTextExtract.store_document_name(settings, file), records))
+            print(f"Sent {len(elements)} segments to the store.")
+            return file
 
+        try:
 
-            elements_to_json(elements, filename=segment_filepath, indent=4)
+            if settings.get("staging_root") is not None:
+                segment_filepath = BulkTextExtract.staged_output_path(settings, file)
+            else:
+                segment_filepath = BulkTextExtract.segment_path(settings, file)
+            os.makedirs(os.path.dirname(segment_filepath), exist_ok=True)
+
+            # Write next to the destination and rename, so an interrupted worker never leaves a truncated file
+            temp_filepath = segment_filepath + ".partial"
+            with metrics.stage("serialize") as record:
+                elements_to_json(elements, filename=temp_filepath, indent=4)
+                os.replace(temp_filepath, segment_filepath)
+                record.bytes_out = os.path.getsize(segment_filepath)
             print(f"Saved {len(elements)} segments.")
-            
-        except (ValueError or IOError) as e:
+
+        except (ValueError, IOError) as e:
             dbg("Failed to save segments. Logging details. Skipping to next file.",e ,1)
+            return None
+
+        return file
 
     def signal_handler(self, signal_number, frame):
-        print("\nReceived signal, terminating threads...")
-        self.thread_pool.terminate()  # Terminate threads immediately
-        self.thread_pool.join()  # Wait for termination to complete
+        # A repeated signal must not interrupt the shutdown halfway, but can still end one that hangs
+        signal.signal(signal.SIGINT, BulkTextExtract.force_exit_handler)
+        signal.signal(signal.SIGTERM, BulkTextExtract.force_exit_handler)
+        print(f"\nReceived signal {signal_number}, cancelling in-flight documents... Send it again to exit immediately.")
+        raise KeyboardInterrupt
 
-    def thread_response_count_complete(self):
-        self.progress_index += 1
-        print(f"Finished conversion. Done: {self.progress_index}")
+    @staticmethod
+    def force_exit_handler(signal_number, frame):
+        print(f"\nReceived signal {signal_number} again, exiting without saving progress.")
+        os._exit(128 + signal_number)
 
-    def __init__(self, directory):
+    @staticmethod
+    def init_worker(*_):
+        """Leaves Ctrl+C to the parent, which terminates the pool, rather than interrupting documents in every worker.
+
+        Workers are forked after the parent has installed its handlers, which would otherwise be inherited.
+        """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def thread_response_count_complete(self, file):
+        self.completed.add(file)
+        self.link_duplicates(file)
+        print(f"Finished conversion. Done: {len(self.completed)}")
+        if time.time() - self.last_progress_save >= BulkTextExtract.progress_save_interval:
+            self.flush_progress()
+
+    def __init__(self, directory, max_num_threads=6, file_types=None, output_mode="beside", output_dir=None,
+                 metrics_path=None, unstructured_settings=None, staging_dir=None, io_threads=4, dedup=False,
+                 prefer=DEFAULT_PREFERENCE, stream_chunks=False, max_characters=DEFAULT_MAX_CHARACTERS,
+                 window_pages=DEFAULT_WINDOW_PAGES, min_workers=1, min_available_memory=512, profile_dir=None):
         self.running_pool = False
         self.directory = validate_directory(directory)
-
-        if not self.directory:
-            print("Couldn't find directory. Exiting")
-            return
-
-        self.progress_file = self.directory+"/progress.json"
-        self.max_num_threads = 6
+        self.max_num_threads = max_num_threads
+        self.min_workers = min_workers
+        self.min_available_memory = min_available_memory
+        self.file_types = tuple(file_types or BulkTextExtract.file_types_of_interest)
+        self.output_mode = output_mode
+        self.output_dir = output_dir
+        self.unstructured_settings = unstructured_settings or BulkTextExtract.unstructured_settings
         self.thread_pool = None
+        self.files = list()
+        self.completed = set()
+        self.duplicates = {}
+        self.dedup = dedup
+        self.prefer = tuple(prefer)
+        self.last_progress_save = 0
+        self.metrics = Metrics()
+        self.metrics_path = metrics_path
+        self.profile_dir = profile_dir
+        self.staging_dir = staging_dir
+        self.io_threads = io_threads
+        self.store = None
+        self.stream_chunks = stream_chunks
+        self.max_characters = max_characters
+        self.window_pages = window_pages
+
+        if self.directory:
+            self.progress_file = self.directory+"/progress.json"
+
+    def print_status(self):
+        """Reports the state of a previous session without starting any work."""
+        self.attempt_load_progress()
+        if self.files is None:
+            print("No previous session in directory.")
+        else:
+            print(f"Previous session: {len(self.completed)} of {len(self.files)} files done.")
 
+    def run(self, resume="resume"):
+        """Runs a whole session.
 
-
-        self.progress_index = 0
+        resume decides what happens to a previous session found in the directory: "resume" continues
+        with its file list, "rescan" adds newly found files to it and "restart" discards it.
+        """
         try:
             print("Looking for previous session in directory.")
+            files_found = None
+            sampler = None
+            if self.profile_dir is not None:
+                # Samples from a previous run would be merged into this one
+                shutil.rmtree(self.profile_worker_dir(), ignore_errors=True)
+                os.makedirs(self.profile_worker_dir())
+                # Workers are forked before they start their own sampler, so this one only samples this process
+                sampler = StackSampler()
+                sampler.active = True
             self.attempt_load_progress()
+            if self.files is not None and resume == "restart":
+                print("Discarding previous session.")
+                self.complete_progress()
+                self.files = None
+                self.completed = set()
+                self.duplicates = {}
+
             if self.files is None:
                 self.files = list()
                 print("Didn't find anything to resume. Let's scan.")
                 files_found = self.find_files()
                 print(f"Found {len(files_found)} applicable files.")
+            elif resume == "rescan":
+                print("Scanning for new list.")
+                files_found = self.find_files()
+                print(f"Found {len(files_found)} applicable files.")
             else:
-                input("Found a progress file. Continue?")
-                response = input("Begin conversion?").lower()
-                if response != 'y':
-                    print("Scanning for new list.")
-                    files_found = self.find_files()
-                    print(f"Found {len(files_found)} applicable files.")
-
-            response = input("Begin conversion?").lower()
-            if response != 'y':
-                print("Response wasn't y. Breaking.")
-                return
-
-            self.begin_extract()
-
-        except KeyboardInterrupt:  # Handle Ctrl+C
-            if self.thread_pool is not None:
-                self.thread_pool.terminate()
+                print(f"Resuming previous session with {len(self.completed)} of {len(self.files)} files done.")
+
+            # A resumed session keeps the duplicates found when it was started
+            if self.dedup and (files_found is not None or not self.duplicates):
+                self.detect_duplicates()
+
+            start_time = time.time()
+            try:
+                self.begin_extract()
+            finally:
+                if self.metrics_path is not None:
+                    self.metrics.export(self.metrics_path, run_seconds=time.time() - start_time)
+                    print(f"Metrics written to {self.metrics_path}.")
+                if sampler is not None:
+                    self.write_profile(sampler)
+
+        except KeyboardInterrupt:  # Ctrl+C before the pool started; nothing to save yet
             print("\nExiting program...")
-            self.save_progress()
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extract and segment text from every document in a directory.")
+    parser.add_argument("directory", help="Directory to scan for documents.")
+    parser.add_argument("-n", "--workers", type=int, default=6, help="Number of partition workers.")
+    parser.add_argument("--min-workers", type=int, default=1,
+                        help="Extract at least this many documents at once, even when memory runs low. Default: %(default)s.")
+    parser.add_argument("--min-available-memory", type=int, default=512,
+                        help="Extract fewer documents at once, down to --min-workers, while less than this many MiB of "
+                             "memory are available. More are extracted again, up to --workers, once there is room. "
+                             "Only supported on Linux. Default: %(default)s.")
+    parser.add_argument("-f", "--formats", default=",".join(BulkTextExtract.file_types_of_interest),
+                        help="Comma-separated file extensions to extract. Default: %(default)s.")
+    parser.add_argument("--output-mode", choices=("beside", "collect", "store"), default="beside",
+                        help="Write segments next to each source (beside), into --output-dir, mirroring the "
+                             "layout of the scanned directory (collect), or append them to a memory-mappable "
+                             "segment store in --output-dir (store).")
+    parser.add_argument("-o", "--output-dir", help="Output directory for --output-mode=collect and store.")
+    parser.add_argument("--resume", choices=("resume", "rescan", "restart"), default="resume",
+                        help="What to do with a previous session: continue it, continue it after adding newly "
+                             "found files, or discard it. Default: %(default)s.")
+    parser.add_argument("--status", action="store_true", help="Report the previous session and exit.")
+    parser.add_argument("--metrics", help="Write per-stage timings, byte counts and peak worker memory to this file. "
+                                          "Prometheus textfile format if it ends with .prom, JSON otherwise.")
+    parser.add_argument("--profile", help="Sample the stacks of this process and of every worker and write them to this "
+                                          "directory, merged into flamegraph-compatible collapsed stacks "
+                                          "(profile.collapsed) and a table of the functions found in the most "
+                                          "samples (profile.txt).")
+    parser.add_argument("--staging-dir", help="Local directory for prefetched sources and finished segments. Sources are "
+                                              "copied there ahead of the workers and segments are copied to their "
+                                              "destination in the background, so workers never wait on slow storage.")
+    parser.add_argument("--io-threads", type=int, default=4,
+                        help="Number of threads copying files to and from --staging-dir. Default: %(default)s.")
+    parser.add_argument("--stream-chunks", action="store_true",
+                        help="Chunk while partitioning instead of after, and write each chunk to <name>_chunks.jsonl "
+                             "as soon as its section closes. PDFs are partitioned --window-pages pages at a time if "
+                             "pypdf is installed, which bounds the memory used per document.")
+    parser.add_argument("--max-characters", type=int, default=DEFAULT_MAX_CHARACTERS,
+                        help="Maximum length of a chunk for --stream-chunks. Default: %(default)s.")
+    parser.add_argument("--window-pages", type=int, default=DEFAULT_WINDOW_PAGES,
+                        help="Pages partitioned at a time for --stream-chunks. Default: %(default)s.")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Extract only one copy of books found in several formats and link the outputs of the "
+                             "other copies to it. Copies are found by title and confirmed by comparing sampled text.")
+    parser.add_argument("--prefer", default=",".join(DEFAULT_PREFERENCE),
+                        help="Comma-separated formats in order of preference for --dedup. Default: %(default)s.")
+    args = parser.parse_args(argv)
+
+    if args.output_mode in ("collect", "store") and args.output_dir is None:
+        parser.error(f"--output-mode={args.output_mode} requires --output-dir.")
+
+    return args
+
 
 if __name__ == "__main__":
+    args = parse_args()
     logging.basicConfig(filename=dbg_file, filemode='w', format='%(name)s - %(levelname)s - %(message)s')
-    directory = input("Enter the directory to scan: ")
-    app = BulkTextExtract(directory)
\ No newline at end of file
+
+    app = BulkTextExtract(
+        args.directory,
+        max_num_threads=args.workers,
+        min_workers=args.min_workers,
+        min_available_memory=args.min_available_memory,
+        file_types=[ext.strip().lower() for ext in args.formats.split(",") if ext.strip()],
+        output_mode=args.output_mode,
+        output_dir=args.output_dir and os.path.abspath(args.output_dir),
+        metrics_path=args.metrics and os.path.abspath(args.metrics),
+        profile_dir=args.profile and os.path.abspath(args.profile),
+        staging_dir=args.staging_dir and os.path.abspath(args.staging_dir),
+        io_threads=args.io_threads,
+        stream_chunks=args.stream_chunks,
+        max_characters=args.max_characters,
+        window_pages=args.window_pages,
+        dedup=args.dedup,
+        prefer=[ext.strip().lower() for ext in args.prefer.split(",") if ext.strip()],
+    )
+
+    if not app.directory:
+        print("Couldn't find directory. Exiting")
+        raise SystemExit(1)
+
+    if args.status:
+        app.print_status()
+    else:
+        app.run(args.resume)
@@ -0,0 +1,140 @@
+import json
+import math
+import os
+import resource
+import sys
+from contextlib import contextmanager
+from time import perf_counter
+
+PERCENTILES = (50, 90, 99)
+
+
+def get_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class StageRecord:
+    def __init__(self, bytes_in=0):
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+
+
+class Metrics:
+    """Per-stage durations, byte counts and counters of an extraction run.
+
+    Each worker task fills its own instance and returns as_dict(). The parent merges those
+    snapshots and writes one report per run, as JSON or as a Prometheus textfile.
+    """
+
+    prefix = "bulk_text_extract"
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.workers = {}
+
+    def record(self, name, seconds, bytes_in=0, bytes_out=0):
+        stage = self.stages.setdefault(name, {"samples": [], "bytes_in": 0, "bytes_out": 0})
+        stage["samples"].append(seconds)
+        stage["bytes_in"] += bytes_in
+        stage["bytes_out"] += bytes_out
+
+    @contextmanager
+    def stage(self, name, bytes_in=0):
+        record = StageRecord(bytes_in)
+        start_time = perf_counter()
+        try:
+            yield record
+        finally:
+            self.record(name, perf_counter() - start_time, record.bytes_in, record.bytes_out)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        return {
+            "stages": self.stages,
+            "counters": self.counters,
+            "workers": {**self.workers, str(os.getpid()): get_peak_rss()},
+        }
+
+    def merge(self, snapshot):
+        if snapshot is None:
+            return
+        for name, other in snapshot["stages"].items():
+            stage = self.stages.setdefault(name, {"samples": [], "bytes_in": 0, "bytes_out": 0})
+            stage["samples"].extend(other["samples"])
+            stage["bytes_in"] += other["bytes_in"]
+            stage["bytes_out"] += other["bytes_out"]
+        for name, amount in snapshot["counters"].items():
+            self.count(name, amount)
+        for pid, peak_rss in snapshot["workers"].items():
+            self.workers[pid] = max(peak_rss, self.workers.get(pid, 0))
+
+    def summary(self, run_seconds):
+        stages = {}
+        for name, stage in self.stages.items():
+            samples = stage["samples"]
+            stages[name] = {
+                "count": len(samples),
+                "seconds": sum(samples),
+                "max_seconds": max(samples),
+                "bytes_in": stage["bytes_in"],
+                "bytes_out": stage["bytes_out"],
+                **{f"p{p}_seconds": percentile(samples, p) for p in PERCENTILES},
+            }
+        return {
+            "run_seconds": run_seconds,
+            "stages": stages,
+            "counters": dict(self.counters),
+            "workers": {**self.workers, str(os.getpid()): get_peak_rss()},
+        }
+
+    def to_prometheus(self, run_seconds):
+        summary = self.summary(run_seconds)
+        prefix = Metrics.prefix
+        lines = [
+            f"# HELP {prefix}_run_seconds Wall-clock duration of the run.",
+            f"# TYPE {prefix}_run_seconds gauge",
+            f"{prefix}_run_seconds {run_seconds:.6f}",
+        ]
+
+        stage_metrics = [
+            ("stage_seconds_total", "seconds", "Time spent in each stage, summed over workers."),
+            ("stage_calls_total", "count", "Number of times each stage ran."),
+            ("stage_bytes_in_total", "bytes_in", "Bytes read by each stage."),
+            ("stage_bytes_out_total", "bytes_out", "Bytes written by each stage."),
+        ]
+        for metric, key, help_text in stage_metrics:
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            lines.extend(f'{prefix}_{metric}{{stage="{name}"}} {stage[key]}' for name, stage in summary["stages"].items())
+
+        for name, amount in summary["counters"].items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {amount}")
+
+        lines.append(f"# HELP {prefix}_worker_peak_rss_bytes Peak resident set size of each process.")
+        lines.append(f"# TYPE {prefix}_worker_peak_rss_bytes gauge")
+        lines.extend(f'{prefix}_worker_peak_rss_bytes{{pid="{pid}"}} {rss}' for pid, rss in summary["workers"].items())
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, run_seconds):
+        """Writes a JSON report, or a Prometheus textfile if the path ends with .prom."""
+        if path.endswith(".prom"):
+            content = self.to_prometheus(run_seconds)
+        else:
+            content = json.dumps(self.summary(run_seconds), indent=4)
+
+        # The textfile collector may read at any moment, so only ever expose complete files
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(content)
+        os.replace(temp_path, path)
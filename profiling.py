@@ -0,0 +1,104 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005
+TOP_N = 30
+
+
+def get_frame_label(code):
+    # Semicolons separate the frames of collapsed stacks
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class StackSampler:
+    """Periodically records the Python stack of the main thread from a background thread.
+
+    Unlike cProfile, this adds no overhead to function calls, and time spent in C code is attributed
+    to the Python function that called it. Frames above root_code, i.e. the pool machinery that
+    invoked the profiled code, are omitted.
+    """
+
+    def __init__(self, root_code=None, interval=SAMPLE_INTERVAL):
+        self.stacks = Counter()
+        self.active = False
+        self.thread_id = threading.main_thread().ident
+        self.root_code = root_code
+        self.interval = interval
+        threading.Thread(target=self.run, name="stack_sampler", daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None and frame.f_code is not self.root_code:
+                labels.append(get_frame_label(frame.f_code))
+                frame = frame.f_back
+            if len(labels) > 0:
+                self.stacks[";".join(reversed(labels))] += 1
+
+    def dump(self, path):
+        # The counts are cumulative, so every dump replaces the previous one
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(dict(self.stacks), f)
+        os.replace(temp_path, path)
+
+
+# Every worker starts a sampler with its first profiled task
+worker_sampler = None
+
+
+def run_profiled(profile_dir, func, *args):
+    """Runs a task while sampling its stack, and writes the samples of the worker so far to profile_dir."""
+    global worker_sampler
+    if worker_sampler is None:
+        worker_sampler = StackSampler(root_code=run_profiled.__code__)
+    worker_sampler.active = True
+    try:
+        return func(*args)
+    finally:
+        worker_sampler.active = False
+        worker_sampler.dump(os.path.join(profile_dir, f"{os.getpid()}.json"))
+
+
+def merge_profiles(profile_dir):
+    stacks = Counter()
+    for name in os.listdir(profile_dir):
+        if name.endswith(".json"):
+            with open(os.path.join(profile_dir, name)) as f:
+                stacks.update(json.load(f))
+    return stacks
+
+
+def format_top_functions(stacks, top_n=TOP_N):
+    """A table of the functions found in the most samples, both on top of the stack and anywhere in it."""
+    own_samples = Counter()
+    total_samples = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own_samples[frames[-1]] += count
+        for frame in set(frames):
+            total_samples[frame] += count
+
+    sample_count = max(sum(stacks.values()), 1)
+    lines = [f"{'Own':>8} {'Own%':>6} {'Total':>8} {'Total%':>6}  Function"]
+    for frame, total in total_samples.most_common(top_n):
+        own = own_samples[frame]
+        lines.append(f"{own:>8} {100 * own / sample_count:>6.1f} {total:>8} {100 * total / sample_count:>6.1f}  {frame}")
+    return "\n".join(lines) + "\n"
+
+
+def write_profile_report(profile_dir, collapsed_path, table_path):
+    """Merges the samples of all processes into flamegraph-compatible collapsed stacks and a table of the top functions."""
+    stacks = merge_profiles(profile_dir)
+    with open(collapsed_path, "w") as f:
+        f.writelines(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+    with open(table_path, "w") as f:
+        f.write(format_top_functions(stacks))
@@ -0,0 +1,303 @@
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import signal
+import struct
+from collections import namedtuple
+
+DATA_FILE = "segments.dat"
+INDEX_FILE = "index.dat"
+CATALOG_FILE = "catalog.json"
+# offset and length of the serialized element in the data file, document id, page number (0 if unknown) and type id
+INDEX_ENTRY = struct.Struct("<QIIIH2x")
+
+IndexEntry = namedtuple("IndexEntry", ("offset", "length", "document", "page", "type"))
+
+
+def element_records(elements):
+    """Serializes elements, or chunks as dicts, for the store. Returns (page, type, bytes) for every element."""
+    records = []
+    for element in elements:
+        if hasattr(element, "to_dict"):
+            data = element.to_dict()
+        elif isinstance(element, dict):
+            data = element
+        else:
+            data = {"type": "Text", "text": str(element)}
+        page = (data.get("metadata") or {}).get("page_number") or 0
+        records.append((page, data.get("type", ""), json.dumps(data).encode("utf-8")))
+    return records
+
+
+def read_catalog(directory):
+    try:
+        with open(os.path.join(directory, CATALOG_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"data_size": 0, "index_count": 0, "types": [], "documents": {}, "aliases": {}}
+
+
+def map_file(path, size):
+    if size == 0:
+        return None
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+
+class SegmentStore:
+    """Reads a segment store through memory maps.
+
+    The store holds the elements of every document in one append-only data file. A binary index
+    locates each element by document, page and element type, and the catalog names the documents
+    and records how much of both files is committed. Only committed data is visible, so a store
+    can be read while it is being written.
+    """
+
+    def __init__(self, directory):
+        self.catalog = read_catalog(directory)
+        self.data = map_file(os.path.join(directory, DATA_FILE), self.catalog["data_size"])
+        self.index = map_file(os.path.join(directory, INDEX_FILE), self.catalog["index_count"] * INDEX_ENTRY.size)
+        self.aliases = self.catalog.get("aliases", {})
+        self.names = {document["id"]: name for name, document in self.catalog["documents"].items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for mapped in (self.data, self.index):
+            if mapped is not None:
+                mapped.close()
+
+    def documents(self):
+        """The names of the extracted documents and of their aliases."""
+        return list(self.catalog["documents"]) + list(self.aliases)
+
+    def entries(self, document=None, page=None, element_type=None):
+        """Yields the index entries matching the given document, page and element type.
+
+        Scans without a document report elements under the extracted document rather than its aliases.
+        """
+        if document is not None:
+            # Aliases are resolved here, so they follow later extractions of their original
+            resolved = self.aliases.get(document, document)
+            if resolved not in self.catalog["documents"]:
+                return
+            # The elements of a document are indexed contiguously
+            first = self.catalog["documents"][resolved]["first"]
+            last = first + self.catalog["documents"][resolved]["count"]
+        else:
+            first, last = 0, self.catalog["index_count"]
+
+        for position in range(first, last):
+            offset, length, document_id, entry_page, type_id = INDEX_ENTRY.unpack_from(self.index, position * INDEX_ENTRY.size)
+            if document is None and document_id not in self.names:
+                continue  # Superseded by a later extraction of the same document
+            if page is not None and entry_page != page:
+                continue
+            if element_type is not None and self.catalog["types"][type_id] != element_type:
+                continue
+            name = document if document is not None else self.names[document_id]
+            yield IndexEntry(offset, length, name, entry_page, self.catalog["types"][type_id])
+
+    def segment(self, entry):
+        """The serialized element of an entry, as a view of the mapped data file. Release it before closing the store."""
+        return memoryview(self.data)[entry.offset:entry.offset + entry.length]
+
+    def element(self, entry):
+        with self.segment(entry) as view:
+            return json.loads(bytes(view))
+
+
+class SegmentStoreWriter:
+    """Appends documents to a segment store. A store must only have one writer at a time.
+
+    Anything written after the last commit is discarded when the store is opened again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.catalog = read_catalog(directory)
+        self.data = self.open_committed(DATA_FILE, self.catalog["data_size"])
+        self.index = self.open_committed(INDEX_FILE, self.catalog["index_count"] * INDEX_ENTRY.size)
+        self.type_ids = {name: i for i, name in enumerate(self.catalog["types"])}
+        self.next_document_id = max((document["id"] for document in self.catalog["documents"].values()), default=-1) + 1
+
+    def open_committed(self, name, size):
+        f = open(os.path.join(self.directory, name), "ab")
+        f.truncate(size)
+        return f
+
+    def discard_uncommitted(self):
+        for f, size in ((self.data, self.catalog["data_size"]), (self.index, self.catalog["index_count"] * INDEX_ENTRY.size)):
+            try:
+                f.flush()
+            except OSError:
+                pass  # Whatever is still buffered lies beyond the committed size anyway
+            f.truncate(size)
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def get_type_id(self, element_type):
+        if element_type not in self.type_ids:
+            self.type_ids[element_type] = len(self.catalog["types"])
+            self.catalog["types"].append(element_type)
+        return self.type_ids[element_type]
+
+    def append_document(self, name, records):
+        """Appends the (page, type, bytes) records of a document. A document appended again replaces the earlier one.
+
+        The catalog only changes once the whole document has been written. If writing fails, the next
+        commit still describes the previous state and the partial document is discarded on reopening.
+        """
+        document = {"id": self.next_document_id, "first": self.catalog["index_count"], "count": len(records)}
+        data_size = self.catalog["data_size"]
+        try:
+            for page, element_type, data in records:
+                self.data.write(data)
+                self.index.write(INDEX_ENTRY.pack(data_size, len(data), document["id"], page, self.get_type_id(element_type)))
+                data_size += len(data)
+        except OSError:
+            # Later documents are appended where this one started, so their offsets stay right
+            self.discard_uncommitted()
+            raise
+
+        self.next_document_id += 1
+        self.catalog["data_size"] = data_size
+        self.catalog["index_count"] += len(records)
+        self.catalog["documents"][name] = document
+        self.catalog.setdefault("aliases", {}).pop(name, None)
+
+    def alias(self, name, original):
+        """Makes name refer to the elements of original, for copies of a document that are not extracted.
+
+        Aliases are stored by name, so they follow later extractions of the original.
+        """
+        if original not in self.catalog["documents"]:
+            raise KeyError(f"{original} is not in the store")
+        self.catalog.setdefault("aliases", {})[name] = original
+        self.catalog["documents"].pop(name, None)
+
+    def commit(self):
+        """Makes everything appended so far visible to readers, atomically."""
+        for f in (self.data, self.index):
+            f.flush()
+            os.fsync(f.fileno())
+        catalog_path = os.path.join(self.directory, CATALOG_FILE)
+        temp_path = catalog_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.catalog, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, catalog_path)
+
+
+def run_writer(directory, requests, acknowledgements, batch_size):
+    """Appends the documents sent by the workers until None is received.
+
+    A request is (key, name, records) or (key, name, original) for an alias. Requests are committed in
+    batches, and (key, error) is acknowledged for each one after its batch has been committed.
+
+    Signals to the process group are left to the parent, which stops the writer once the workers are
+    gone, so a batch is never abandoned halfway. If the parent dies, the writer commits and stops.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    parent = os.getppid()
+    writer = SegmentStoreWriter(directory)
+    running = True
+    try:
+        while running:
+            try:
+                batch = [requests.get(timeout=1)]
+            except queue.Empty:
+                running = os.getppid() == parent
+                continue
+            while len(batch) < batch_size:
+                try:
+                    batch.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            results = []
+            for request in batch:
+                if request is None:
+                    running = False
+                    continue
+                key, name, payload = request
+                try:
+                    if isinstance(payload, str):
+                        writer.alias(name, payload)
+                    else:
+                        writer.append_document(name, payload)
+                except (KeyError, OSError) as e:
+                    results.append((key, e.__str__()))
+                else:
+                    results.append((key, None))
+            writer.commit()
+            for result in results:
+                acknowledgements.put(result)
+    finally:
+        writer.close()
+
+
+class SegmentStoreProcess:
+    """Runs the single writer of a segment store in its own process.
+
+    Workers put their documents on the bounded requests queue, so they wait when the writer falls
+    behind. Like AsyncFileIO, it reports the documents whose writes have finished.
+    """
+
+    def __init__(self, directory, max_queued=16, batch_size=16):
+        self.requests = multiprocessing.Queue(max_queued)
+        self.acknowledgements = multiprocessing.Queue()
+        self.pending = 0
+        self.process = multiprocessing.Process(target=run_writer, name="segment_store",
+                                               args=(directory, self.requests, self.acknowledgements, batch_size))
+
+    def __enter__(self):
+        self.process.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join()
+
+    def alias(self, key, name, original):
+        self.pending += 1
+        self.requests.put((key, name, original))
+
+    def expect(self, count=1):
+        """Counts documents that workers have sent, so drain knows how many acknowledgements to wait for."""
+        self.pending += count
+
+    def completed_writes(self):
+        """Returns (key, error) for every document committed since the last call. error is None on success."""
+        completed = []
+        while self.pending > 0:
+            try:
+                completed.append(self.acknowledgements.get_nowait())
+            except queue.Empty:
+                break
+            self.pending -= 1
+        return completed
+
+    def drain(self):
+        completed = []
+        while self.pending > 0:
+            try:
+                completed.append(self.acknowledgements.get(timeout=1))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("The segment store writer stopped unexpectedly")
+                continue
+            self.pending -= 1
+        return completed
@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+
+import pytest
+
+import async_io
+from async_io import AsyncFileIO
+
+
+def make_sources(tmp_path, count):
+    sources = []
+    for i in range(count):
+        path = tmp_path / "library" / f"book_{i}.pdf"
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(f"book {i}")
+        sources.append(str(path))
+    return sources
+
+
+def test_prefetch_keeps_source_order(tmp_path, monkeypatch):
+    sources = make_sources(tmp_path, 6)
+    copy_file = async_io.copy_file
+
+    # Later sources finish copying first
+    def slow_copy_file(source, dest):
+        time.sleep(0.02 * (6 - sources.index(source)))
+        copy_file(source, dest)
+
+    monkeypatch.setattr(async_io, "copy_file", slow_copy_file)
+
+    with AsyncFileIO(str(tmp_path / "staging"), max_threads=6, prefetch_depth=2) as io:
+        prefetched = list(io.prefetch(sources))
+
+    assert [source for source, _ in prefetched] == sources
+    for i, (source, staged) in enumerate(prefetched):
+        assert os.path.basename(staged) == os.path.basename(source)
+        with open(staged) as f:
+            assert f.read() == f"book {i}"
+
+
+def test_prefetch_falls_back_to_source(tmp_path):
+    sources = make_sources(tmp_path, 1) + [str(tmp_path / "missing.pdf")]
+
+    with AsyncFileIO(str(tmp_path / "staging")) as io:
+        prefetched = list(io.prefetch(sources))
+
+    assert prefetched[1] == (sources[1], None)
+
+
+def test_write_behind(tmp_path):
+    local_path = tmp_path / "staging" / "out" / "a.json"
+    local_path.parent.mkdir(parents=True)
+    local_path.write_text("[]")
+    dest = str(tmp_path / "output" / "a.json")
+
+    with AsyncFileIO(str(tmp_path / "staging")) as io:
+        io.write_behind("a.pdf", str(local_path), dest)
+        io.write_behind("b.pdf", str(tmp_path / "missing.json"), str(tmp_path / "output" / "b.json"))
+        completed = dict(io.drain())
+
+    assert completed["a.pdf"] is None
+    assert isinstance(completed["b.pdf"], OSError)
+    assert not local_path.exists()
+    with open(dest) as f:
+        assert f.read() == "[]"
+
+
+def test_exit_finishes_pending_writes(tmp_path):
+    local_path = tmp_path / "a.json"
+    local_path.write_text("[]")
+    dest = tmp_path / "output" / "a.json"
+    started = threading.Event()
+
+    def slow_publish(*args):
+        started.set()
+        time.sleep(0.1)
+        async_io.publish_file(*args)
+
+    with AsyncFileIO(str(tmp_path / "staging"), max_threads=1) as io:
+        io.submit(slow_publish, str(local_path), str(dest))
+        started.wait()
+
+    assert dest.exists()
+
+
+def test_interrupted_exit_cancels_queued_copies(tmp_path):
+    release = threading.Event()
+
+    with pytest.raises(KeyboardInterrupt):
+        with AsyncFileIO(str(tmp_path / "staging"), max_threads=1) as io:
+            running = io.submit(release.wait)
+            queued = io.submit(async_io.copy_file, str(tmp_path / "a"), str(tmp_path / "b"))
+            raise KeyboardInterrupt
+
+    assert queued.cancelled()
+    release.set()
+    assert running.result(timeout=1)
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+from chunking import StreamingChunker, iter_page_windows
+
+
+def make_element(category, text, page_number=1):
+    return SimpleNamespace(category=category, text=text, metadata=SimpleNamespace(page_number=page_number))
+
+
+def feed_all(chunker, elements):
+    chunks = []
+    for element in elements:
+        chunks.extend(chunker.feed(element))
+    return chunks + chunker.flush()
+
+
+def test_titles_close_chunks():
+    chunker = StreamingChunker("by_title", max_characters=100)
+    chunks = feed_all(chunker, [
+        make_element("Title", "One"),
+        make_element("NarrativeText", "First text."),
+        make_element("PageBreak", ""),
+        make_element("Title", "Two", page_number=2),
+        make_element("NarrativeText", "Second text.", page_number=2),
+    ])
+
+    assert [chunk["text"] for chunk in chunks] == ["One\n\nFirst text.", "Two\n\nSecond text."]
+    assert [chunk["metadata"]["page_number"] for chunk in chunks] == [1, 2]
+    assert [chunk["metadata"]["section"] for chunk in chunks] == ["One", "Two"]
+
+
+def test_basic_ignores_titles():
+    chunker = StreamingChunker("basic", max_characters=100)
+    chunks = feed_all(chunker, [make_element("Title", "One"), make_element("Title", "Two")])
+
+    assert [chunk["text"] for chunk in chunks] == ["One\n\nTwo"]
+
+
+def test_max_characters_closes_chunks():
+    chunker = StreamingChunker("basic", max_characters=10)
+    chunks = feed_all(chunker, [make_element("NarrativeText", "abcd"), make_element("NarrativeText", "efgh"),
+                                make_element("NarrativeText", "ijkl")])
+
+    # "abcd\n\nefgh" fits exactly; the separator is counted
+    assert [chunk["text"] for chunk in chunks] == ["abcd\n\nefgh", "ijkl"]
+    assert all(len(chunk["text"]) <= 10 for chunk in chunks)
+
+
+def test_long_text_is_split():
+    chunker = StreamingChunker("basic", max_characters=4)
+    chunks = feed_all(chunker, [make_element("NarrativeText", "abcdefghij")])
+
+    assert [chunk["text"] for chunk in chunks] == ["abcd", "efgh", "ij"]
+
+
+def test_tables_are_never_combined():
+    chunker = StreamingChunker("basic", max_characters=100)
+    chunks = feed_all(chunker, [make_element("NarrativeText", "Before."), make_element("Table", "a b c"),
+                                make_element("NarrativeText", "After.")])
+
+    assert [(chunk["type"], chunk["text"]) for chunk in chunks] == [
+        ("CompositeElement", "Before."), ("Table", "a b c"), ("CompositeElement", "After.")]
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        StreamingChunker("by_page")
+
+
+def test_other_documents_are_not_windowed(tmp_path):
+    path = str(tmp_path / "book.epub")
+
+    assert list(iter_page_windows(path, str(tmp_path))) == [(path, 0)]
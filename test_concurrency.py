@@ -0,0 +1,65 @@
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrency import ConcurrencyController, get_available_memory, get_child_pids, get_process_rss
+
+MiB = 2 ** 20
+
+
+def test_limit_lowered_under_pressure():
+    controller = ConcurrencyController(min_workers=1, max_workers=8, min_available=512 * MiB)
+
+    controller.update(400 * MiB, [300 * MiB])
+    assert controller.limit == 7
+
+    controller.update(100 * MiB, [300 * MiB])
+    assert controller.limit == 3
+
+    controller.update(100 * MiB, [300 * MiB])
+    controller.update(100 * MiB, [300 * MiB])
+    assert controller.limit == 1
+
+
+def test_limit_raised_when_there_is_room():
+    controller = ConcurrencyController(min_workers=2, max_workers=4, min_available=512 * MiB)
+    controller.limit = 2
+
+    # Not enough room for another worker as large as the largest one
+    controller.update(700 * MiB, [300 * MiB])
+    assert controller.limit == 2
+
+    for _ in range(3):
+        controller.update(1024 * MiB, [300 * MiB])
+    assert controller.limit == 4
+
+
+def test_gate_waits_for_finished_tasks():
+    controller = ConcurrencyController(min_workers=1, max_workers=2, min_available=0, sample_interval=0.05)
+    controller.sample = lambda: None  # Keep the limit independent of the memory of the test machine
+    finished_tasks = multiprocessing.Value("i", 0)
+    gate = controller.gate(range(4), finished_tasks)
+
+    assert [next(gate), next(gate)] == [0, 1]
+
+    # The third task is held back until a worker reports a finished task
+    def finish():
+        time.sleep(0.2)
+        with finished_tasks.get_lock():
+            finished_tasks.value += 1
+
+    thread = threading.Thread(target=finish)
+    thread.start()
+    start_time = time.monotonic()
+    assert next(gate) == 2
+    assert time.monotonic() - start_time >= 0.15
+    thread.join()
+
+
+def test_process_memory():
+    if get_available_memory() is None:
+        return
+
+    assert get_process_rss(os.getpid()) > 0
+    assert os.getpid() in get_child_pids(os.getppid())
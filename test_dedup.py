@@ -0,0 +1,81 @@
+import os
+import random
+import zipfile
+
+from dedup import find_duplicates, get_shingles, group_candidates, link_output, normalize_title
+
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda omicron sigma tau upsilon omega".split()
+
+
+def make_text(seed, words=2000):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def write_epub(path, title, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zipfile.ZipFile(path, "w") as book:
+        book.writestr("META-INF/container.xml", (
+            '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="c.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'
+        ))
+        book.writestr("c.opf", (
+            '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="2.0">'
+            f'<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>{title}</dc:title></metadata></package>'
+        ))
+        book.writestr("a.xhtml", f"<html><body><p>{text}</p></body></html>")
+    return path
+
+
+def test_normalize_title():
+    assert normalize_title("Les Misérables, Tome I!") == "les miserables tome i"
+
+
+def test_group_candidates(tmp_path):
+    text = make_text(1)
+    by_name = write_epub(str(tmp_path / "a" / "Moby Dick.epub"), "Unrelated", text)
+    by_title = write_epub(str(tmp_path / "b" / "md.epub"), "Moby-Dick", text)
+    other = write_epub(str(tmp_path / "c" / "Emma.epub"), "Emma", text)
+
+    groups = group_candidates([by_name, by_title, other])
+    assert [sorted(group) for group in groups] == [sorted([by_name, by_title])]
+
+
+def test_find_duplicates(tmp_path):
+    text = make_text(1)
+    first = write_epub(str(tmp_path / "a" / "Moby Dick.epub"), "Moby Dick", text)
+    copy = write_epub(str(tmp_path / "b" / "Moby Dick.epub"), "Moby Dick", text)
+    # Shares the title, but not the text
+    other_edition = write_epub(str(tmp_path / "c" / "Moby Dick.epub"), "Moby Dick", make_text(2))
+
+    mobi = str(tmp_path / "d" / "Moby Dick.mobi")
+    os.makedirs(os.path.dirname(mobi))
+    with open(mobi, "wb") as f:
+        f.write(b"not a real mobi")
+    converted = str(tmp_path / "converted.html")
+    with open(converted, "w") as f:
+        f.write(f"<html><body>{text}</body></html>")
+
+    duplicates = find_duplicates([mobi, other_edition, copy, first], convert_mobi=lambda path: converted)
+    assert duplicates == {copy: first, mobi: first}
+
+
+def test_short_texts_are_not_compared(tmp_path):
+    first = write_epub(str(tmp_path / "a" / "Emma.epub"), "Emma", "Too short to compare.")
+    copy = write_epub(str(tmp_path / "b" / "Emma.epub"), "Emma", "Too short to compare.")
+
+    assert get_shingles("Too short to compare.") == set()
+    assert find_duplicates([first, copy]) == {}
+
+
+def test_link_output(tmp_path):
+    target = tmp_path / "out" / "a.json"
+    target.parent.mkdir()
+    target.write_text("[]")
+    link = str(tmp_path / "links" / "b.json")
+
+    link_output(str(target), link)
+    link_output(str(target), link)
+
+    with open(link) as f:
+        assert f.read() == "[]"
@@ -0,0 +1,128 @@
+import json
+import os
+
+import pytest
+
+import extract_daemon
+from extract_daemon import ExtractionDaemon
+from main import BulkTextExtract
+
+
+class InlinePool:
+    """Stands in for a keep-alive mpire pool: its single worker is initialized once and then runs every job."""
+
+    def __init__(self, shared_objects):
+        self.shared_objects = shared_objects
+        self.initialized = 0
+        self.jobs = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def imap_unordered(self, func, iterable, worker_init=None, worker_lifespan=None):
+        if self.initialized == 0 and worker_init is not None:
+            worker_init(self.shared_objects)
+            self.initialized += 1
+        self.jobs += 1
+        for item in iterable:
+            yield func(self.shared_objects, item)
+
+
+def extract_stub(settings, file, staged=None):
+    # Files named "broken" fail the way a document the parsers choke on does
+    return (None if "broken" in file else file), {}
+
+
+class StubDaemon(ExtractionDaemon):
+    extractor = staticmethod(extract_stub)
+
+    def __init__(self, queue_dir):
+        super().__init__(queue_dir, max_num_threads=1)
+        self.pools = []
+
+    def open_pool(self):
+        self.pools.append(InlinePool(self.worker_settings))
+        return self.pools[-1]
+
+
+def submit(queue_dir, name, job):
+    with open(os.path.join(queue_dir, "incoming", name), "w") as f:
+        json.dump(job, f)
+
+
+def read_job(queue_dir, outcome, name):
+    with open(os.path.join(queue_dir, outcome, name)) as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    monkeypatch.setattr(BulkTextExtract, "warm_up", staticmethod(lambda *_: None))
+    daemon = StubDaemon(str(tmp_path))
+    daemon.thread_pool = InlinePool(daemon.worker_settings)
+    return daemon
+
+
+def test_jobs_move_to_done_or_failed(daemon, tmp_path):
+    queue_dir = str(tmp_path)
+    submit(queue_dir, "1.json", {"files": ["/a.pdf", "/b.epub"]})
+    submit(queue_dir, "2.json", {"files": ["/c.pdf", "/broken.pdf"]})
+    submit(queue_dir, "3.json", {"directory": 42})
+    submit(queue_dir, "4.json", {"path": "/library"})
+    submit(queue_dir, "notes.txt", {})
+
+    for _ in range(4):
+        assert daemon.process_next_job()
+    assert not daemon.process_next_job()
+
+    done = read_job(queue_dir, "done", "1.json")
+    assert (done["documents"], done["succeeded"], done["failed"]) == (2, ["/a.pdf", "/b.epub"], [])
+
+    failed = read_job(queue_dir, "failed", "2.json")
+    assert (failed["succeeded"], failed["failed"]) == (["/c.pdf"], ["/broken.pdf"])
+
+    assert "error" in read_job(queue_dir, "failed", "3.json")
+    assert "error" in read_job(queue_dir, "failed", "4.json")
+    assert os.listdir(os.path.join(queue_dir, "processing")) == []
+    assert os.listdir(os.path.join(queue_dir, "incoming")) == ["notes.txt"]
+
+
+def test_interrupted_job_is_requeued(daemon, tmp_path):
+    queue_dir = str(tmp_path)
+    submit(queue_dir, "1.json", {"files": ["/a.pdf"]})
+
+    def interrupt(settings, file, staged=None):
+        raise KeyboardInterrupt
+
+    daemon.extractor = interrupt
+    with pytest.raises(KeyboardInterrupt):
+        daemon.process_next_job()
+    assert os.listdir(os.path.join(queue_dir, "processing")) == ["1.json"]
+
+    # The next daemon started on the queue picks the job up again
+    restarted = StubDaemon(queue_dir)
+    restarted.thread_pool = InlinePool(restarted.worker_settings)
+    restarted.requeue_interrupted_jobs()
+    assert restarted.process_next_job()
+    assert read_job(queue_dir, "done", "1.json")["succeeded"] == ["/a.pdf"]
+
+
+def test_pool_is_kept_alive_between_jobs(daemon, tmp_path, monkeypatch):
+    queue_dir = str(tmp_path)
+    submit(queue_dir, "1.json", {"files": ["/a.pdf"]})
+    submit(queue_dir, "2.json", {"files": ["/b.pdf"]})
+
+    def stop(seconds):
+        raise KeyboardInterrupt
+
+    # serve_forever only returns when interrupted, which here happens once the queue is empty
+    monkeypatch.setattr(extract_daemon.time, "sleep", stop)
+    with pytest.raises(KeyboardInterrupt):
+        daemon.serve_forever()
+
+    assert len(daemon.pools) == 1
+    assert (daemon.pools[0].jobs, daemon.pools[0].initialized) == (2, 1)
+    assert sorted(os.listdir(os.path.join(queue_dir, "done"))) == ["1.json", "2.json"]
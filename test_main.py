@@ -0,0 +1,179 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import types
+
+import pytest
+
+from main import BulkTextExtract, parse_args
+from metrics import Metrics
+from test_dedup import make_text, write_epub
+
+
+def test_detect_duplicates_converts_mobi_books_in_pool(tmp_path):
+    pytest.importorskip("mpire")
+    library = tmp_path / "library"
+    text = make_text(1)
+    epub = write_epub(str(library / "Moby Dick.epub"), "Moby Dick", text)
+    mobi = library / "Moby Dick.mobi"
+    mobi.write_bytes(b"not a real mobi")
+    unrelated = library / "Emma.mobi"
+    unrelated.write_bytes(b"not a real mobi either")
+
+    # A cached conversion is found by the fingerprint of the source, so the pool never needs kindleunpack
+    cache_dir = os.path.join(str(library), BulkTextExtract.mobi_cache_dir, BulkTextExtract.get_file_fingerprint(str(mobi)), "mobi8")
+    write_epub(os.path.join(cache_dir, "Moby Dick.epub"), "Moby Dick", text)
+
+    app = BulkTextExtract(str(library), max_num_threads=2)
+    app.files = [epub, str(mobi), str(unrelated)]
+    converted = []
+    convert_mobi_files = app.convert_mobi_files
+
+    def record_conversions(files):
+        converted.extend(files)
+        return convert_mobi_files(files)
+
+    app.convert_mobi_files = record_conversions
+    app.detect_duplicates()
+
+    assert app.duplicates == {str(mobi): epub}
+    # Books without a candidate copy are not converted
+    assert converted == [str(mobi)]
+
+
+def test_parse_args_defaults():
+    args = parse_args(["/library"])
+
+    assert args.directory == "/library"
+    assert (args.workers, args.output_mode, args.resume, args.status, args.dedup) == (6, "beside", "resume", False, False)
+    assert args.formats == "pdf,mobi,epub"
+    assert args.prefer == "epub,pdf,mobi"
+
+
+def test_parse_args_options():
+    args = parse_args(["/library", "-n", "3", "--output-mode", "store", "-o", "/out", "--resume", "restart",
+                       "--stream-chunks", "--max-characters", "800", "--dedup", "--prefer", "pdf,epub"])
+
+    assert (args.workers, args.output_mode, args.output_dir, args.resume) == (3, "store", "/out", "restart")
+    assert (args.stream_chunks, args.max_characters, args.dedup, args.prefer) == (True, 800, True, "pdf,epub")
+
+
+@pytest.mark.parametrize("argv", [
+    ["/library", "--output-mode", "collect"],
+    ["/library", "--output-mode", "store"],
+    ["/library", "--resume", "continue"],
+    [],
+])
+def test_parse_args_rejects(argv):
+    with pytest.raises(SystemExit):
+        parse_args(argv)
+
+
+def test_cli_does_not_import_heavy_modules():
+    # --help, --status and the resume check must not wait for unstructured, mobi or mpire to load
+    code = ("import sys, main; main.parse_args(['/library', '--status']); "
+            "print(sorted({name.split('.')[0] for name in sys.modules} & {'unstructured', 'mobi', 'mpire'}))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"
+
+
+def make_library(tmp_path, names):
+    library = tmp_path / "library"
+    library.mkdir(exist_ok=True)
+    for name in names:
+        (library / name).write_bytes(b"%PDF-1.4")
+    return str(library)
+
+
+def test_progress_round_trip(tmp_path):
+    library = make_library(tmp_path, ["a.pdf", "b.pdf", "c.pdf"])
+    app = BulkTextExtract(library)
+    app.files = ["a.pdf", "b.pdf", "c.pdf"]
+    app.completed = {"b.pdf", "a.pdf"}
+    app.duplicates = {"c.pdf": "a.pdf"}
+    app.flush_progress()
+
+    assert not os.path.exists(app.progress_file + ".tmp")
+    resumed = BulkTextExtract(library)
+    resumed.attempt_load_progress()
+    assert (resumed.files, resumed.completed, resumed.duplicates) == (app.files, app.completed, app.duplicates)
+
+
+def test_legacy_progress_index(tmp_path):
+    library = make_library(tmp_path, [])
+    with open(os.path.join(library, "progress.json"), "w") as f:
+        json.dump({"files": ["a.pdf", "b.pdf", "c.pdf"], "progress_index": 2}, f)
+
+    app = BulkTextExtract(library)
+    app.attempt_load_progress()
+    assert app.completed == {"a.pdf", "b.pdf"}
+
+
+@pytest.mark.parametrize("resume, files, completed", [
+    ("resume", ["a.pdf"], {"a.pdf"}),
+    ("rescan", ["a.pdf", "b.pdf"], {"a.pdf"}),
+    ("restart", ["a.pdf", "b.pdf"], set()),
+])
+def test_run_resumes_previous_session(tmp_path, monkeypatch, resume, files, completed):
+    library = make_library(tmp_path, ["a.pdf", "b.pdf"])
+    a = os.path.join(library, "a.pdf")
+    BulkTextExtract.save_progress(os.path.join(library, "progress.json"), [a], {a})
+
+    app = BulkTextExtract(library)
+    monkeypatch.setattr(app, "begin_extract", lambda: True)
+    app.run(resume)
+
+    assert sorted(app.files) == [os.path.join(library, name) for name in files]
+    assert app.completed == {os.path.join(library, name) for name in completed}
+
+
+class InterruptedPool:
+    """Stands in for an mpire pool that receives Ctrl+C after its first document."""
+
+    def __init__(self, n_jobs, shared_objects):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def imap_unordered(self, func, tasks, **kwargs):
+        yield next(iter(tasks)), Metrics().as_dict()
+        raise KeyboardInterrupt
+
+
+def test_interrupted_extraction_saves_progress(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "mpire", types.SimpleNamespace(WorkerPool=InterruptedPool))
+    library = make_library(tmp_path, ["a.pdf", "b.pdf", "c.pdf"])
+    app = BulkTextExtract(library, max_num_threads=2)
+    app.find_files()
+    app.files.sort()
+    handlers = {signal_number: signal.getsignal(signal_number) for signal_number in (signal.SIGINT, signal.SIGTERM)}
+
+    assert not app.begin_extract()
+
+    # Only the document that finished before the interruption is completed, and the handlers are restored
+    with open(app.progress_file) as f:
+        progress = json.load(f)
+    assert progress["files"] == app.files
+    assert progress["completed"] == [app.files[0]]
+    assert {signal_number: signal.getsignal(signal_number) for signal_number in handlers} == handlers
+
+
+def test_signal_handler_forces_exit_on_second_signal(tmp_path):
+    app = BulkTextExtract(make_library(tmp_path, []))
+    handlers = {signal_number: signal.getsignal(signal_number) for signal_number in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            app.signal_handler(signal.SIGTERM, None)
+        assert signal.getsignal(signal.SIGINT) == BulkTextExtract.force_exit_handler
+        assert signal.getsignal(signal.SIGTERM) == BulkTextExtract.force_exit_handler
+    finally:
+        for signal_number, handler in handlers.items():
+            signal.signal(signal_number, handler)
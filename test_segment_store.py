@@ -0,0 +1,75 @@
+import os
+
+from segment_store import DATA_FILE, SegmentStore, SegmentStoreWriter, element_records
+
+
+def make_records(name, pages):
+    return element_records([
+        {"type": "Title" if page == 1 else "NarrativeText", "text": f"{name} page {page}", "metadata": {"page_number": page}}
+        for page in range(1, pages + 1)
+    ])
+
+
+def test_round_trip(tmp_path):
+    writer = SegmentStoreWriter(tmp_path)
+    writer.append_document("a.pdf", make_records("a", 3))
+    writer.append_document("b.epub", make_records("b", 2))
+    writer.commit()
+    writer.close()
+
+    with SegmentStore(tmp_path) as store:
+        assert sorted(store.documents()) == ["a.pdf", "b.epub"]
+        assert [store.element(entry)["text"] for entry in store.entries("a.pdf")] == ["a page 1", "a page 2", "a page 3"]
+        assert [entry.document for entry in store.entries(page=2)] == ["a.pdf", "b.epub"]
+        assert [entry.document for entry in store.entries(element_type="Title")] == ["a.pdf", "b.epub"]
+        assert list(store.entries("missing.pdf")) == []
+
+
+def test_reextracted_document_replaces_earlier_one(tmp_path):
+    writer = SegmentStoreWriter(tmp_path)
+    writer.append_document("a.pdf", make_records("old", 2))
+    writer.commit()
+    writer.append_document("a.pdf", make_records("new", 1))
+    writer.commit()
+    writer.close()
+
+    with SegmentStore(tmp_path) as store:
+        assert [store.element(entry)["text"] for entry in store.entries("a.pdf")] == ["new page 1"]
+        assert [store.element(entry)["text"] for entry in store.entries()] == ["new page 1"]
+
+
+def test_alias_follows_reextraction(tmp_path):
+    writer = SegmentStoreWriter(tmp_path)
+    writer.append_document("a.epub", make_records("old", 1))
+    writer.alias("a.pdf", "a.epub")
+    writer.commit()
+    writer.append_document("a.epub", make_records("new", 1))
+    writer.commit()
+    writer.close()
+
+    with SegmentStore(tmp_path) as store:
+        assert sorted(store.documents()) == ["a.epub", "a.pdf"]
+        assert [store.element(entry)["text"] for entry in store.entries("a.pdf")] == ["new page 1"]
+        assert all(entry.document == "a.pdf" for entry in store.entries("a.pdf"))
+
+
+def test_uncommitted_data_is_discarded(tmp_path):
+    writer = SegmentStoreWriter(tmp_path)
+    writer.append_document("a.pdf", make_records("a", 1))
+    writer.commit()
+    committed_size = os.path.getsize(tmp_path / DATA_FILE)
+    writer.append_document("b.pdf", make_records("b", 1))
+    writer.close()
+
+    # Readers only see committed data, and the next writer truncates the rest
+    with SegmentStore(tmp_path) as store:
+        assert store.documents() == ["a.pdf"]
+
+    writer = SegmentStoreWriter(tmp_path)
+    assert os.path.getsize(tmp_path / DATA_FILE) == committed_size
+    writer.append_document("c.pdf", make_records("c", 1))
+    writer.commit()
+    writer.close()
+
+    with SegmentStore(tmp_path) as store:
+        assert [store.element(entry)["text"] for entry in store.entries("c.pdf")] == ["c page 1"]